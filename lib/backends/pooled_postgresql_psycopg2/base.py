@@ -0,0 +1,189 @@
+"""
+postgresql_psycopg2, but each process keeps its connections open in a pool
+instead of connecting for every request. Turn it on in localsettings with
+
+    DATABASE_ENGINE = 'yourworld.lib.backends.pooled_postgresql_psycopg2'
+
+When Django closes a connection at the end of a request, it's rolled back
+and put back in the pool; the next request's first query takes one out.
+The pool holds at most DATABASE_POOL_SIZE connections, in use or idle, and
+a request that finds them all in use waits up to DATABASE_POOL_TIMEOUT
+seconds for one. Connections older than DATABASE_POOL_MAX_AGE seconds are
+closed when they come back, and ones idle for longer than
+DATABASE_POOL_CHECK_AFTER get a SELECT 1 before they're handed out. Size the
+pool to the worker's threads: each long poll holds its connection too.
+
+`pool.stats()` has the counts, wait times and utilization for operators.
+"""
+
+import threading, time
+
+from django.conf import settings
+from django.db.backends.postgresql_psycopg2.base import *
+from django.db.backends.postgresql_psycopg2.base import DatabaseWrapper as _DatabaseWrapper
+
+class PoolTimeout(DatabaseError):
+    pass
+
+class Pool(object):
+    def __init__(self, size, timeout, max_age, check_after):
+        self.size = size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.check_after = check_after
+        self._cond = threading.Condition()
+        self._idle = [] # (connection, last used), most recently used last
+        self._born = {} # id(connection) -> when it was opened
+        self._in_use = 0
+        self._counts = {
+            'acquired': 0,
+            'opened': 0,
+            'waits': 0, # acquires that had to wait for a connection
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0,
+            'timeouts': 0,
+            'recycled': 0, # closed for age
+            'broken': 0, # closed for failing a check or rollback
+        }
+
+    def acquire(self):
+        """
+        Takes a connection out of the pool. Returns None if there's room for a
+        new one instead: the caller must then either open it and call opened(),
+        or call release(None) to give up its place.
+        """
+        start = time.time()
+        self._cond.acquire()
+        try:
+            while not self._idle and self._in_use >= self.size:
+                remaining = start + self.timeout - time.time()
+                if remaining <= 0:
+                    self._counts['timeouts'] += 1
+                    raise PoolTimeout('No database connection free after %s seconds' % self.timeout)
+                self._cond.wait(remaining)
+            waited = time.time() - start
+            if waited > 0.001:
+                self._counts['waits'] += 1
+                self._counts['wait_seconds'] += waited
+                self._counts['max_wait_seconds'] = max(self._counts['max_wait_seconds'], waited)
+            self._counts['acquired'] += 1
+            self._in_use += 1
+            if not self._idle:
+                return None
+            connection, last_used = self._idle.pop()
+        finally:
+            self._cond.release()
+        if time.time() - last_used > self.check_after and not self._healthy(connection):
+            self._close(connection, 'broken')
+            return None
+        return connection
+
+    def opened(self, connection):
+        self._cond.acquire()
+        try:
+            self._born[id(connection)] = time.time()
+            self._counts['opened'] += 1
+        finally:
+            self._cond.release()
+
+    def release(self, connection):
+        """Puts back a connection from acquire(), or gives up the place if it's None."""
+        if connection is not None:
+            if time.time() - self._born.get(id(connection), 0) > self.max_age:
+                self._close(connection, 'recycled')
+                connection = None
+            else:
+                try:
+                    connection.rollback()
+                except Exception:
+                    self._close(connection, 'broken')
+                    connection = None
+        self._cond.acquire()
+        try:
+            self._in_use -= 1
+            if connection is not None:
+                self._idle.append((connection, time.time()))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _healthy(self, connection):
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, connection, why):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        self._cond.acquire()
+        try:
+            self._born.pop(id(connection), None)
+            self._counts[why] += 1
+        finally:
+            self._cond.release()
+
+    def stats(self):
+        self._cond.acquire()
+        try:
+            stats = dict(self._counts)
+            stats.update({
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'utilization': float(self._in_use) / self.size,
+            })
+            return stats
+        finally:
+            self._cond.release()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(alias):
+    _pools_lock.acquire()
+    try:
+        if alias not in _pools:
+            _pools[alias] = Pool(getattr(settings, 'DATABASE_POOL_SIZE', 10),
+                                 getattr(settings, 'DATABASE_POOL_TIMEOUT', 10),
+                                 getattr(settings, 'DATABASE_POOL_MAX_AGE', 600),
+                                 getattr(settings, 'DATABASE_POOL_CHECK_AFTER', 30))
+        return _pools[alias]
+    finally:
+        _pools_lock.release()
+
+class DatabaseWrapper(_DatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+        self.pool = _get_pool(self.alias)
+
+    def _cursor(self):
+        if self.connection is not None:
+            return super(DatabaseWrapper, self)._cursor()
+        connection = self.pool.acquire()
+        if connection is not None:
+            connection.set_isolation_level(self.isolation_level)
+            self.connection = connection
+            return super(DatabaseWrapper, self)._cursor()
+        # Our turn to open a new one
+        try:
+            cursor = super(DatabaseWrapper, self)._cursor()
+        except:
+            if self.connection is not None:
+                self.pool._close(self.connection, 'broken')
+                self.connection = None
+            self.pool.release(None)
+            raise
+        self.pool.opened(self.connection)
+        return cursor
+
+    def close(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            self.pool.release(connection)
@@ -0,0 +1,224 @@
+"""
+Cache backends for the ywot caches.
+
+LocalCache is a per-process, thread-safe LRU with an optional TTL. It is the
+default, and is all a single-process deployment needs. SharedCache puts the
+entries in django.core.cache instead (e.g. CACHE_BACKEND = 'memcached://...'),
+so that every worker process sees the same entries and invalidations.
+
+Pick one with YWOT_CACHE_BACKEND = 'local' or 'shared' in settings.
+"""
+
+import hashlib, threading, time
+
+from django.conf import settings
+
+class _Link(object):
+    __slots__ = ['prev', 'next', 'key', 'value', 'expires']
+
+class LocalCache(object):
+    """An LRU dict with a size bound and optional per-entry timeout (in seconds)."""
+    shared = False
+
+    def __init__(self, max_entries=10000, timeout=None):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._map = {}
+        self._root = root = _Link() # sentinel; root.next is the most recently used
+        root.prev = root.next = root
+
+    def _unlink(self, link):
+        link.prev.next = link.next
+        link.next.prev = link.prev
+
+    def _push_front(self, link):
+        root = self._root
+        link.prev, link.next = root, root.next
+        root.next.prev = link
+        root.next = link
+
+    def _get(self, key, now):
+        link = self._map.get(key)
+        if link is None:
+            return None
+        if link.expires is not None and link.expires < now:
+            self._unlink(link)
+            del self._map[key]
+            return None
+        self._unlink(link)
+        self._push_front(link)
+        return link
+
+    def _set(self, key, value, timeout, now):
+        if timeout is None:
+            timeout = self.timeout
+        link = self._map.get(key)
+        if link is None:
+            link = _Link()
+            link.key = key
+            self._map[key] = link
+        else:
+            self._unlink(link)
+        link.value = value
+        link.expires = (now + timeout) if timeout else None
+        self._push_front(link)
+        while len(self._map) > self.max_entries:
+            oldest = self._root.prev
+            self._unlink(oldest)
+            del self._map[oldest.key]
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._get(key, time.time())
+        finally:
+            self._lock.release()
+        if link is None:
+            return default
+        return link.value
+
+    def get_many(self, keys):
+        result = {}
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for key in keys:
+                link = self._get(key, now)
+                if link is not None:
+                    result[key] = link.value
+        finally:
+            self._lock.release()
+        return result
+
+    def set(self, key, value, timeout=None):
+        self._lock.acquire()
+        try:
+            self._set(key, value, timeout, time.time())
+        finally:
+            self._lock.release()
+
+    def set_many(self, data, timeout=None):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for key, value in data.iteritems():
+                self._set(key, value, timeout, now)
+        finally:
+            self._lock.release()
+
+    def add(self, key, value, timeout=None):
+        """Set `key` only if it isn't already set. Returns whether it was set."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if self._get(key, now) is not None:
+                return False
+            self._set(key, value, timeout, now)
+            return True
+        finally:
+            self._lock.release()
+
+    def incr(self, key, delta=1):
+        """Increments an integer entry, starting from 0 if it isn't set."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            link = self._get(key, now)
+            value = (link.value if link is not None else 0) + delta
+            self._set(key, value, None, now)
+            return value
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        self._lock.acquire()
+        try:
+            for key in keys:
+                link = self._map.pop(key, None)
+                if link is not None:
+                    self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._map)
+
+class SharedCache(object):
+    """
+    Same interface as LocalCache, on top of django.core.cache. Keys may be
+    any tuple of strings and numbers. `max_entries` is left to the cache server.
+    """
+    shared = True
+
+    def __init__(self, prefix, timeout=None):
+        from django.core.cache import cache
+        self._cache = cache
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def _key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        s = ':'.join([self.prefix] + [unicode(k) for k in key]).encode('utf-8')
+        if len(s) > 200 or ' ' in s:
+            # memcached's limits
+            s = '%s:%s' % (self.prefix, hashlib.md5(s).hexdigest())
+        return s
+
+    def _timeout(self, timeout):
+        return timeout if timeout is not None else self.timeout
+
+    def get(self, key, default=None):
+        return self._cache.get(self._key(key), default)
+
+    def get_many(self, keys):
+        keymap = dict((self._key(k), k) for k in keys)
+        found = self._cache.get_many(keymap.keys())
+        return dict((keymap[k], v) for k, v in found.iteritems())
+
+    def set(self, key, value, timeout=None):
+        self._cache.set(self._key(key), value, self._timeout(timeout))
+
+    def set_many(self, data, timeout=None):
+        self._cache.set_many(dict((self._key(k), v) for k, v in data.iteritems()),
+                             self._timeout(timeout))
+
+    def add(self, key, value, timeout=None):
+        return self._cache.add(self._key(key), value, self._timeout(timeout))
+
+    def incr(self, key, delta=1):
+        k = self._key(key)
+        try:
+            return self._cache.incr(k, delta)
+        except ValueError:
+            # Not set yet. If we lose the race to add it, incr again. (A
+            # timeout of 0 would have it expire at once with some backends.)
+            if self._cache.add(k, delta, self._timeout(None)):
+                return delta
+            return self._cache.incr(k, delta)
+
+    def delete(self, key):
+        self._cache.delete(self._key(key))
+
+    def delete_many(self, keys):
+        self._cache.delete_many([self._key(k) for k in keys])
+
+def get_cache(prefix, max_entries, timeout=None):
+    """Returns a cache of the configured kind. `prefix` namespaces shared keys."""
+    if getattr(settings, 'YWOT_CACHE_BACKEND', 'local') == 'shared':
+        return SharedCache(prefix, timeout)
+    return LocalCache(max_entries, timeout)
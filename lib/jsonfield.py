@@ -1,26 +1,98 @@
-#http://www.djangosnippets.org/snippets/1478/
+#http://www.djangosnippets.org/snippets/1478/, made lazy
+#
+# A DictField holds the JSON text it was loaded with until the attribute is
+# first read, and writes that same text back if it never was, so rows that
+# are loaded and saved (or sent on) without looking at the dict never pay
+# for JSON. '{}', which most tile properties are, is never parsed at all, nor
+# dumped again while it stays empty. Once the attribute has been read, though,
+# a save dumps it afresh, and most tile paths (send_edits checking for
+# protection, apply_edits clearing links, the tile cache) do read it: what
+# this saves on tiles is mostly the cost of the empty ones.
+#
+# A faster JSON module can be plugged in with settings.JSON_CODEC, the name
+# of a module with simplejson-style loads() and dumps() (e.g. 'ujson').
 
 from django.db import models
 from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import importlib
 from django.utils import simplejson as json
 
+EMPTY = u'{}'
+
+_codec = None
+
+def _get_codec():
+    global _codec
+    if _codec is None:
+        from django.conf import settings
+        name = getattr(settings, 'JSON_CODEC', None)
+        if name:
+            module = importlib.import_module(name)
+            _codec = (module.loads, module.dumps)
+        else:
+            _codec = (json.loads, lambda value: json.dumps(value, cls=DjangoJSONEncoder))
+    return _codec
+
+def loads(text):
+    """Parses what DictField stores."""
+    if text == EMPTY or not text:
+        return {}
+    value = _get_codec()[0](text)
+    assert isinstance(value, dict)
+    return value
+
+def dumps(value):
+    """Serializes a dict the way DictField stores it."""
+    assert isinstance(value, dict)
+    if not value:
+        return EMPTY
+    return _get_codec()[1](value)
+
+class _LazyDict(object):
+    # The attribute holds either the text from the database (not read yet)
+    # or the dict.
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.field.attname]
+        if not isinstance(value, dict):
+            value = loads(value)
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
 class DictField(models.TextField):
     """DictField is a textfield that contains JSON-serialized dictionaries."""
 
-    # Used so to_python() is called
-    __metaclass__ = models.SubfieldBase
+    def contribute_to_class(self, cls, name):
+        super(DictField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, _LazyDict(self))
 
     def to_python(self, value):
-        """Convert our string value to JSON after we load it from the DB"""
         if isinstance(value, dict):
             return value
-        value = json.loads(value)
-        assert isinstance(value, dict)
-        return value
+        return loads(value)
+
+    def db_value(self, instance):
+        """
+        The text to store for `instance`: what was loaded, if the dict was
+        never read, and a fresh dump otherwise.
+        """
+        value = instance.__dict__[self.attname]
+        if isinstance(value, basestring):
+            return value
+        return dumps(value)
+
+    def pre_save(self, model_instance, add):
+        return self.db_value(model_instance)
 
     def get_db_prep_save(self, value):
         """Convert our JSON object to a string before we save"""
-        assert isinstance(value, dict)
-        value = json.dumps(value, cls=DjangoJSONEncoder)
+        if isinstance(value, dict):
+            value = dumps(value)
         return super(DictField, self).get_db_prep_save(value)
-
@@ -1,6 +1,26 @@
-import os, logging, logging.handlers, time
+"""
+The application log, LOG_DIRECTORY/application.log.
+
+Logging calls never touch the file themselves: records go on a queue of at
+most LOG_QUEUE_SIZE, and a background thread writes them out (and does the
+rotating). When the queue is full, records are dropped and counted in
+`stats` rather than holding up the request. Nothing is set up until the
+first record is logged, and whatever is still queued is written at exit.
+
+Use `action` for the ACTION events. With LOG_FORMAT = 'json', every line is
+a JSON object, and ACTION events carry their fields by name.
+"""
+
+import atexit, datetime, logging, logging.handlers, os, Queue, threading
 
 from django.conf import settings
+from django.utils import simplejson
+
+stats = {
+    'queued': 0,
+    'written': 0,
+    'dropped': 0, # queue was full
+}
 
 def _mkdir(newdir):
     # Copied from http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/82465
@@ -21,21 +41,134 @@ def _mkdir(newdir):
         if tail:
             os.mkdir(newdir)
 
-_mkdir(settings.LOG_DIRECTORY)
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue for another thread to write, like the
+    logging.handlers.QueueHandler that Python 2 doesn't have. Records are
+    formatted here first, since their arguments and tracebacks belong to
+    the caller.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+            _count('queued')
+        except Queue.Full:
+            _count('dropped')
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with the fields of ACTION events spelled out."""
+
+    def format(self, record):
+        d = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+        }
+        action = getattr(record, 'ywot_action', None)
+        if action is not None:
+            d['action'] = action
+            d.update(record.ywot_fields)
+        else:
+            d['message'] = record.getMessage()
+        if record.exc_text:
+            d['traceback'] = record.exc_text
+        return simplejson.dumps(d)
 
-filename = settings.LOG_DIRECTORY + '/application.log'
+_logger = None
+_queue = None
+_file_handler = None
+_lock = threading.Lock() # for setting up, and stats
 
-logger = logging.getLogger('default')
-handler = logging.handlers.RotatingFileHandler(filename, maxBytes=10*1024*1024, backupCount=10)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+def _count(state):
+    _lock.acquire()
+    try:
+        stats[state] += 1
+    finally:
+        _lock.release()
 
-logger.setLevel(1) # 0 seems to skip DEBUG messages, contrary to the docs
+def _write(record):
+    try:
+        _file_handler.handle(record)
+        _count('written')
+    except Exception:
+        _file_handler.handleError(record)
 
-debug = logger.debug
-info = logger.info
-warning = logger.warning
-error = logger.error
-critical = logger.critical
-exception = logger.exception
+def _run():
+    while True:
+        _write(_queue.get())
+
+def flush():
+    """Writes whatever is queued, in this thread."""
+    if _queue is None:
+        return
+    while True:
+        try:
+            record = _queue.get_nowait()
+        except Queue.Empty:
+            return
+        _write(record)
+
+def _setup():
+    global _queue, _file_handler
+    _mkdir(settings.LOG_DIRECTORY)
+    filename = os.path.join(settings.LOG_DIRECTORY, 'application.log')
+    _file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=10*1024*1024, backupCount=10)
+    if getattr(settings, 'LOG_FORMAT', 'text') == 'json':
+        _file_handler.setFormatter(JSONFormatter())
+    else:
+        _file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    _queue = Queue.Queue(getattr(settings, 'LOG_QUEUE_SIZE', 10000))
+    writer = threading.Thread(target=_run, name='ywot-log')
+    writer.setDaemon(True)
+    writer.start()
+    atexit.register(flush)
+
+    logger = logging.getLogger('default')
+    logger.addHandler(QueueHandler(_queue))
+    logger.setLevel(1) # 0 seems to skip DEBUG messages, contrary to the docs
+    return logger
+
+def get_logger():
+    global _logger
+    if _logger is None:
+        _lock.acquire()
+        try:
+            if _logger is None:
+                _logger = _setup()
+        finally:
+            _lock.release()
+    return _logger
+
+def _logs_at(level):
+    def log(msg, *args, **kwargs):
+        get_logger().log(level, msg, *args, **kwargs)
+    return log
+
+debug = _logs_at(logging.DEBUG)
+info = _logs_at(logging.INFO)
+warning = _logs_at(logging.WARNING)
+error = _logs_at(logging.ERROR)
+critical = _logs_at(logging.CRITICAL)
+
+def exception(msg, *args):
+    get_logger().exception(msg, *args)
+
+def action(name, fields):
+    """
+    Logs an ACTION event. `fields` is a list of (name, value) pairs; the text
+    format has just the values, in order: "ACTION:PROTECT 12 -3 5".
+    """
+    msg = ' '.join(['ACTION:' + name] + [unicode(value) for key, value in fields])
+    get_logger().info(msg, extra={'ywot_action': name, 'ywot_fields': dict(fields)})
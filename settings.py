@@ -15,6 +15,13 @@ DATABASE_PASSWORD = ''         # Not used with sqlite3.
 DATABASE_HOST = ''             # Set to empty string for localhost. Not used with sqlite3.
 DATABASE_PORT = ''             # Set to empty string for default. Not used with sqlite3.
 
+# For DATABASE_ENGINE = 'yourworld.lib.backends.pooled_postgresql_psycopg2',
+# which keeps connections open between requests. Per worker process.
+DATABASE_POOL_SIZE = 10 # connections, in use or idle; one per thread is plenty
+DATABASE_POOL_TIMEOUT = 10 # seconds to wait for a free one before giving up
+DATABASE_POOL_MAX_AGE = 600 # seconds before a connection is closed and reopened
+DATABASE_POOL_CHECK_AFTER = 30 # idle seconds before a connection is checked with SELECT 1
+
 TIME_ZONE = 'America/Los_Angeles'
 
 LANGUAGE_CODE = 'en-us'
@@ -47,6 +54,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'yourworld.ywot.middleware.MetricsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -72,9 +80,67 @@ DEFAULT_FROM_EMAIL = SERVER_EMAIL = '"Your World of Text" <no-reply@example.com>
 
 # You should change this
 LOG_DIRECTORY = './log/' 
+LOG_FORMAT = 'text' # or 'json', one object per line
+LOG_QUEUE_SIZE = 10000 # records waiting for the log writer before new ones are dropped
 
 ACCOUNT_ACTIVATION_DAYS = 3
 
+# Where the ywot caches live: 'local' (an LRU in each process) or 'shared'
+# (django.core.cache, so set CACHE_BACKEND to e.g. 'memcached://127.0.0.1:11211/')
+YWOT_CACHE_BACKEND = 'local'
+TILE_CACHE_SIZE = 100000 # tiles, per process when local
+TILE_CACHE_REVISION_TIMEOUT = 2 # seconds; how late polls may notice writes made elsewhere
+WORLD_CACHE_SIZE = 10000
+WORLD_CACHE_TIMEOUT = 10 # seconds; how stale another process's world settings can be when local
+PERMISSION_CACHE_SIZE = 10000
+PERMISSION_CACHE_TIMEOUT = 10 # seconds, likewise for whitelist changes
+USERNAME_INDEX_MAX_AGE = 600 # seconds before member autocomplete sees other processes' new users
+
+# The edit journal is written in the background: see ywot/journal.py
+JOURNAL_BATCH_SIZE = 1000
+JOURNAL_FLUSH_INTERVAL = 1.0 # seconds
+JOURNAL_MAX_QUEUE = 100000 # records held in memory before new ones are dropped
+ACTIVITY_FLUSH_INTERVAL = 10 # seconds between writes of the journal's edit activity counts
+EDIT_HISTORY_RETENTION_DAYS = 30 # then `manage.py compact_edit_history` rolls them up by day
+
+# Longest time (seconds) a fetch may be held open waiting for changes. Each
+# waiting viewer holds a worker thread, so size the WSGI thread pool to match
+# before turning this on. 0 means clients poll every second instead.
+LONGPOLL_TIMEOUT = 0
+LONGPOLL_CHECK_INTERVAL = 0.5 # how often waiters look for other processes' writes
+
+# Hold typing in memory and write each dirty tile once per flush instead of
+# once per POST; see ywot/tilebuffer.py. Other processes see buffered edits
+# only once they're flushed.
+TILE_BUFFER = False
+TILE_BUFFER_FLUSH_INTERVAL = 0.25 # seconds
+TILE_BUFFER_MAX_DIRTY = 500 # tiles waiting before a flush starts early
+
+# Per-client, per-world token buckets, kind: (requests per second, burst). Past
+# them, requests get a 429 before any real work; see ywot/ratelimit.py. A
+# client is a signed-in user, or else an ip, which gets RATE_LIMIT_IP_FACTOR
+# times as much since many people can share one.
+RATE_LIMITS = {
+    'fetch': (5, 30),
+    'edit': (2, 10),
+}
+RATE_LIMIT_IP_FACTOR = 5
+RATE_LIMIT_CLIENTS = 100000 # buckets kept per process when local
+PASTE_BATCH_SIZE = 2000 # edits taken per POST on worlds that allow pasting
+
+# Prometheus metrics at /accounts/metrics/, for these addresses (and superusers)
+METRICS_ALLOWED_IPS = ('127.0.0.1',)
+METRICS_MAX_WORLDS = 100 # worlds labelled by name in ywot_world_seconds_total
+# Sample the stacks of every request to these worlds (or a superuser's with
+# ?profile=1) into PROFILE_DIRECTORY (default: LOG_DIRECTORY/profiles)
+PROFILE_WORLDS = ()
+PROFILE_INTERVAL = 0.005 # seconds
+PROFILE_DIRECTORY = None
+
+# A faster JSON module for DictFields, if installed: any module with
+# simplejson-style loads() and dumps(), e.g. 'ujson'. None means simplejson.
+JSON_CODEC = None
+
 try:
     from localsettings import *
 except:
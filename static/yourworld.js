@@ -161,7 +161,20 @@ YourWorld.World = function() {
         canAdmin: false,
 		features: {}, // Enabled features on this world, from: ['go_to_coord', ...]
 		uiModal: false, // Disables world's interaction-capture if true
-		goToCoord: {}
+		goToCoord: {},
+        cursor: null, // world revision our rendered tiles are current as of
+        fetchBounds: null, // bounds that `cursor` applies to
+        etag: null, // server's tag for the state of fetchBounds as of `cursor`
+        pendingBounds: null, // bounds of the fetch in flight
+        longPoll: 0, // seconds the server may hold a fetch open; 0 to poll
+        longPollErrors: 0, // consecutive failures, so we can fall back to polling
+        fetchXhr: null, // the fetch in flight
+        fetchId: 0, // so we can ignore responses to abandoned fetches
+        fetchTimer: null,
+        editBatch: 200, // most edits the server takes per POST
+        maxQueuedEdits: 10000, // pasting waits while this many are unsent
+        sendingEdits: false, // only one POST in flight at a time
+        paste: null // the paste being typed out: {text, pos, lineStart}
     };
     var _ui = {}; // Container for UI elements: paused, announce; `scrolling` for scroll interface
     var _config = null; // generated by init
@@ -281,6 +294,10 @@ YourWorld.World = function() {
         for (var i=0; i<coords.length; i++) {
             getOrCreateTile(coords[i][0], coords[i][1]);
         }
+        if (_state.longPoll && _state.fetchXhr) {
+            // Don't wait for the server to tell us about tiles we aren't showing
+            restartFetch();
+        }
     };
     
     var makeLeftRoom = function(numPx) {
@@ -330,21 +347,57 @@ YourWorld.World = function() {
     // while not visibly moving any content.
     var makeBottomRoom = makeRightRoom;
     
-    var updateData = function(data) {
+    var scheduleFetch = function(delay) {
+        clearTimeout(_state.fetchTimer);
+        _state.fetchTimer = setTimeout(fetchUpdates, delay);
+    };
+
+    var restartFetch = function() {
+        // Abandon the fetch in flight (e.g. a long poll for a stale area) and start over
+        _state.fetchId++;
+        if (_state.fetchXhr) {
+            _state.fetchXhr.abort();
+            _state.fetchXhr = null;
+        }
+        scheduleFetch(0);
+    };
+
+    var updateData = function(data, etag) {
         // Callback for fetchEdits -- gets new tile data from server and renders
-        setTimeout(fetchUpdates, 997);
-        $.each(data, function(YX, properties) {
-            var coords = YX.split(',');
-            var tile = getTile(coords[0], coords[1]);
+        // `data` is null if nothing changed.
+        // A long poll only returns early when there's news, so go right back,
+        // leaving a moment for edits to batch up on busy worlds.
+        _state.fetchXhr = null;
+        _state.longPollErrors = 0;
+        scheduleFetch(_state.longPoll ? 97 : 997);
+        if (!data) {
+            return;
+        }
+        _state.cursor = data.c;
+        _state.etag = etag;
+        _state.fetchBounds = _state.pendingBounds;
+        // data.t lists [tileY, tileX, content, (properties)] for tiles that exist
+        $.each(data.t, function(i, t) {
+            var tile = getTile(t[0], t[1]);
             // We may have cleaned up tiles while the request was made:
             if (tile) {
-                tile.setProperties(properties);
+                tile.setProperties({content: t[2], properties: t[3]});
             }
         });
     };
     
     var updateError = function(xhr) {
-        setTimeout(fetchUpdates, 997); // TODO: 997 shared w/above
+        _state.fetchXhr = null;
+        if (_state.longPoll && (++_state.longPollErrors >= 3)) {
+            // Perhaps a proxy that doesn't like held connections. Poll instead.
+            _state.longPoll = 0;
+        }
+        var delay = 997; // TODO: 997 shared w/above
+        if (xhr.status == 429) {
+            // Rate limited; wait as long as the server asks, on top
+            delay += 1000 * (parseInt(xhr.getResponseHeader('Retry-After'), 10) || 1);
+        }
+        scheduleFetch(delay);
     };
     
     var editsDone = function(editsReceived) {
@@ -354,26 +407,46 @@ YourWorld.World = function() {
         });
     };
     
-    var editsError = function(xhr) {
+    var editsError = function(xhr, edits) {
         if (xhr.status == 403) {
             _state.canWrite = false;
+        } else if (xhr.status == 429) {
+            // Rate limited; send them again with the next batch
+            _edits = edits.concat(_edits);
         }
     };
    
     var sendEdits = function() {
-        // Send local edits to the server
-        if (!_edits.length) {
+        // Send local edits to the server, a batch at a time. The server says
+        // how many of the batch it got to, and we send the rest again, right
+        // after, if there's still a backlog.
+        if (!_edits.length || _state.sendingEdits) {
             return;
         }
+        var edits = _edits.slice(0, _state.editBatch);
+        _edits = _edits.slice(_state.editBatch);
+        _state.sendingEdits = true;
         jQuery.ajax({
             type: 'POST',
             url: window.location.pathname,
-            data: {edits: _edits},
-            success: editsDone,
+            data: {edits: edits, v: 2},
+            success: function(data) {
+                _state.sendingEdits = false;
+                editsDone(data.accepted);
+                if (data.done < edits.length) {
+                    _edits = edits.slice(data.done).concat(_edits);
+                }
+                if (_edits.length) {
+                    setTimeout(sendEdits, 497);
+                }
+            },
             dataType: 'json',
-            error: editsError
+            timeout: 30000,
+            error: function(xhr) {
+                _state.sendingEdits = false;
+                editsError(xhr, edits);
+            }
         });
-        _edits = [];
     };
     
     var fetchUpdates = function() {
@@ -381,12 +454,20 @@ YourWorld.World = function() {
         // Skip if user is inactive for over a minute:
         if ((new Date().getTime() - _state.lastEvent) > 30000) {
             _ui.paused.show();
-            setTimeout(fetchUpdates, 331); // yarg this is getting hacky
+            scheduleFetch(331); // yarg this is getting hacky
             return;
         }
         _ui.paused.hide();
         var bounds = getMandatoryBounds();
-        jQuery.ajax({
+        // Only ask for changes if we already have everything else in view
+        var since = -1;
+        if ((_state.cursor !== null) && _state.fetchBounds && 
+            (bounds.join() == _state.fetchBounds.join())) {
+            since = _state.cursor;
+        }
+        _state.pendingBounds = bounds;
+        var fetchId = ++_state.fetchId;
+        var xhr = _state.fetchXhr = jQuery.ajax({
             type: 'GET',
             url: window.location.pathname,
             data: { fetch: 1, 
@@ -394,11 +475,32 @@ YourWorld.World = function() {
                     min_tileX: bounds[1],
                     max_tileY: bounds[2],
                     max_tileX: bounds[3],
-                    v: 3 // version
+                    since: since,
+                    wait: (since >= 0) ? _state.longPoll : 0,
+                    v: 4 // version
                     },
-            success: updateData,
+            beforeSend: function(xhr) {
+                if ((since >= 0) && _state.etag) {
+                    xhr.setRequestHeader('If-None-Match', _state.etag);
+                }
+            },
+            success: function(data) {
+                if (fetchId == _state.fetchId) {
+                    updateData(data, xhr.getResponseHeader('ETag'));
+                }
+            },
             dataType: 'json',
-            error: updateError
+            error: function(xhr) {
+                if (fetchId != _state.fetchId) {
+                    return;
+                }
+                if (xhr.status == 304) {
+                    // jQuery counts an empty body as a JSON parse error
+                    updateData(null);
+                } else {
+                    updateError(xhr);
+                }
+            }
         });
     };
     
@@ -498,59 +600,89 @@ YourWorld.World = function() {
         });
     };
     
-    var doProtect = function(tile) {
-        var data = {
-            namespace: _state.worldName,
-            tileY: $.data(tile, 'tileY'),
-            tileX: $.data(tile, 'tileX')
+    var pickRange = function(selector, hoverCss, done) {
+        // Lets the user pick a rectangle of `selector` elements (tiles or
+        // cells) by clicking two opposite corners, or one element twice,
+        // then calls done(first, second). Clicking elsewhere cancels.
+        _ui.scrolling.stop();
+        var s1 = YourWorld.helpers.addCss(hoverCss);
+        var s2 = YourWorld.helpers.addCss('.rangeStart, .rangeStart td {background-color: #ccf}');
+        var first = null;
+        var onClick = function(e) {
+            var target = $(e.target).closest(selector).get(0);
+            if (target && !first) {
+                first = target;
+                $(first).addClass('rangeStart');
+                return;
+            }
+            $(_container).unbind('click', onClick);
+            if (first) {
+                $(first).removeClass('rangeStart');
+            }
+            $(s1).remove();
+            $(s2).remove();
+            _ui.scrolling.start();
+            if (target) {
+                done(first, target);
+            }
         };
-        
+        $(_container).bind('click', onClick);
+    };
+
+    var tileRange = function(tile1, tile2) {
+        // The POST fields for the rectangle of tiles with these corners
+        var y1 = $.data(tile1, 'tileY'), y2 = $.data(tile2, 'tileY');
+        var x1 = $.data(tile1, 'tileX'), x2 = $.data(tile2, 'tileX');
+        return {
+            tileY: Math.min(y1, y2),
+            tileX: Math.min(x1, x2),
+            max_tileY: Math.max(y1, y2),
+            max_tileX: Math.max(x1, x2)
+        };
+    };
+
+    var cellRange = function(td1, td2) {
+        // The POST fields for the rectangle of cells with these corners
+        var a = YourWorld.helpers.getCellCoords(td1);
+        var b = YourWorld.helpers.getCellCoords(td2);
+        var aAbove = (a[0] < b[0]) || ((a[0] == b[0]) && (a[2] <= b[2]));
+        var aLeft = (a[1] < b[1]) || ((a[1] == b[1]) && (a[3] <= b[3]));
+        var top = aAbove ? a : b, bottom = aAbove ? b : a;
+        var left = aLeft ? a : b, right = aLeft ? b : a;
+        return {
+            tileY: top[0],
+            charY: top[2],
+            tileX: left[1],
+            charX: left[3],
+            max_tileY: bottom[0],
+            max_charY: bottom[2],
+            max_tileX: right[1],
+            max_charX: right[3]
+        };
+    };
+
+    var doProtect = function(tile1, tile2) {
         jQuery.ajax({
             type: 'POST',
             url: '/ajax/protect/',
-            data: data
+            data: $.extend({namespace: _state.worldName}, tileRange(tile1, tile2))
         });
     };
     
-    var doUnprotect = function(tile) {
-        var data = {
-            namespace: _state.worldName,
-            tileY: $.data(tile, 'tileY'),
-            tileX: $.data(tile, 'tileX')
-        };
-        
+    var doUnprotect = function(tile1, tile2) {
         jQuery.ajax({
             type: 'POST',
             url: '/ajax/unprotect/',
-            data: data
+            data: $.extend({namespace: _state.worldName}, tileRange(tile1, tile2))
         });
     };
 
     var protectATile = function() {
-        _ui.scrolling.stop();
-		var s1 = YourWorld.helpers.addCss('.tilecont:hover {background-color: #e5e5ff; cursor:pointer}');
-        $(_container).one('click', function(e) {
-			var target = $(e.target).closest('.tilecont').get(0);
-			if (target) {
-				doProtect(target);
-			}
-			$(s1).remove();
-            _ui.scrolling.start();
-        });
+        pickRange('.tilecont', '.tilecont:hover {background-color: #e5e5ff; cursor:pointer}', doProtect);
     };
  
     var unprotectATile = function() {
-        // TODO: factor out w/protectATile
-        _ui.scrolling.stop();
-		var s1 = YourWorld.helpers.addCss('.tilecont:hover {background-color: #fff; cursor:pointer}');
-        $(_container).one('click', function(e) {
-			var target = $(e.target).closest('.tilecont').get(0);
-			if (target) {
-				doUnprotect(target);
-			}
-			$(s1).remove();
-            _ui.scrolling.start();
-        });
+        pickRange('.tilecont', '.tilecont:hover {background-color: #fff; cursor:pointer}', doUnprotect);
     };
 
 	var doGoToCoord = function(y, x) {
@@ -665,90 +797,47 @@ YourWorld.World = function() {
 		getCoordInput('Go to coordinates:', doGoToCoord);
 	};
 
-	var sendCoordLink = function(td, y, x) {
-		var YX_yx = YourWorld.helpers.getCellCoords(td);
-        var data = {
-            namespace: _state.worldName,
-            tileY: YX_yx[0],
-            tileX: YX_yx[1],
-            charY: YX_yx[2],
-            charX: YX_yx[3],
-			link_tileY: y,
-			link_tileX: x
-
-        };
+	var sendCoordLink = function(td1, td2, y, x) {
         jQuery.ajax({
             type: 'POST',
             url: '/ajax/coordlink/',
-            data: data
+            data: $.extend({namespace: _state.worldName, link_tileY: y, link_tileX: x},
+                           cellRange(td1, td2))
         });
 	};
 
-
-	var doCoordLink = function(y, x) {
-		// TODO: factor out with protect+unprotect
-        _ui.scrolling.stop();
-		var s1 = YourWorld.helpers.addCss('td:hover {background-color: #aaf; cursor:pointer}');
+	var pickCells = function(done) {
+		// pickRange for cells; only the owner may link on protected tiles
+		var css = 'td:hover {background-color: #aaf; cursor:pointer}';
 		if (!_state.canAdmin) {
-			var s2 = YourWorld.helpers.addCss('.protected td:hover {background-color: inherit; cursor:inherit}');
+			css += ' .protected td:hover {background-color: inherit; cursor:inherit}';
 		}
-        $(_container).one('click', function(e) {
-			var target = $(e.target).closest('td').get(0);
-			if (target) {
-				sendCoordLink(target, y, x);
-			}
-			$(s1).remove();
-			if (!_state.canAdmin) {
-				$(s2).remove();
-			}
-            _ui.scrolling.start();
-        });
+		pickRange('td', css, done);
 	};
 
-	var sendUrlLink = function(td, url) {
-		var YX_yx = YourWorld.helpers.getCellCoords(td);
-        var data = {
-            namespace: _state.worldName,
-            tileY: YX_yx[0],
-            tileX: YX_yx[1],
-            charY: YX_yx[2],
-            charX: YX_yx[3],
-			url: url
+	var doCoordLink = function(y, x) {
+		pickCells(function(td1, td2) {
+			sendCoordLink(td1, td2, y, x);
+		});
+	};
 
-        };
+	var sendUrlLink = function(td1, td2, url) {
         jQuery.ajax({
             type: 'POST',
             url: '/ajax/urllink/',
-            data: data
+            data: $.extend({namespace: _state.worldName, url: url}, cellRange(td1, td2))
         });
 	};
 
-
 	var doUrlLink = function(url) {
-		// TODO: factor out with doCoordLink
-        _ui.scrolling.stop();
-		var s1 = YourWorld.helpers.addCss('td:hover {background-color: #aaf; cursor:pointer}');
-		if (!_state.canAdmin) {
-			var s2 = YourWorld.helpers.addCss('.protected td:hover {background-color: inherit; cursor:inherit}');
-		}
-        $(_container).one('click', function(e) {
-			var target = $(e.target).closest('td').get(0);
-			if (target) {
-				sendUrlLink(target, url);
-			}
-			$(s1).remove();
-			if (!_state.canAdmin) {
-				$(s2).remove();
-			}
-            _ui.scrolling.start();
-        });
+		pickCells(function(td1, td2) {
+			sendUrlLink(td1, td2, url);
+		});
 	};
 
-
-
 	var coordLink = function() {
 		// Called when clicking on menu item to create link to coordinates
-		getCoordInput('Enter the coordinates to create a link to. You can then click on a letter to create the link.', doCoordLink);
+		getCoordInput('Enter the coordinates to create a link to. You can then click on the first and last letters to link.', doCoordLink);
 	};
 
 	var urlLink = function() {
@@ -762,7 +851,7 @@ YourWorld.World = function() {
 			d = document.createElement('div');
 			var html = [];
 			html.push('<form method="get" action="#" id="url_input_form">');
-			html.push('<div id="url_input_title" style="max-width:20em"></div><br>');
+			html.push('<div id="url_input_title" style="max-width:20em">Enter a URL. You can then click on the first and last letters to link.</div><br>');
 			html.push('<label for="url_input">URL: </label><input type="text" name="url_input" value="">');
 			html.push('<div id="url_input_submit"><input type="submit" value="   Go   "> or <span id="url_input_cancel" class="simplemodal-close simplemodal-closelink">cancel</span></div>');
 			html.push('</form>');
@@ -888,6 +977,32 @@ YourWorld.World = function() {
         queueEdit([tileY, tileX, charY, charX, timestamp, s]);
     };
     
+    var pasteText = function(text) {
+        // Types out pasted text from the cursor, starting each line under the first
+        _state.paste = {text: text.replace(/\r\n?/g, '\n'), pos: 0, lineStart: _state.selected};
+        continuePaste();
+    };
+
+    var continuePaste = function() {
+        // Types as much of the paste as the send queue has room for
+        var paste = _state.paste;
+        if (!paste) {
+            return;
+        }
+        while ((paste.pos < paste.text.length) && (_edits.length < _state.maxQueuedEdits)) {
+            var c = paste.text.charAt(paste.pos++);
+            if (c == '\n') {
+                paste.lineStart = moveCursor('down', paste.lineStart);
+            } else {
+                typeChar(c);
+                moveCursor('right');
+            }
+        }
+        if (paste.pos >= paste.text.length) {
+            _state.paste = null;
+        }
+    };
+
     var queueEdit = function (arr) {
         // Record a local edit to be transmitted to server
         // arr is [tileY, tileX, charY, charX, timestamp, char]
@@ -946,18 +1061,25 @@ YourWorld.World = function() {
         // Also record that the user is active
         // Also capture ENTER
         // Also capture arrow keys
-        var input = document.createElement('input');
-        input.type = 'text';
+        // (A textarea where pasting is allowed, so that pastes keep their newlines)
+        var input = document.createElement(_state.features.paste ? 'textarea' : 'input');
+        if (!_state.features.paste) {
+            input.type = 'text';
+        }
         input.style.position = 'absolute';
         input.style.left = '-1000px';
         input.style.top = '-1000px';
         document.body.appendChild(input);
         setInterval(function() {
-            if (input.value) {
+            if (_state.features.paste && (input.value.length > 1)) {
+                pasteText(input.value);
+            } else if (input.value && (input.value.charAt(0) != '\n')) {
+                // (ENTER is handled on keydown)
                 typeChar(input.value.charAt(0));
                 moveCursor('right');
             }
-            input.value = ''; // prevent paste
+            input.value = ''; // prevent paste, where it isn't allowed
+            continuePaste();
         }, 10);
         input.focus();
         $(document).keydown(function(e) {
@@ -994,6 +1116,7 @@ YourWorld.World = function() {
         
         // Capture clicks to set the cursor location
         _container.click(function(ev) {
+           _state.paste = null; // clicking elsewhere stops a paste
            setSelected(ev.target);
            _state.lastClick = ev.target;
         });
@@ -19,6 +19,12 @@ urlpatterns = patterns('yourworld.ywot.views',
     url(r'^accounts/configure/(.*)/$', 'configure', name='configure'),
     url(r'^accounts/configure/(beta/\w+)/$', 'configure', name='configure'),
     url(r'^accounts/member_autocomplete/$', 'member_autocomplete'),
+    url(r'^accounts/history/(.*)/$', 'edit_history', name='edit_history'),
+    url(r'^accounts/export/(.*)/$', 'export_world', name='export_world'),
+    url(r'^accounts/stats/$', 'server_stats', name='server_stats'),
+    url(r'^accounts/activity/$', 'edit_activity', name='site_activity'),
+    url(r'^accounts/activity/(.*)/$', 'edit_activity', name='edit_activity'),
+    url(r'^accounts/metrics/$', 'metrics_text', name='metrics'),
     
     (r'^accounts/', include('registration.urls')),
     
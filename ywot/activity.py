@@ -0,0 +1,267 @@
+"""
+Edit activity by hour and by day, per world and for the whole site
+(EditActivity), so that a year's graph reads a few hundred rows instead of
+the edit log.
+
+ywot.journal calls `record` with every batch it has written, which only
+adds the batch to counts kept in memory. The journal's thread writes them
+with `maybe_flush`, every ACTIVITY_FLUSH_INTERVAL seconds, in a transaction
+of its own, so each process takes the busy rows' locks (the whole site's
+above all) once per flush rather than once per batch. If that fails, the
+counts are kept for the next flush. Distinct editors and ips are counted with
+EditActivityMembers, one per person already counted in a period; they're
+pruned once their period is more than MEMBER_DAYS old, since it won't get
+edits any more.
+
+`rebuild_day` recounts whole days from the edit history: EditRecords, the old
+Edit rows, and compacted EditSummaries. These only say which day, so the
+hourly rows of compacted days are left as they were. See the
+rollup_edit_activity command. Recounting today can count edits journaled in
+the last ACTIVITY_FLUSH_INTERVAL seconds twice.
+"""
+
+import datetime, re, threading, time
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+
+from yourworld.lib import log
+from yourworld.ywot.models import (Edit, EditActivity, EditActivityMember, EditRecord,
+                                   EditSummary, insert_rows)
+
+SITE = 0 # scope of the whole site's rows
+MEMBER_DAYS = 2
+PRUNE_INTERVAL = 3600 # seconds between prunes by each process
+# Members are looked up this many at a time
+MEMBER_CHUNK = 500
+FLUSH_INTERVAL = getattr(settings, 'ACTIVITY_FLUSH_INTERVAL', 10)
+
+stats = {
+    'flushes': 0,
+    'failed': 0, # flushes lost to a database error, and retried
+}
+
+_last_prune = 0
+_counts_lock = threading.Lock() # for _pending
+_pending = {} # counts not yet written, as made by _count
+_last_flush = 0
+
+def period_start(period, t):
+    if period == 'hour':
+        return t.replace(minute=0, second=0, microsecond=0)
+    return datetime.datetime.combine(t.date(), datetime.time())
+
+def _merge(counts, more):
+    for key, (edits, who) in more.iteritems():
+        c = counts.setdefault(key, [0, set()])
+        c[0] += edits
+        c[1].update(who)
+
+def _count(counts, world_id, user_id, ip, t, n=1):
+    """Adds `n` edits by user_id or ip at `t` to `counts`, by (scope, period, start)."""
+    who = []
+    if user_id is not None:
+        who.append('u%d' % user_id)
+    if ip:
+        who.append('i%s' % ip)
+    for scope in (world_id, SITE):
+        for period in EditActivity.PERIODS:
+            key = (scope, period, period_start(period, t))
+            c = counts.get(key)
+            if c is None:
+                c = counts[key] = [0, set()]
+            c[0] += n
+            c[1].update(who)
+
+def _lock(scope, period, start):
+    qs = EditActivity.objects.filter(scope=scope, period=period, start=start)
+    if 'sqlite' not in connection.settings_dict['ENGINE']:
+        sql, params = qs.query.get_compiler(qs.db).as_sql()
+        qs = EditActivity.objects.raw(sql + ' FOR UPDATE', params)
+    found = list(qs)
+    return found and found[0] or None
+
+def _get_locked(scope, period, start):
+    """The row for the period, locked FOR UPDATE and created if need be."""
+    row = _lock(scope, period, start)
+    if row is not None:
+        return row
+    row = EditActivity(scope=scope, period=period, start=start)
+    sid = transaction.savepoint()
+    try:
+        row.save(force_insert=True)
+        transaction.savepoint_commit(sid)
+        return row
+    except IntegrityError:
+        # Somebody else created it first
+        transaction.savepoint_rollback(sid)
+        return _lock(scope, period, start)
+
+def _new_members(scope, period, start, who):
+    """Adds the people in `who` not yet counted in the period. Returns them."""
+    who = sorted(who)
+    seen = set()
+    members = EditActivityMember.objects.filter(scope=scope, period=period, start=start)
+    for i in xrange(0, len(who), MEMBER_CHUNK):
+        seen.update(members.filter(who__in=who[i:i + MEMBER_CHUNK]).values_list('who', flat=True))
+    new = [w for w in who if w not in seen]
+    if new:
+        to_db = connection.ops.value_to_db_datetime(start)
+        insert_rows(EditActivityMember, ['scope', 'period', 'start', 'who'],
+                    [(scope, period, to_db, w) for w in new])
+    return new
+
+def _add(counts):
+    # In a fixed order, so that writers in different processes can't deadlock.
+    # The row lock also keeps them from counting the same person twice.
+    for key in sorted(counts):
+        edits, who = counts[key]
+        row = _get_locked(*key)
+        new = _new_members(row.scope, row.period, row.start, who)
+        row.edits += edits
+        row.editors += len([w for w in new if w[0] == 'u'])
+        row.ips += len([w for w in new if w[0] == 'i'])
+        row.save()
+
+def record(rows):
+    """
+    Counts journal rows, (world_id, tileY, tileX, charY, charX, char, user_id,
+    ip, time) tuples as in EditRecordManager.FIELDS, once they're written.
+    The counts are written by the next flush.
+    """
+    _counts_lock.acquire()
+    try:
+        for row in rows:
+            _count(_pending, row[0], row[6], row[7], row[8])
+    finally:
+        _counts_lock.release()
+
+@transaction.commit_on_success
+def _write(counts):
+    _add(counts)
+    _maybe_prune()
+
+def flush():
+    """Writes the counts recorded so far, in this thread."""
+    global _pending, _last_flush
+    _counts_lock.acquire()
+    try:
+        counts, _pending = _pending, {}
+        _last_flush = time.time()
+    finally:
+        _counts_lock.release()
+    if not counts:
+        return
+    try:
+        _write(counts)
+    except Exception:
+        _counts_lock.acquire()
+        try:
+            stats['failed'] += 1
+            _merge(_pending, counts)
+        finally:
+            _counts_lock.release()
+        log.exception('Could not write edit activity; will try again')
+        connection.close() # reconnect next time
+        return
+    _counts_lock.acquire()
+    try:
+        stats['flushes'] += 1
+    finally:
+        _counts_lock.release()
+
+def maybe_flush():
+    """Flushes if it's been FLUSH_INTERVAL seconds since the last time."""
+    if time.time() - _last_flush >= FLUSH_INTERVAL:
+        flush()
+
+def _maybe_prune():
+    global _last_prune
+    if time.time() - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = time.time()
+    prune()
+
+def _delete(model, start, end, period=None):
+    # A plain DELETE, rather than QuerySet.delete() loading every row first
+    qn = connection.ops.quote_name
+    to_db = connection.ops.value_to_db_datetime
+    sql = 'DELETE FROM %s WHERE %s >= %%s AND %s < %%s' % (
+        qn(model._meta.db_table), qn('start'), qn('start'))
+    params = [to_db(start), to_db(end)]
+    if period is not None:
+        sql += ' AND %s = %%s' % qn('period')
+        params.append(period)
+    connection.cursor().execute(sql, params)
+    transaction.set_dirty()
+
+def prune():
+    """Deletes the EditActivityMembers that can no longer be needed. Call this inside a transaction."""
+    before = period_start('day', datetime.datetime.now() - datetime.timedelta(days=MEMBER_DAYS))
+    _delete(EditActivityMember, datetime.datetime.min, before)
+
+# Edit.content is the repr() of the edits' lists of strings; each starts with tileY
+_OLD_EDIT = re.compile(r"\[u?'-?\d")
+
+def _count_day(day):
+    start = datetime.datetime.combine(day, datetime.time())
+    end = start + datetime.timedelta(days=1)
+    counts = {}
+    for world_id, user_id, ip, t in (EditRecord.objects.filter(time__gte=start, time__lt=end)
+                                     .order_by().values_list('world', 'user', 'ip', 'time')
+                                     .iterator()):
+        _count(counts, world_id, user_id, ip, t)
+    for world_id, user_id, ip, t, content in (Edit.objects.filter(time__gte=start, time__lt=end)
+                                              .order_by()
+                                              .values_list('world', 'user', 'ip', 'time', 'content')
+                                              .iterator()):
+        _count(counts, world_id, user_id, ip, t, len(_OLD_EDIT.findall(content)))
+    # Compacted history only says which day
+    summaries = {}
+    for world_id, user_id, ip, n in (EditSummary.objects.filter(day=day).order_by()
+                                     .values_list('world', 'user', 'ip', 'edits').iterator()):
+        _count(summaries, world_id, user_id, ip, start, n)
+    for key, (edits, who) in summaries.iteritems():
+        if key[1] == 'day':
+            c = counts.setdefault(key, [0, set()])
+            c[0] += edits
+            c[1].update(who)
+    return counts
+
+@transaction.commit_on_success
+def rebuild_day(day):
+    """
+    Replaces the EditActivity of the date `day` with a recount from history;
+    only the daily rows, if the day has been compacted. Returns how many
+    edits it found.
+    """
+    start = datetime.datetime.combine(day, datetime.time())
+    end = start + datetime.timedelta(days=1)
+    # Compacted history can't say which hour, so keep what the journal counted
+    period = EditSummary.objects.filter(day=day).exists() and 'day' or None
+    _delete(EditActivity, start, end, period)
+    _delete(EditActivityMember, start, end, period)
+    counts = _count_day(day)
+    if period is not None:
+        counts = dict((key, c) for key, c in counts.iteritems() if key[1] == period)
+    _add(counts)
+    return counts.get((SITE, 'day', start), [0])[0]
+
+def oldest_day():
+    """The first day with any edit history, or None."""
+    days = []
+    for model, field in ((EditRecord, 'time'), (Edit, 'time'), (EditSummary, 'day')):
+        first = model.objects.order_by(field).values_list(field, flat=True)[:1]
+        if first:
+            days.append(isinstance(first[0], datetime.datetime) and first[0].date() or first[0])
+    return days and min(days) or None
+
+def get(scope, period, start, end):
+    """
+    {start: (edits, editors, ips)} for the periods with edits, from the one
+    containing the datetime `start` up to the one containing `end`.
+    """
+    rows = EditActivity.objects.filter(scope=scope, period=period,
+                                       start__gte=period_start(period, start),
+                                       start__lte=period_start(period, end))
+    return dict((row.start, (row.edits, row.editors, row.ips)) for row in rows)
@@ -0,0 +1,176 @@
+"""
+A load test of the poll and edit paths, shaped like yourworld.js traffic:
+every client fetches its viewport once a second (with the cursor and ETag of
+its last fetch, as the client does), and typists also send what they typed
+every two seconds. Time is simulated in rounds of one second, with the
+requests of a round made back to back through the Django test client, so
+the numbers are per-request costs rather than a measure of concurrency.
+
+Viewers and typists sit on overlapping viewports (around the origin) or
+disjoint ones (far apart), or half and half. Besides the two views, the
+world lookup and the permission checks they start with are timed on their
+own. See the benchmark command, which runs this on a scratch database.
+"""
+
+import copy, random, time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import connection
+from django.test.client import Client
+from django.utils import simplejson
+
+from yourworld.ywot import permissions, ratelimit
+from yourworld.ywot.models import Tile, World, Whitelist
+
+WORLD = 'benchmark'
+TYPING_RATE = 5 # characters a second
+SEND_INTERVAL = 2 # rounds between sends
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[int(round(p * (len(samples) - 1)))]
+
+class Timings(object):
+    """Latencies and query counts of one operation."""
+
+    def __init__(self):
+        self.seconds = []
+        self.queries = []
+        self.query_seconds = []
+
+    def add(self, seconds, queries):
+        self.seconds.append(seconds)
+        self.queries.append(len(queries))
+        self.query_seconds.append(sum([float(q['time']) for q in queries]))
+
+    def report(self):
+        n = len(self.seconds)
+        total = sum(self.seconds)
+        ms = lambda s: round(s * 1000, 3) if s is not None else None
+        return {
+            'requests': n,
+            'throughput': round(n / total, 1) if total else None, # per second, one at a time
+            'p50_ms': ms(percentile(self.seconds, .5)),
+            'p95_ms': ms(percentile(self.seconds, .95)),
+            'p99_ms': ms(percentile(self.seconds, .99)),
+            'queries_per_request': round(float(sum(self.queries)) / n, 2) if n else None,
+            'db_ms_per_request': ms(sum(self.query_seconds) / n) if n else None,
+        }
+
+class _Client(object):
+    def __init__(self, number, bounds):
+        self.ip = '10.%d.%d.%d' % (number >> 16 & 255, number >> 8 & 255, number & 255)
+        self.bounds = bounds
+        self.cursor = -1
+        self.etag = None
+        self.client = Client(REMOTE_ADDR=self.ip)
+
+def _viewport(number, layout, rows, cols):
+    if layout == 'disjoint' or (layout == 'mixed' and number % 2):
+        top, left = number * 1000, number * 1000
+    else:
+        top, left = random.randint(-2, 2), random.randint(-2, 2)
+    return [top, left, top + rows - 1, left + cols - 1]
+
+def _timed(timings, f, *args, **kwargs):
+    before = len(connection.queries)
+    start = time.time()
+    result = f(*args, **kwargs)
+    timings.add(time.time() - start, connection.queries[before:])
+    return result
+
+def _request(timings, f, *args, **kwargs):
+    # The test client resets connection.queries as each request starts
+    start = time.time()
+    response = f(*args, **kwargs)
+    timings.add(time.time() - start, connection.queries)
+    return response
+
+def _fetch(timings, c):
+    params = {'fetch': 1, 'since': c.cursor, 'wait': 0, 'v': 4}
+    params.update(zip(['min_tileY', 'min_tileX', 'max_tileY', 'max_tileX'], c.bounds))
+    headers = {}
+    if c.cursor >= 0 and c.etag:
+        headers['HTTP_IF_NONE_MATCH'] = c.etag
+    response = _request(timings, c.client.get, '/' + WORLD, params, **headers)
+    if response.status_code == 200:
+        c.cursor = simplejson.loads(response.content)['c']
+        c.etag = response.get('ETag', None)
+    return response.status_code
+
+def _send(timings, c, number):
+    edits = []
+    top, left = c.bounds[:2]
+    for i in xrange(TYPING_RATE * SEND_INTERVAL):
+        pos = number * TYPING_RATE * SEND_INTERVAL + i
+        charX = pos % (Tile.COLS * 4)
+        charY = pos // (Tile.COLS * 4) % Tile.ROWS
+        edits.append('%d,%d,%d,%d,%d,%s' % (top, left + charX // Tile.COLS, charY,
+                                             charX % Tile.COLS, int(time.time() * 1000),
+                                             random.choice('abcdefghijklmnopqrstuvwxyz ')))
+    response = _request(timings, c.client.post, '/' + WORLD, {'edits': edits, 'v': '2'})
+    return response.status_code
+
+def _setup():
+    world, _ = World.get_or_create(WORLD)
+    world.public_readable = world.public_writable = True
+    world.owner, _ = User.objects.get_or_create(username='benchmark_owner')
+    world.save()
+    member, _ = User.objects.get_or_create(username='benchmark_member')
+    Whitelist.objects.get_or_create(world=world, user=member)
+    return world, world.owner, member
+
+def run(viewers=20, typists=5, rounds=30, layout='mixed', viewport=(8, 10), rate_limit=False):
+    """
+    Runs the simulation against the configured database, and returns the
+    results as a dict ready for JSON.
+    """
+    saved_debug, saved_limits = settings.DEBUG, ratelimit.RATE_LIMITS
+    settings.DEBUG = True # so connection.queries is kept
+    if not rate_limit:
+        ratelimit.RATE_LIMITS = {}
+    try:
+        world, owner, member = _setup()
+        clients = [_Client(i, _viewport(i, layout, *viewport)) for i in xrange(viewers + typists)]
+        typing = clients[viewers:]
+        timings = dict((name, Timings()) for name in
+                       ['fetch_updates', 'send_edits', 'World.get_or_create',
+                        'permissions.can_read', 'permissions.can_write', 'permissions.can_admin'])
+        statuses = {}
+        start = time.time()
+        for second in xrange(rounds):
+            for c in clients:
+                status = _fetch(timings['fetch_updates'], c)
+                statuses[status] = statuses.get(status, 0) + 1
+            if second % SEND_INTERVAL == 0:
+                for c in typing:
+                    status = _send(timings['send_edits'], c, second // SEND_INTERVAL)
+                    statuses[status] = statuses.get(status, 0) + 1
+            for c in clients:
+                _timed(timings['World.get_or_create'], World.get_or_create, WORLD)
+            # Every request brings a fresh user object, without our memos
+            for user in [AnonymousUser(), owner, member]:
+                for check in ['can_read', 'can_write', 'can_admin']:
+                    _timed(timings['permissions.' + check], getattr(permissions, check),
+                           copy.copy(user), world)
+        elapsed = time.time() - start
+    finally:
+        settings.DEBUG, ratelimit.RATE_LIMITS = saved_debug, saved_limits
+    return {
+        'config': {
+            'viewers': viewers,
+            'typists': typists,
+            'rounds': rounds,
+            'layout': layout,
+            'viewport': list(viewport),
+            'rate_limit': rate_limit,
+            'database': connection.settings_dict['ENGINE'],
+            'cache_backend': getattr(settings, 'YWOT_CACHE_BACKEND', 'local'),
+        },
+        'elapsed_s': round(elapsed, 3),
+        'statuses': dict((str(k), v) for k, v in statuses.iteritems()),
+        'results': dict((name, t.report()) for name, t in timings.iteritems()),
+    }
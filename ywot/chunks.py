@@ -0,0 +1,184 @@
+"""
+The chunked tile layout: a world's tiles kept TileChunk.SIZE x TileChunk.SIZE
+to a row, so that a screenful of tiles is a handful of rows to read or write
+rather than a couple of hundred. Meant for big, busy worlds; a world is moved
+to it (and back) with the chunk_world command, and WorldRevision.chunked says
+which layout it's in.
+
+Tiles come out of here as ordinary (unsaved) Tile objects, so nothing above
+tilestore, tilecache and export needs to know about chunks. Writers to a
+world are already serialized by its revision row (see tilestore), which is
+also what makes it safe to take the layout from the database each time.
+"""
+
+from django.db import connection, transaction
+from django.db.models import Min, Q
+
+from yourworld.ywot.models import Tile, TileChunk, WorldRevision
+
+SIZE = TileChunk.SIZE
+
+def is_chunked(world):
+    return WorldRevision.objects.filter(world=world, chunked=True).exists()
+
+def lock_layout(world):
+    """
+    Whether the world is chunked, read with its WorldRevision row locked FOR
+    UPDATE, or None if it has no row yet (and so isn't). Call this inside a
+    transaction.
+    """
+    qs = WorldRevision.objects.filter(world=world)
+    if 'sqlite' not in connection.settings_dict['ENGINE']:
+        sql, params = qs.query.get_compiler(qs.db).as_sql()
+        qs = WorldRevision.objects.raw(sql + ' FOR UPDATE', params)
+    found = list(qs)
+    if not found:
+        return None
+    return found[0].chunked
+
+def chunk_of(tileY, tileX):
+    return tileY // SIZE, tileX // SIZE
+
+def _key(tileY, tileX):
+    return '%d,%d' % (tileY, tileX)
+
+def _tile(chunk, tileY, tileX, data=None):
+    tile = Tile(world_id=chunk.world_id, tileY=tileY, tileX=tileX)
+    if data is not None:
+        tile.content, tile.properties, tile.revision = data
+    tile._chunk = chunk
+    return tile
+
+def _tiles_of(chunk):
+    for key, data in chunk.tiles.iteritems():
+        tileY, tileX = map(int, key.split(','))
+        yield tileY, tileX, data
+
+def tiles_in(world, min_tileY, min_tileX, max_tileY, max_tileX, since=-1):
+    """
+    Yields the Tiles in the (inclusive) rectangle written after revision
+    `since`, reading only the chunks that cover it.
+    """
+    min_chunkY, min_chunkX = chunk_of(min_tileY, min_tileX)
+    max_chunkY, max_chunkX = chunk_of(max_tileY, max_tileX)
+    chunks = TileChunk.objects.filter(world=world,
+                                      chunkY__gte=min_chunkY, chunkY__lte=max_chunkY,
+                                      chunkX__gte=min_chunkX, chunkX__lte=max_chunkX)
+    if since >= 0:
+        chunks = chunks.filter(revision__gt=since)
+    for chunk in chunks:
+        for tileY, tileX, data in _tiles_of(chunk):
+            if (min_tileY <= tileY <= max_tileY and min_tileX <= tileX <= max_tileX
+                and data[2] > since):
+                yield _tile(chunk, tileY, tileX, data)
+
+def lock_many(world, coords):
+    """
+    TileManager.lock_many for a chunked world: loads the chunks covering
+    `coords`, and returns {(tileY, tileX): Tile}. Call this inside the
+    transaction, and after taking the world's next revision.
+    """
+    coords = set((int(tileY), int(tileX)) for tileY, tileX in coords)
+    wanted = sorted(set(chunk_of(tileY, tileX) for tileY, tileX in coords))
+    chunks = {}
+    for i in xrange(0, len(wanted), Tile.objects.LOCK_CHUNK):
+        q = Q()
+        for chunkY, chunkX in wanted[i:i + Tile.objects.LOCK_CHUNK]:
+            q |= Q(chunkY=chunkY, chunkX=chunkX)
+        for chunk in TileChunk.objects.filter(world=world).filter(q):
+            chunks[(chunk.chunkY, chunk.chunkX)] = chunk
+    for chunkY, chunkX in wanted:
+        if (chunkY, chunkX) not in chunks:
+            chunks[(chunkY, chunkX)] = TileChunk(world=world, chunkY=chunkY, chunkX=chunkX)
+    tiles = {}
+    for tileY, tileX in coords:
+        chunk = chunks[chunk_of(tileY, tileX)]
+        tiles[(tileY, tileX)] = _tile(chunk, tileY, tileX, chunk.tiles.get(_key(tileY, tileX)))
+    return tiles
+
+def bulk_save(tiles):
+    """TileManager.bulk_save for Tiles from lock_many: saves each chunk they're in once."""
+    chunks = {}
+    for t in tiles:
+        t.flush_content()
+        chunk = t._chunk
+        chunk.tiles[_key(t.tileY, t.tileX)] = [t.content, t.properties, t.revision]
+        chunk.revision = max(chunk.revision, t.revision)
+        chunks[id(chunk)] = chunk
+    for chunk in chunks.itervalues():
+        chunk.save()
+
+def iter_tiles(world, bbox=None):
+    """export.iter_tiles for a chunked world: one row of chunks at a time."""
+    chunks = TileChunk.objects.filter(world=world)
+    if bbox is not None:
+        min_tileY, min_tileX, max_tileY, max_tileX = bbox
+        min_chunkY, min_chunkX = chunk_of(min_tileY, min_tileX)
+        max_chunkY, max_chunkX = chunk_of(max_tileY, max_tileX)
+        chunks = chunks.filter(chunkY__gte=min_chunkY, chunkY__lte=max_chunkY,
+                               chunkX__gte=min_chunkX, chunkX__lte=max_chunkX)
+    rows = chunks.order_by('chunkY').values_list('chunkY', flat=True).distinct()
+    for chunkY in list(rows):
+        band = []
+        for chunk in chunks.filter(chunkY=chunkY):
+            for tileY, tileX, data in _tiles_of(chunk):
+                if bbox is None or (min_tileY <= tileY <= max_tileY and
+                                    min_tileX <= tileX <= max_tileX):
+                    band.append(_tile(chunk, tileY, tileX, data))
+        band.sort(key=lambda t: (t.tileY, t.tileX))
+        for tile in band:
+            yield tile
+
+def min_tileX(world):
+    """The leftmost tileX in a chunked world, or None if it's empty."""
+    chunkX = TileChunk.objects.filter(world=world).aggregate(Min('chunkX'))['chunkX__min']
+    if chunkX is None:
+        return None
+    return min([tileX for chunk in TileChunk.objects.filter(world=world, chunkX=chunkX)
+                for tileY, tileX, data in _tiles_of(chunk)])
+
+def _delete_all(model, world):
+    qn = connection.ops.quote_name
+    connection.cursor().execute('DELETE FROM %s WHERE %s = %%s' % (
+        qn(model._meta.db_table), qn(model._meta.get_field('world').column)), [world.id])
+    transaction.set_dirty()
+
+@transaction.commit_on_success
+def convert(world):
+    """
+    Moves a world's tiles into chunks, in one transaction, keeping their
+    revisions (so cached copies stay good). Returns how many tiles moved.
+    """
+    from yourworld.ywot import export
+    world.next_revision() # holds off writers until we commit
+    moved = 0
+    chunks = {}
+    band = []
+    for tile in export.iter_tiles(world):
+        if band and tile.tileY // SIZE != band[-1].tileY // SIZE:
+            bulk_save(band)
+            band = []
+            chunks = {}
+        coords = chunk_of(tile.tileY, tile.tileX)
+        if coords not in chunks:
+            chunks[coords] = TileChunk(world=world, chunkY=coords[0], chunkX=coords[1])
+        tile._chunk = chunks[coords]
+        band.append(tile)
+        moved += 1
+    bulk_save(band)
+    _delete_all(Tile, world)
+    WorldRevision.objects.filter(world=world).update(chunked=True)
+    return moved
+
+@transaction.commit_on_success
+def revert(world):
+    """Moves a chunked world's tiles back into the tile table. Returns how many moved."""
+    world.next_revision()
+    moved = 0
+    for chunk in TileChunk.objects.filter(world=world).iterator():
+        tiles = [_tile(chunk, tileY, tileX, data) for tileY, tileX, data in _tiles_of(chunk)]
+        Tile.objects.bulk_save(tiles)
+        moved += len(tiles)
+    _delete_all(TileChunk, world)
+    WorldRevision.objects.filter(world=world).update(chunked=False)
+    return moved
@@ -0,0 +1,112 @@
+"""
+Who has edited each world (WorldEditors), kept up to date as edits are
+journaled, so that claim() reads one row instead of the world's history.
+
+ywot.journal calls `record` with every batch it writes, in a transaction of
+its own once the batch is in; if that fails, it has the worlds counted from
+history again. Worlds edited before WorldEditors existed are counted from
+their history once, by the backfill_world_editors command or by the first
+`get`.
+"""
+
+import datetime
+
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Max, Min
+
+from yourworld.ywot.models import Edit, EditRecord, EditSummary, WorldEditors
+
+def _lock(world_id):
+    """The world's WorldEditors, locked FOR UPDATE, or None. Call this inside a transaction."""
+    qs = WorldEditors.objects.filter(world=world_id)
+    if 'sqlite' not in connection.settings_dict['ENGINE']:
+        sql, params = qs.query.get_compiler(qs.db).as_sql()
+        qs = WorldEditors.objects.raw(sql + ' FOR UPDATE', params)
+    found = list(qs)
+    return found and found[0] or None
+
+def _add(world_id, user_ids, anonymous, first_edit, last_edit, backfilled=False):
+    """Merges into the world's WorldEditors, creating it if need be. Call this inside a transaction."""
+    summary = _lock(world_id)
+    if summary is None:
+        summary = WorldEditors(world_id=world_id, backfilled=backfilled)
+        summary.add(user_ids, anonymous, first_edit, last_edit)
+        sid = transaction.savepoint()
+        try:
+            summary.save(force_insert=True)
+            transaction.savepoint_commit(sid)
+            return summary
+        except IntegrityError:
+            # Somebody else created it first
+            transaction.savepoint_rollback(sid)
+            summary = _lock(world_id)
+    summary.add(user_ids, anonymous, first_edit, last_edit)
+    summary.backfilled = summary.backfilled or backfilled
+    summary.save()
+    return summary
+
+def record(rows):
+    """
+    Counts journal rows, (world_id, tileY, tileX, charY, charX, char, user_id,
+    ip, time) tuples as in EditRecordManager.FIELDS. Call this inside a
+    transaction.
+    """
+    worlds = {}
+    for row in rows:
+        world_id, user_id, time = row[0], row[6], row[8]
+        w = worlds.get(world_id)
+        if w is None:
+            w = worlds[world_id] = [set(), False, time, time]
+        if user_id is None:
+            w[1] = True
+        else:
+            w[0].add(user_id)
+        w[2] = min(w[2], time)
+        w[3] = max(w[3], time)
+    # In a fixed order, so that journal writers in different processes can't deadlock
+    for world_id in sorted(worlds):
+        user_ids, anonymous, first_edit, last_edit = worlds[world_id]
+        _add(world_id, user_ids, anonymous, first_edit, last_edit)
+
+def _from_history(world_id):
+    """(user_ids, anonymous, first_edit, last_edit) from everything stored about the world's edits."""
+    limit = WorldEditors.MAX_EDITORS + 1
+    user_ids = set()
+    anonymous = False
+    times = []
+    for model, time_field in ((Edit, 'time'), (EditRecord, 'time'), (EditSummary, 'day')):
+        qs = model.objects.filter(world=world_id)
+        user_ids.update(qs.filter(user__isnull=False).order_by()
+                          .values_list('user', flat=True).distinct()[:limit])
+        anonymous = anonymous or qs.filter(user__isnull=True).exists()
+        span = qs.aggregate(first=Min(time_field), last=Max(time_field))
+        for t in (span['first'], span['last']):
+            if t is None:
+                continue
+            if not isinstance(t, datetime.datetime):
+                t = datetime.datetime.combine(t, datetime.time())
+            times.append(t)
+    return user_ids, anonymous, times and min(times) or None, times and max(times) or None
+
+@transaction.commit_on_success
+def backfill(world_id):
+    """Counts the world's edits from before its WorldEditors existed, if they haven't been."""
+    summary = _lock(world_id)
+    if summary is not None and summary.backfilled:
+        return summary
+    user_ids, anonymous, first_edit, last_edit = _from_history(world_id)
+    return _add(world_id, user_ids, anonymous, first_edit, last_edit, backfilled=True)
+
+def get(world):
+    """The world's WorldEditors, counting its history first if that hasn't been done."""
+    try:
+        summary = WorldEditors.objects.get(world=world)
+        if summary.backfilled:
+            return summary
+    except WorldEditors.DoesNotExist:
+        pass
+    try:
+        return backfill(world.id)
+    except IntegrityError:
+        # Somebody else created it first, without a savepoint to fall back on
+        return backfill(world.id)
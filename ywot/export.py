@@ -0,0 +1,84 @@
+"""
+World dumps, as plain text or as JSON lines.
+
+Tiles are read in row-major order a page at a time, each page picking up
+after the last (tileY, tileX) of the one before, so the unique index does the
+work and memory use doesn't depend on the size of the world. Only tiles that
+exist are ever looked at, however sparse the world is. (Chunked worlds are
+read a row of chunks at a time instead; see ywot.chunks.)
+"""
+
+import itertools
+
+from django.db.models import Min, Q
+from django.utils import simplejson
+
+from yourworld.ywot import chunks
+from yourworld.ywot.models import Tile
+
+PAGE_SIZE = 1000
+
+def iter_tiles(world, bbox=None):
+    """
+    Yields the world's tiles by row, then column. `bbox` optionally limits
+    them to an inclusive (min_tileY, min_tileX, max_tileY, max_tileX).
+    """
+    if chunks.is_chunked(world):
+        for tile in chunks.iter_tiles(world, bbox):
+            yield tile
+        return
+    tiles = Tile.objects.filter(world=world).order_by('tileY', 'tileX')
+    if bbox is not None:
+        min_tileY, min_tileX, max_tileY, max_tileX = bbox
+        tiles = tiles.filter(tileY__gte=min_tileY, tileY__lte=max_tileY,
+                             tileX__gte=min_tileX, tileX__lte=max_tileX)
+    last = None
+    while True:
+        page = tiles
+        if last is not None:
+            page = page.filter(Q(tileY__gt=last[0]) | Q(tileY=last[0], tileX__gt=last[1]))
+        page = list(page[:PAGE_SIZE])
+        for tile in page:
+            yield tile
+        if len(page) < PAGE_SIZE:
+            return
+        last = (page[-1].tileY, page[-1].tileX)
+
+def text_lines(world, bbox=None):
+    """
+    Yields the world as lines of text: Tile.ROWS lines for each row of tiles
+    that has any, starting from the left edge of `bbox` (or of the world).
+    Rows of tiles with nothing in them are left out entirely, so use
+    json_lines if you need the coordinates.
+    """
+    if bbox is not None:
+        left = bbox[1]
+    elif chunks.is_chunked(world):
+        left = chunks.min_tileX(world)
+    else:
+        left = Tile.objects.filter(world=world).aggregate(Min('tileX'))['tileX__min']
+    blank = ' ' * Tile.COLS
+    for tileY, tiles in itertools.groupby(iter_tiles(world, bbox), lambda t: t.tileY):
+        lines = [[] for i in xrange(Tile.ROWS)]
+        tileX = left
+        for tile in tiles:
+            content = tile.content.replace('\n', ' ')
+            for i, line in enumerate(lines):
+                line.append(blank * (tile.tileX - tileX))
+                line.append(content[i*Tile.COLS:(i + 1)*Tile.COLS])
+            tileX = tile.tileX + 1
+        for line in lines:
+            yield u''.join(line).rstrip() + u'\n'
+
+def json_lines(world, bbox=None):
+    """Yields one JSON object per tile: tileY, tileX, content, and properties if any."""
+    for tile in iter_tiles(world, bbox):
+        d = {'tileY': tile.tileY, 'tileX': tile.tileX, 'content': tile.content}
+        if tile.properties:
+            d['properties'] = tile.properties
+        yield simplejson.dumps(d) + '\n'
+
+FORMATS = {
+    'text': text_lines,
+    'jsonl': json_lines,
+}
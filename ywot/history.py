@@ -0,0 +1,123 @@
+"""
+Edit history, for noticing abuse: who wrote where, and when.
+
+Recent history is read from EditRecords, one per character, newest first and
+a page at a time. Records older than EDIT_HISTORY_RETENTION_DAYS are rolled up
+by `compact` (see the compact_edit_history command) into EditSummaries, which
+count each user's or ip's characters per tile per day.
+"""
+
+import datetime
+
+from django.db import connection, transaction
+from django.db.models import Count, Q
+
+from yourworld.ywot.models import EditRecord, EditSummary, insert_rows
+
+MAX_LIMIT = 1000
+_CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def _encode_cursor(record):
+    return '%s_%d' % (record.time.strftime(_CURSOR_TIME_FORMAT), record.id)
+
+def _decode_cursor(cursor):
+    t, id = cursor.rsplit('_', 1)
+    return datetime.datetime.strptime(t, _CURSOR_TIME_FORMAT), int(id)
+
+def _filter(qs, world, region, user, ip):
+    if world is not None:
+        qs = qs.filter(world=world)
+    if region is not None:
+        min_tileY, min_tileX, max_tileY, max_tileX = region
+        qs = qs.filter(tileY__gte=min_tileY, tileY__lte=max_tileY,
+                       tileX__gte=min_tileX, tileX__lte=max_tileX)
+    if user is not None:
+        qs = qs.filter(user=user)
+    if ip is not None:
+        qs = qs.filter(ip=ip)
+    return qs
+
+def query(world=None, region=None, user=None, ip=None, start=None, end=None,
+          cursor=None, limit=100):
+    """
+    Returns (records, next_cursor): up to `limit` EditRecords matching all of
+    the given filters, newest first, and the cursor to pass back for the next
+    page (None if there isn't one).
+
+    `region` is an inclusive (min_tileY, min_tileX, max_tileY, max_tileX);
+    `start` and `end` are datetimes, `end` exclusive.
+    """
+    qs = _filter(EditRecord.objects.select_related('user'), world, region, user, ip)
+    if start is not None:
+        qs = qs.filter(time__gte=start)
+    if end is not None:
+        qs = qs.filter(time__lt=end)
+    if cursor:
+        t, id = _decode_cursor(cursor)
+        qs = qs.filter(Q(time__lt=t) | Q(time=t, id__lt=id))
+    limit = max(1, min(limit, MAX_LIMIT))
+    records = list(qs.order_by('-time', '-id')[:limit + 1])
+    next_cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_cursor = _encode_cursor(records[-1])
+    return records, next_cursor
+
+def summaries(world=None, region=None, user=None, ip=None, start=None, end=None):
+    """
+    Same filters as `query`, for history that has been compacted: the days
+    that overlap the time from `start` up to (not including) `end`.
+    """
+    qs = _filter(EditSummary.objects.select_related('user'), world, region, user, ip)
+    if start is not None:
+        qs = qs.filter(day__gte=start.date())
+    if end is not None:
+        end_day = end.date()
+        if end != datetime.datetime.combine(end_day, datetime.time()):
+            end_day += datetime.timedelta(days=1)
+        qs = qs.filter(day__lt=end_day)
+    return qs.order_by('-day')
+
+def compact(before):
+    """
+    Rolls up the EditRecords from before the date `before` into EditSummaries,
+    one transaction per day, and deletes them. Returns how many were rolled up.
+    """
+    oldest = EditRecord.objects.order_by('time').values_list('time', flat=True)[:1]
+    if not oldest:
+        return 0
+    day = oldest[0].date()
+    total = 0
+    while day < before:
+        total += _compact_day(day)
+        day += datetime.timedelta(days=1)
+    return total
+
+@transaction.commit_on_success
+def _compact_day(day):
+    start = datetime.datetime.combine(day, datetime.time())
+    end = start + datetime.timedelta(days=1)
+    groups = (EditRecord.objects
+              .filter(time__gte=start, time__lt=end)
+              .values('world', 'tileY', 'tileX', 'user', 'ip')
+              .annotate(edits=Count('id'))
+              .order_by())
+    counts = dict(((g['world'], g['tileY'], g['tileX'], g['user'], g['ip']), g['edits'])
+                  for g in groups)
+    if not counts:
+        return 0
+    # In case this day was compacted before and more records turned up since
+    for summary in EditSummary.objects.filter(day=day):
+        key = (summary.world_id, summary.tileY, summary.tileX, summary.user_id, summary.ip)
+        if key in counts:
+            summary.edits += counts.pop(key)
+            summary.save()
+    insert_rows(EditSummary, ['world', 'tileY', 'tileX', 'user', 'ip', 'day', 'edits'],
+                [key + (connection.ops.value_to_db_date(day), n) for key, n in counts.iteritems()])
+    qn = connection.ops.quote_name
+    to_db = connection.ops.value_to_db_datetime
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE %s >= %%s AND %s < %%s' % (
+                        qn(EditRecord._meta.db_table), qn('time'), qn('time')),
+                   [to_db(start), to_db(end)])
+    return cursor.rowcount
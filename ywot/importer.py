@@ -0,0 +1,107 @@
+"""
+Bulk world imports: from a block of text, or from the JSON lines written by
+ywot.export. The whole import is one transaction, written BATCH_SIZE tiles at
+a time (see tilestore.write_batches).
+"""
+
+import itertools
+
+from django.utils import simplejson
+
+from yourworld.helpers import control_chars_set
+from yourworld.ywot import tilestore
+from yourworld.ywot.models import Tile
+
+BATCH_SIZE = 500
+
+class ImportException(Exception):
+    pass
+
+def _clean(s):
+    return u''.join([(c in control_chars_set) and u' ' or c for c in s])
+
+def _decoded(lines):
+    for line in lines:
+        if isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        yield line
+
+def _text_batches(lines, tileY, tileX):
+    # Cut into bands of Tile.ROWS lines, and batch the bands up
+    lines = _decoded(lines)
+    edits = {}
+    while True:
+        band = list(itertools.islice(lines, Tile.ROWS))
+        for charY, line in enumerate(band):
+            line = _clean(line.rstrip('\r\n'))
+            for start in xrange(0, len(line), Tile.COLS):
+                cells = edits.setdefault((tileY, tileX + start // Tile.COLS), [])
+                cells.extend([(charY, charX, c)
+                              for charX, c in enumerate(line[start:start + Tile.COLS])])
+        if edits and (len(edits) >= BATCH_SIZE or not band):
+            yield edits.keys(), _text_update(edits)
+            edits = {}
+        if not band:
+            return
+        tileY += 1
+
+def _text_update(edits):
+    def update(tiles):
+        for coords, tile_edits in edits.iteritems():
+            tiles[coords].apply_edits(tile_edits)
+        return [tiles[coords] for coords in edits]
+    return update
+
+def import_text(world, lines, tileY=0, tileX=0):
+    """
+    Writes the text `lines` onto the world, with the first character at the
+    top left of tile (tileY, tileX). Every character overwrites its cell
+    (and any link on it), spaces included; cells past the end of a line are
+    left alone. Returns the number of tiles written.
+    """
+    return tilestore.write_batches(world, _text_batches(lines, tileY, tileX))
+
+def _parse_json_line(line, number):
+    try:
+        d = simplejson.loads(line)
+        content = _clean(d['content'])
+        properties = d.get('properties', {})
+        if len(content) != Tile.LEN or not isinstance(properties, dict):
+            raise ValueError
+        return int(d['tileY']), int(d['tileX']), content, properties
+    except (ValueError, KeyError, TypeError):
+        raise ImportException('Line %d is not a tile.' % number)
+
+def _json_batches(lines, offsetY, offsetX):
+    records = ((number + 1, line) for number, line in enumerate(_decoded(lines)) if line.strip())
+    while True:
+        batch = {}
+        for number, line in itertools.islice(records, BATCH_SIZE):
+            tileY, tileX, content, properties = _parse_json_line(line, number)
+            batch[(tileY + offsetY, tileX + offsetX)] = (content, properties)
+        if not batch:
+            return
+        yield batch.keys(), _json_update(batch)
+
+def _json_update(batch):
+    def update(tiles):
+        for coords, (content, properties) in batch.iteritems():
+            tile = tiles[coords]
+            tile.content = content
+            tile.properties = properties
+        return [tiles[coords] for coords in batch]
+    return update
+
+def import_json_lines(world, lines, tileY=0, tileX=0):
+    """
+    Writes tiles from export.json_lines output onto the world, replacing their
+    content and properties (links, protection), with every tile moved by
+    (tileY, tileX). Raises ImportException, having written nothing, if a line
+    isn't a tile. Returns the number of tiles written.
+    """
+    return tilestore.write_batches(world, _json_batches(lines, tileY, tileX))
+
+FORMATS = {
+    'text': import_text,
+    'jsonl': import_json_lines,
+}
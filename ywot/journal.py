@@ -0,0 +1,189 @@
+"""
+The edit journal: one EditRecord for every character send_edits accepts.
+
+Records are queued in memory and written by a background thread, in batches
+of up to JOURNAL_BATCH_SIZE, at least every JOURNAL_FLUSH_INTERVAL seconds.
+Once a batch is in, WorldEditors is brought up to date in a transaction of
+its own (see ywot.editors), so that a failure there can't lose the records,
+and the batch is counted towards EditActivity, which the same thread writes
+every so often (see ywot.activity). A batch that can't be written goes
+back on the front of the queue, to be tried again on the next round. The
+queue holds at most JOURNAL_MAX_QUEUE records; past that, the newest records
+are dropped and counted rather than holding up edits. Whatever is queued is written when the
+process exits, so a clean restart loses nothing.
+"""
+
+import atexit, datetime, threading
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from yourworld.lib import log
+from yourworld.ywot.models import EditRecord, WorldEditors
+from yourworld.ywot import activity, editors
+
+BATCH_SIZE = getattr(settings, 'JOURNAL_BATCH_SIZE', 1000)
+FLUSH_INTERVAL = getattr(settings, 'JOURNAL_FLUSH_INTERVAL', 1.0)
+MAX_QUEUE = getattr(settings, 'JOURNAL_MAX_QUEUE', 100000)
+
+stats = {
+    'queued': 0,
+    'written': 0,
+    'dropped': 0, # queue was full
+    'failed': 0, # database error while writing; queued again
+    'editors_failed': 0, # written, but a database error kept them out of WorldEditors
+}
+
+_cond = threading.Condition() # also guards stats
+_pending = []
+_writer = None
+_stopping = False
+
+def _count(state, n):
+    _cond.acquire()
+    try:
+        stats[state] += n
+    finally:
+        _cond.release()
+
+def make_rows(world, user, ip, edits):
+    """
+    Journal rows for `edits`, which are [tileY, tileX, charY, charX,
+    timestamp, char] lists as in send_edits, made now: tuples of values for
+    EditRecordManager.FIELDS.
+    """
+    now = datetime.datetime.now()
+    user_id = user.id if user.is_authenticated() else None
+    return [(world.id, e[0], e[1], e[2], e[3], e[5], user_id, ip, now) for e in edits]
+
+def record(world, user, ip, edits):
+    """Queues the accepted `edits`, as in `make_rows`."""
+    record_rows(make_rows(world, user, ip, edits))
+
+def record_rows(rows):
+    """Queues rows made by `make_rows`, e.g. once the edits they're for have been written."""
+    _cond.acquire()
+    try:
+        room = MAX_QUEUE - len(_pending)
+        if room < len(rows):
+            stats['dropped'] += len(rows) - max(room, 0)
+            rows = rows[:max(room, 0)]
+        _pending.extend(rows)
+        stats['queued'] += len(rows)
+        _start_writer()
+        if len(_pending) >= BATCH_SIZE:
+            _cond.notify()
+    finally:
+        _cond.release()
+
+def flush():
+    """Writes everything queued so far, edit activity included, in this thread."""
+    _write_batches()
+    activity.flush()
+
+def _write_batches():
+    while _write_batch():
+        pass
+
+def _take_batch():
+    global _pending
+    _cond.acquire()
+    try:
+        batch, _pending = _pending[:BATCH_SIZE], _pending[BATCH_SIZE:]
+        return batch
+    finally:
+        _cond.release()
+
+@transaction.commit_on_success
+def _insert(batch):
+    EditRecord.objects.insert_many(batch)
+
+@transaction.commit_on_success
+def _record_editors(batch):
+    editors.record(batch)
+
+def _put_back(batch):
+    # Ahead of what was queued since, keeping the queue's bound
+    _cond.acquire()
+    try:
+        _pending[:0] = batch
+        over = len(_pending) - MAX_QUEUE
+        if over > 0:
+            del _pending[-over:]
+            stats['dropped'] += over
+    finally:
+        _cond.release()
+
+def _write_batch():
+    """
+    Writes one batch. Returns whether to go on, i.e. there was a batch and
+    it was written.
+    """
+    batch = _take_batch()
+    if not batch:
+        return False
+    return _write(batch)
+
+def _write(batch):
+    """Writes a batch, or puts it back to try again later. Returns whether it was written."""
+    try:
+        _insert(batch)
+        _count('written', len(batch))
+    except Exception:
+        _count('failed', len(batch))
+        log.exception('Could not write %d journal records; will try again' % len(batch))
+        connection.close() # reconnect next time
+        _put_back(batch)
+        return False
+    activity.record(batch)
+    try:
+        _record_editors(batch)
+    except Exception:
+        _count('editors_failed', len(batch))
+        log.exception('Could not count %d journal records in WorldEditors' % len(batch))
+        connection.close()
+        _recount_editors(batch)
+    return True
+
+def _recount_editors(batch):
+    # The records are in, so having the worlds' WorldEditors counted from
+    # history again on their next use catches them up
+    try:
+        WorldEditors.objects.filter(world__in=set([row[0] for row in batch])).update(backfilled=False)
+    except Exception:
+        log.exception('Could not mark WorldEditors for a recount')
+        connection.close()
+
+def _run():
+    while not _stopping:
+        _cond.acquire()
+        try:
+            if len(_pending) < BATCH_SIZE and not _stopping:
+                _cond.wait(FLUSH_INTERVAL)
+        finally:
+            _cond.release()
+        _write_batches()
+        activity.maybe_flush()
+
+def _shutdown():
+    """At exit: stops the writer, then writes what's left in this thread."""
+    global _stopping
+    _cond.acquire()
+    try:
+        _stopping = True
+        _cond.notify()
+    finally:
+        _cond.release()
+    _writer.join()
+    flush()
+    if _pending:
+        log.error('Lost %d journal records that could not be written before exit' % len(_pending))
+
+def _start_writer():
+    # Called with _cond held
+    global _writer
+    if _writer is None:
+        _writer = threading.Thread(target=_run, name='ywot-journal')
+        _writer.setDaemon(True)
+        _writer.start()
+        atexit.register(_shutdown)
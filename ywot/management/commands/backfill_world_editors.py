@@ -0,0 +1,27 @@
+from django.core.management.base import NoArgsCommand
+
+from yourworld.ywot import editors
+from yourworld.ywot.models import World, WorldEditors
+
+class Command(NoArgsCommand):
+    help = ("Counts each world's editors from its edit history into WorldEditors, "
+            "for worlds edited before those were kept. Safe to run again.")
+
+    # Worlds' ids are read this many at a time
+    CHUNK = 1000
+
+    def handle_noargs(self, **options):
+        done = set(WorldEditors.objects.filter(backfilled=True).values_list('world', flat=True))
+        n = 0
+        last = 0
+        while True:
+            ids = list(World.objects.filter(id__gt=last).order_by('id')
+                       .values_list('id', flat=True)[:self.CHUNK])
+            if not ids:
+                break
+            last = ids[-1]
+            for id in ids:
+                if id not in done:
+                    editors.backfill(id)
+                    n += 1
+        print 'Backfilled the editors of %d worlds.' % n
@@ -0,0 +1,55 @@
+import os, sys, tempfile
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+from yourworld.ywot import benchmark, journal
+
+class Command(NoArgsCommand):
+    help = ("Load-tests fetches and edits the way yourworld.js makes them, on a scratch "
+            "test database, and writes the latencies and query counts as JSON.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--viewers', type='int', dest='viewers', default=20,
+                    help='Clients that only fetch.'),
+        make_option('--typists', type='int', dest='typists', default=5,
+                    help='Clients that fetch and type.'),
+        make_option('--rounds', type='int', dest='rounds', default=30,
+                    help='Simulated seconds.'),
+        make_option('--layout', dest='layout', default='mixed',
+                    choices=['overlapping', 'disjoint', 'mixed'],
+                    help='Where the viewports are: overlapping, disjoint, or mixed (the default).'),
+        make_option('--viewport', dest='viewport', default='8x10',
+                    help='Tiles in view, as ROWSxCOLS.'),
+        make_option('--rate-limit', action='store_true', dest='rate_limit', default=False,
+                    help='Leave RATE_LIMITS on.'),
+        make_option('--output', dest='output', default=None,
+                    help='Write the JSON here instead of to stdout.'),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            viewport = tuple(map(int, options['viewport'].split('x')))
+            assert len(viewport) == 2
+        except (ValueError, AssertionError):
+            raise CommandError('--viewport looks like 8x10.')
+        path = None
+        if 'sqlite' in connection.settings_dict['ENGINE']:
+            # On disk rather than in memory, so the journal's thread sees it too
+            fd, path = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+            connection.settings_dict['TEST_NAME'] = path
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = benchmark.run(options['viewers'], options['typists'], options['rounds'],
+                                    options['layout'], viewport, options['rate_limit'])
+            journal.flush()
+            results['journal'] = journal.stats
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if path and os.path.exists(path):
+                os.remove(path)
+        out = options['output'] and open(options['output'], 'w') or sys.stdout
+        out.write(simplejson.dumps(results, indent=2, sort_keys=True) + '\n')
@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from yourworld.ywot import chunks
+from yourworld.ywot.models import World
+
+class Command(BaseCommand):
+    help = ("Moves worlds' tiles into chunks of %d x %d tiles, or back with --undo. "
+            "Edits to a world wait while it's moved." % (chunks.SIZE, chunks.SIZE))
+    args = '<world name> [<world name> ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--undo', action='store_true', dest='undo', default=False,
+                    help='Move the tiles back into the tile table.'),
+    )
+
+    def handle(self, *names, **options):
+        if not names:
+            raise CommandError('Which worlds?')
+        for name in names:
+            try:
+                world = World.objects.get(name=name)
+            except World.DoesNotExist:
+                raise CommandError('No world named "%s".' % name)
+            if chunks.is_chunked(world) != options['undo']:
+                print '%s: already done' % name
+                continue
+            if options['undo']:
+                moved = chunks.revert(world)
+            else:
+                moved = chunks.convert(world)
+            print '%s: moved %d tiles' % (name, moved)
@@ -0,0 +1,20 @@
+import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from yourworld.ywot import history
+
+class Command(NoArgsCommand):
+    help = "Rolls up old per-character edit history into per-tile daily summaries."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', dest='days',
+                    default=getattr(settings, 'EDIT_HISTORY_RETENTION_DAYS', 30),
+                    help='Keep this many days of per-character history.'),
+    )
+
+    def handle_noargs(self, **options):
+        before = datetime.date.today() - datetime.timedelta(days=options['days'])
+        n = history.compact(before)
+        print 'Compacted %d edits from before %s.' % (n, before)
@@ -0,0 +1,32 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from yourworld.ywot import export
+from yourworld.ywot.models import World
+
+class Command(BaseCommand):
+    help = "Writes a world to stdout as text, or as JSON lines with tile properties."
+    args = '<world name>'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='text', choices=export.FORMATS.keys(),
+                    help='text (the default) or jsonl.'),
+        make_option('--bbox', dest='bbox', default=None,
+                    help='Only these tiles: min_tileY,min_tileX,max_tileY,max_tileX (inclusive).'),
+    )
+
+    def handle(self, name=None, **options):
+        if not name:
+            raise CommandError('Which world?')
+        try:
+            world = World.objects.get(name=name)
+        except World.DoesNotExist:
+            raise CommandError('No world named "%s".' % name)
+        bbox = None
+        if options['bbox']:
+            bbox = map(int, options['bbox'].split(','))
+            if len(bbox) != 4:
+                raise CommandError('--bbox takes four numbers.')
+        for chunk in export.FORMATS[options['format']](world, bbox):
+            sys.stdout.write(chunk.encode('utf-8'))
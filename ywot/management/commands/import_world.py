@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from yourworld.ywot import importer
+from yourworld.ywot.models import World
+
+class Command(BaseCommand):
+    help = "Writes a text file, or an export_world --format jsonl dump, onto a world."
+    args = '<world name> <file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='text', choices=importer.FORMATS.keys(),
+                    help='text (the default) or jsonl.'),
+        make_option('--tileY', dest='tileY', type='int', default=0,
+                    help='Tile row to put the text at, or to move jsonl tiles by.'),
+        make_option('--tileX', dest='tileX', type='int', default=0,
+                    help='Tile column to put the text at, or to move jsonl tiles by.'),
+        make_option('--create', dest='create', action='store_true', default=False,
+                    help="Create the world if it doesn't exist."),
+    )
+
+    def handle(self, name=None, filename=None, **options):
+        if not (name and filename):
+            raise CommandError('Usage: import_world %s' % self.args)
+        if options['create']:
+            world, _ = World.get_or_create(name)
+        else:
+            try:
+                world = World.objects.get(name=name)
+            except World.DoesNotExist:
+                raise CommandError('No world named "%s". (Use --create?)' % name)
+        f = open(filename)
+        try:
+            n = importer.FORMATS[options['format']](world, f, options['tileY'], options['tileX'])
+        except importer.ImportException, e:
+            raise CommandError(str(e))
+        finally:
+            f.close()
+        print 'Wrote %d tiles to "%s".' % (n, world.name)
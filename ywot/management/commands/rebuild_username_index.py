@@ -0,0 +1,20 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from yourworld.ywot import usernames
+
+class Command(NoArgsCommand):
+    help = "Has the web processes rebuild their username index for member autocomplete."
+
+    def handle_noargs(self, **options):
+        usernames.invalidate()
+        start = time.time()
+        n = usernames.rebuild()
+        print 'Indexed %d usernames in %.2f seconds.' % (n, time.time() - start)
+        if getattr(settings, 'YWOT_CACHE_BACKEND', 'local') == 'shared':
+            print 'Every web process will rebuild its index on its next lookup.'
+        else:
+            print ('YWOT_CACHE_BACKEND is local, so the web processes will only rebuild theirs '
+                   'once it is USERNAME_INDEX_MAX_AGE (%s seconds) old.' % usernames.MAX_AGE)
@@ -0,0 +1,39 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import transaction
+
+from yourworld.ywot import activity
+
+class Command(NoArgsCommand):
+    help = ("Recounts the hourly and daily edit activity of whole days from the edit "
+            "history, replacing what was there; for days already compacted, just the "
+            "daily activity. The journal keeps today's up to date.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--start', dest='start', default=None,
+                    help='First day, as YYYY-MM-DD. Defaults to the oldest edit.'),
+        make_option('--end', dest='end', default=None,
+                    help='Last day, as YYYY-MM-DD. Defaults to yesterday.'),
+    )
+
+    def _day(self, value):
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError('Days look like 2010-06-30.')
+
+    def handle_noargs(self, **options):
+        start = options['start'] and self._day(options['start']) or activity.oldest_day()
+        end = (options['end'] and self._day(options['end'])
+               or datetime.date.today() - datetime.timedelta(days=1))
+        if start is None:
+            print 'No edit history.'
+            return
+        day = start
+        total = 0
+        while day <= end:
+            total += activity.rebuild_day(day)
+            day += datetime.timedelta(days=1)
+        transaction.commit_on_success(activity.prune)()
+        print 'Counted %d edits from %s to %s.' % (total, start, end)
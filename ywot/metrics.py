@@ -0,0 +1,240 @@
+"""
+Counters and histograms for operators, served in Prometheus' text format by
+views.metrics. MetricsMiddleware times every request by endpoint, along with
+its database queries and response size; views add what only they know, like
+tiles per fetch and edits per batch. All of it is per process, so have
+Prometheus scrape each worker.
+
+There's also a sampling profiler, for finding where a busy world's time
+goes: requests to a world in PROFILE_WORLDS, or superusers' requests with
+?profile=1, get their stack sampled every PROFILE_INTERVAL seconds, written
+out as collapsed stacks (one "frame;frame;frame count" line each, as
+flamegraph.pl reads them) under PROFILE_DIRECTORY.
+"""
+
+import collections, os, sys, thread, threading, time
+
+from django.conf import settings
+
+SECONDS_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000)
+
+# Worlds get their own label only up to here, so a crawl can't blow up our
+# memory or the scraper's; the rest are counted as "other".
+MAX_WORLDS = getattr(settings, 'METRICS_MAX_WORLDS', 100)
+
+_lock = threading.Lock()
+_registry = []
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, _escape(v)) for k, v in pairs])
+
+def render_values(name, help, kind, samples):
+    """Prometheus text for one metric; `samples` is a list of (labels dict, value)."""
+    lines = ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind)]
+    for labels, value in samples:
+        lines.append('%s%s %s' % (name, _labels(sorted(labels.items())), value))
+    return lines
+
+class Counter(object):
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        _lock.acquire()
+        try:
+            self._values[key] = self._values.get(key, 0) + amount
+        finally:
+            _lock.release()
+
+    def render(self):
+        return render_values(self.name, self.help, 'counter',
+                             [(dict(key), value) for key, value in sorted(self._values.items())])
+
+class Histogram(object):
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [cumulative count for each bucket..., sum, count]
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        _lock.acquire()
+        try:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+        finally:
+            _lock.release()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for key, series in sorted(self._series.items()):
+            for bound, n in zip(self.buckets, series):
+                lines.append('%s_bucket%s %d' % (self.name, _labels(key, [('le', bound)]), n))
+            lines.append('%s_bucket%s %d' % (self.name, _labels(key, [('le', '+Inf')]), series[-1]))
+            lines.append('%s_sum%s %s' % (self.name, _labels(key), series[-2]))
+            lines.append('%s_count%s %d' % (self.name, _labels(key), series[-1]))
+        return lines
+
+def render():
+    """Everything registered here, as lines of Prometheus text."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return lines
+
+request_seconds = Histogram('ywot_request_seconds', 'Time to respond, by endpoint.', SECONDS_BUCKETS)
+request_queries = Histogram('ywot_request_db_queries', 'Database queries per request, by endpoint.', COUNT_BUCKETS)
+request_db_seconds = Histogram('ywot_request_db_seconds', 'Time in database queries per request, by endpoint.', SECONDS_BUCKETS)
+response_bytes = Histogram('ywot_response_bytes', 'Response body size, by endpoint (not streamed ones).', BYTES_BUCKETS)
+fetch_tiles = Histogram('ywot_fetch_tiles', 'Tiles sent per fetch.', COUNT_BUCKETS)
+edit_batch = Histogram('ywot_edit_batch_size', 'Edits taken per send_edits POST.', COUNT_BUCKETS)
+world_seconds = Counter('ywot_world_seconds_total', 'Time spent on requests, by world.')
+
+_worlds = set()
+
+def world_label(name):
+    name = name.lower()
+    _lock.acquire()
+    try:
+        if name not in _worlds:
+            if len(_worlds) >= MAX_WORLDS:
+                return 'other'
+            _worlds.add(name)
+        return name
+    finally:
+        _lock.release()
+
+#
+# Query timing
+#
+
+_local = threading.local()
+
+def reset_queries():
+    _local.queries = 0
+    _local.seconds = 0.0
+
+def queries():
+    """(queries, seconds in them) in this thread since reset_queries()."""
+    return getattr(_local, 'queries', 0), getattr(_local, 'seconds', 0.0)
+
+class _TimedCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def _timed(self, method, args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            _local.queries = getattr(_local, 'queries', 0) + 1
+            _local.seconds = getattr(_local, 'seconds', 0.0) + time.time() - start
+
+    def execute(self, *args):
+        return self._timed(self.cursor.execute, args)
+
+    def executemany(self, *args):
+        return self._timed(self.cursor.executemany, args)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def install_query_timer():
+    """Wraps every database cursor to count queries. Django 1.2 has no hook for this."""
+    from django.db.backends import BaseDatabaseWrapper
+    if getattr(BaseDatabaseWrapper.cursor, '_ywot_timed', False):
+        return
+    cursor = BaseDatabaseWrapper.cursor
+    def timed_cursor(self):
+        return _TimedCursor(cursor(self))
+    timed_cursor._ywot_timed = True
+    BaseDatabaseWrapper.cursor = timed_cursor
+
+#
+# Sampling profiler
+#
+
+PROFILE_WORLDS = set([name.lower() for name in getattr(settings, 'PROFILE_WORLDS', ())])
+PROFILE_INTERVAL = getattr(settings, 'PROFILE_INTERVAL', 0.005)
+PROFILE_DIRECTORY = getattr(settings, 'PROFILE_DIRECTORY', None) or os.path.join(settings.LOG_DIRECTORY, 'profiles')
+
+class Sampler(object):
+    """Counts the stacks of one thread, sampled every `interval` seconds until stop()."""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.defaultdict(int)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ywot-sampler')
+        self._thread.setDaemon(True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.isSet():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.stacks[';'.join(stack)] += 1
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+def should_profile(request, world_name):
+    if world_name is not None and world_name.lower() in PROFILE_WORLDS:
+        return True
+    return ('profile' in request.GET and request.user.is_authenticated()
+            and request.user.is_superuser)
+
+def start_profile():
+    return Sampler(thread.get_ident()).start()
+
+def write_profile(sampler, label):
+    """Stops `sampler` and writes what it saw to PROFILE_DIRECTORY. Returns the file name."""
+    stacks = sampler.stop()
+    if not os.path.isdir(PROFILE_DIRECTORY):
+        os.makedirs(PROFILE_DIRECTORY)
+    filename = os.path.join(PROFILE_DIRECTORY, '%s-%d-%s.txt' % (
+        time.strftime('%Y%m%d-%H%M%S'), os.getpid(), ''.join([c for c in label if c.isalnum() or c in '_-'])))
+    f = open(filename, 'w')
+    try:
+        for stack, n in sorted(stacks.items()):
+            f.write('%s %d\n' % (stack, n))
+    finally:
+        f.close()
+    return filename
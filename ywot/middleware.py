@@ -0,0 +1,53 @@
+import time
+
+from yourworld.ywot import metrics
+
+class MetricsMiddleware(object):
+    """
+    Records each request's time, queries and response size in ywot.metrics,
+    by endpoint, and samples it with the profiler when asked to. Goes first
+    in MIDDLEWARE_CLASSES, so that the time of the others is counted too.
+    """
+
+    def __init__(self):
+        metrics.install_query_timer()
+
+    def process_request(self, request):
+        request._metrics_start = time.time()
+        metrics.reset_queries()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        endpoint = getattr(view_func, '__name__', 'other')
+        world = None
+        if endpoint == 'yourworld':
+            world = view_args[0]
+            if 'fetch' in request.GET:
+                endpoint = 'fetch'
+            elif request.method == 'POST':
+                endpoint = 'send_edits'
+            else:
+                endpoint = 'world_page'
+        request._metrics_endpoint = endpoint
+        request._metrics_world = world
+        if metrics.should_profile(request, world):
+            request._metrics_sampler = metrics.start_profile()
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is None:
+            return response
+        elapsed = time.time() - start
+        endpoint = getattr(request, '_metrics_endpoint', 'other')
+        queries, db_seconds = metrics.queries()
+        metrics.request_seconds.observe(elapsed, endpoint=endpoint)
+        metrics.request_queries.observe(queries, endpoint=endpoint)
+        metrics.request_db_seconds.observe(db_seconds, endpoint=endpoint)
+        if getattr(response, '_is_string', False):
+            metrics.response_bytes.observe(len(response.content), endpoint=endpoint)
+        world = getattr(request, '_metrics_world', None)
+        if world is not None:
+            metrics.world_seconds.inc(elapsed, world=metrics.world_label(world))
+        sampler = getattr(request, '_metrics_sampler', None)
+        if sampler is not None:
+            metrics.write_profile(sampler, '%s-%s' % (endpoint, world or ''))
+        return response
@@ -1,9 +1,34 @@
+import copy, datetime
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Q, signals
 from django.http import Http404
 
+from yourworld.helpers import control_chars_set
+from yourworld.lib.cache import get_cache
+from yourworld.ywot import permissions
 from yourworld.lib.jsonfield import DictField
 
+# Resolved worlds by lower-cased name. Every save or delete of a world clears
+# its entry; with a local cache, other processes may take up to
+# WORLD_CACHE_TIMEOUT seconds to notice.
+_world_cache = get_cache('world', getattr(settings, 'WORLD_CACHE_SIZE', 10000),
+                         getattr(settings, 'WORLD_CACHE_TIMEOUT', 10))
+
+# Rows written per statement by bulk writes; SQLite takes at most 999 parameters
+ROWS_PER_STATEMENT = 100
+
+def _copy_world(world):
+    """A copy of a cached world, properties and all, for a caller to modify."""
+    world = copy.copy(world)
+    # Until it's first read, this is the text from the database, which can be shared
+    properties = world.__dict__.get('properties')
+    if isinstance(properties, dict):
+        world.__dict__['properties'] = copy.deepcopy(properties)
+    return world
+
 class World(models.Model):
     name = models.TextField(unique=True)
         # Creating this index for much faster world lookups from World.get_or_create,
@@ -22,19 +47,28 @@ class World(models.Model):
     @staticmethod
     def get_or_create(name):
         """Same interface as Model.get_or_create."""
+        key = name.lower()
+        world = _world_cache.get(key)
+        if world is not None:
+            # Callers may modify what we give them
+            return (_copy_world(world), False)
+
         if '/' in name:
             # These are only created manually
             try:
-                return (World.objects.get(name__iexact=name), False)
+                world = World.objects.get(name__iexact=name)
             except World.DoesNotExist:
                 raise Http404
+            _world_cache.set(key, world)
+            return (_copy_world(world), False)
 
         # GAE worlds were case-sensitive. Until we figure out what to do about that, just return
         # the first one:
-        worlds = World.objects.filter(name__iexact=name)
-        if not len(worlds):
+        worlds = list(World.objects.filter(name__iexact=name)[:1])
+        if not worlds:
             return (World.objects.create(name=name), True)
-        return (worlds[0], False)
+        _world_cache.set(key, worlds[0])
+        return (_copy_world(worlds[0]), False)
     
     class Meta:
         ordering = ['name']
@@ -45,6 +79,114 @@ class World(models.Model):
     def get_absolute_url(self):
         return '/' + self.name
 
+    def current_revision(self):
+        """The revision of the most recent tile write to this world, 0 if none."""
+        revs = WorldRevision.objects.filter(world=self).values_list('revision', flat=True)
+        return revs[0] if revs else 0
+
+    def next_revision(self):
+        """
+        Bump and return this world's change sequence. Call this inside the
+        transaction that saves the changed tiles: the row lock taken by the
+        UPDATE orders concurrent writers, so a client can never see revision
+        N before every write numbered below N has committed.
+        """
+        qs = WorldRevision.objects.filter(world=self)
+        if not qs.update(revision=models.F('revision') + 1):
+            sid = transaction.savepoint()
+            try:
+                WorldRevision.objects.create(world=self, revision=1)
+                transaction.savepoint_commit(sid)
+                return 1
+            except IntegrityError:
+                # Somebody else created it first
+                transaction.savepoint_rollback(sid)
+                qs.update(revision=models.F('revision') + 1)
+        return qs.values_list('revision', flat=True)[0]
+
+class WorldRevision(models.Model):
+    # Kept out of World itself so that World.save() from e.g. `configure`
+    # can never write back a stale value.
+    world = models.OneToOneField(World, primary_key=True)
+    revision = models.IntegerField(default=0)
+    # Whether the world's tiles are kept in TileChunks; see ywot.chunks.
+    # ADD COLUMN:
+    #ALTER TABLE ywot_worldrevision ADD COLUMN chunked boolean NOT NULL DEFAULT false;
+    chunked = models.BooleanField(default=False)
+
+class TileManager(models.Manager):
+    # Keeps the OR'd lookups in lock_many to a sane size
+    LOCK_CHUNK = 250
+
+    def lock_many(self, world, coords):
+        """
+        Returns {(tileY, tileX): Tile} for every pair in `coords`. Tiles that
+        exist are loaded with one query per LOCK_CHUNK pairs and locked FOR
+        UPDATE, in a fixed order so that writers can't deadlock; the rest
+        are new, unsaved Tiles. Call this inside a transaction.
+        """
+        coords = sorted(set((int(tileY), int(tileX)) for tileY, tileX in coords))
+        tiles = {}
+        for i in xrange(0, len(coords), self.LOCK_CHUNK):
+            q = Q()
+            for tileY, tileX in coords[i:i + self.LOCK_CHUNK]:
+                q |= Q(tileY=tileY, tileX=tileX)
+            qs = self.filter(world=world).filter(q).order_by('tileY', 'tileX')
+            if 'sqlite' not in connection.settings_dict['ENGINE']:
+                # No select_for_update() until Django 1.4. (SQLite has no
+                # row locks, and locks the whole database on write anyway.)
+                sql, params = qs.query.get_compiler(qs.db).as_sql()
+                qs = self.raw(sql + ' FOR UPDATE', params)
+            for tile in qs:
+                tiles[(tile.tileY, tile.tileX)] = tile
+        for tileY, tileX in coords:
+            if (tileY, tileX) not in tiles:
+                tiles[(tileY, tileX)] = self.model(world=world, tileY=tileY, tileX=tileX)
+        return tiles
+
+    def bulk_save(self, tiles):
+        """
+        Writes `tiles` with multi-row INSERTs for the new ones (see
+        insert_rows) and, on PostgreSQL, multi-row UPDATEs for the rest, up to
+        ROWS_PER_STATEMENT at a time. Other databases update one row per
+        statement. Unlike save(), this doesn't set the new tiles' ids. Call
+        this inside a transaction.
+        """
+        meta = self.model._meta
+        qn = connection.ops.quote_name
+        col = lambda name: qn(meta.get_field(name).column)
+        table = qn(meta.db_table)
+        properties = meta.get_field('properties').db_value
+        for t in tiles:
+            t.flush_content()
+        new = [t for t in tiles if t.pk is None]
+        old = [t for t in tiles if t.pk is not None]
+        if new:
+            fields = ['world', 'tileY', 'tileX', 'content', 'properties', 'revision', 'created_at']
+            now = connection.ops.value_to_db_datetime(datetime.datetime.now())
+            insert_rows(self.model, fields,
+                        [(t.world_id, t.tileY, t.tileX, t.content, properties(t), t.revision, now)
+                         for t in new])
+        if not old:
+            return
+        cursor = connection.cursor()
+        rows = [(t.pk, t.content, properties(t), t.revision) for t in old]
+        if 'postgresql' in connection.settings_dict['ENGINE']:
+            for i in xrange(0, len(rows), ROWS_PER_STATEMENT):
+                chunk = rows[i:i + ROWS_PER_STATEMENT]
+                cursor.execute(
+                    'UPDATE %s SET %s = v.content, %s = v.properties, %s = v.revision '
+                    'FROM (VALUES %s) AS v (id, content, properties, revision) WHERE %s.%s = v.id' % (
+                        table, col('content'), col('properties'), col('revision'),
+                        ', '.join(['(%s, %s, %s, %s)'] * len(chunk)), table, col('id')),
+                    [value for row in chunk for value in row])
+        else:
+            cursor.executemany(
+                'UPDATE %s SET %s = %%s, %s = %%s, %s = %%s WHERE %s = %%s' % (
+                    table, col('content'), col('properties'), col('revision'), col('id')),
+                [row[1:] + row[:1] for row in rows])
+        transaction.set_dirty()
+
 class Tile(models.Model):
     ROWS = 8
     COLS = 16
@@ -58,24 +200,85 @@ class Tile(models.Model):
     # properties:
     # - protected (bool)
     # - cell_props[charY][charX] = {}
+    revision = models.IntegerField(default=0) # world.next_revision() of the last write. ADD INDEX:
+        #CREATE INDEX CONCURRENTLY ywot_tile_revision ON ywot_tile(world_id, revision);
     
     created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = TileManager()
     
+    # While edits are being applied, the content lives in this list
+    _buffer = None
+
     def set_char(self, charY, charX, char):
-        from helpers import control_chars_set
-        if char in control_chars_set:
-            # TODO: log these guys again at some point
-            char = ' '
-        assert len(self.content) == self.ROWS*self.COLS
-        charY, charX = int(charY), int(charX)
-        index = charY*self.COLS+charX
-        self.content = self.content[:index] + char + self.content[index+1:]
-        assert len(self.content) == self.ROWS*self.COLS
+        self.apply_edits([(charY, charX, char)])
+
+    def apply_edits(self, edits):
+        """
+        Writes each (charY, charX, char) in `edits` to the tile, clearing any
+        cell properties (i.e. links) of the cells written. Control characters
+        are written as spaces. The new content is only put back together into
+        a string by flush_content(), which save() calls.
+        """
+        if self._buffer is None:
+            assert len(self.content) == self.LEN
+            self._buffer = list(self.content)
+        buf = self._buffer
+        cols = self.COLS
+        bad = control_chars_set.intersection([edit[2] for edit in edits])
+        # TODO: log control chars again at some point
+        cell_props = self.properties.get('cell_props')
+        for charY, charX, char in edits:
+            charY, charX = int(charY), int(charX)
+            assert 0 <= charY < self.ROWS and 0 <= charX < cols
+            if bad and char in bad:
+                char = ' '
+            buf[charY*cols + charX] = char
+            if cell_props:
+                #must be str because that's how JSON interprets int keys
+                row = cell_props.get(str(charY))
+                if row and str(charX) in row:
+                    del row[str(charX)]
+                    if not row:
+                        del cell_props[str(charY)]
+        if cell_props is not None and not cell_props:
+            del self.properties['cell_props']
+
+    def flush_content(self):
+        """Turns the edit buffer back into `content`."""
+        if self._buffer is not None:
+            self.content = u''.join(self._buffer)
+            assert len(self.content) == self.LEN
+            self._buffer = None
+
+    def save(self, *args, **kwargs):
+        self.flush_content()
+        super(Tile, self).save(*args, **kwargs)
 
     class Meta:
         unique_together=[['world', 'tileY', 'tileX']]
-        
+
+class TileChunk(models.Model):
+    """
+    SIZE x SIZE tiles of a world in one row, for worlds that use the chunked
+    layout (see ywot.chunks). Tile (tileY, tileX) lives in chunk
+    (tileY // SIZE, tileX // SIZE).
+    """
+    SIZE = 8
+
+    world = models.ForeignKey(World)
+    chunkY = models.IntegerField()
+    chunkX = models.IntegerField()
+    # "tileY,tileX" -> [content, properties, revision]
+    tiles = DictField(default={})
+    revision = models.IntegerField(default=0) # Highest revision of its tiles. ADD INDEX:
+        #CREATE INDEX CONCURRENTLY ywot_tilechunk_revision ON ywot_tilechunk(world_id, revision);
+
+    class Meta:
+        unique_together=[['world', 'chunkY', 'chunkX']]
+
 class Edit(models.Model):
+    # No longer written; see EditRecord.
     user = models.ForeignKey(User, null=True)
     ip = models.IPAddressField(null=True)
     world = models.ForeignKey(World)
@@ -86,6 +289,144 @@ class Edit(models.Model):
     class Meta:
         ordering = ['time']
     
+def insert_rows(model, fields, rows):
+    """
+    Inserts `rows`, tuples of values for the named `fields` (ids for foreign
+    keys), into `model`'s table, with one multi-row INSERT per
+    ROWS_PER_STATEMENT rows. Datetimes must already be converted with
+    connection.ops.value_to_db_datetime. Call this inside a transaction.
+    """
+    meta = model._meta
+    qn = connection.ops.quote_name
+    cols = [qn(meta.get_field(name).column) for name in fields]
+    row = '(%s)' % ', '.join(['%s'] * len(cols))
+    cursor = connection.cursor()
+    for i in xrange(0, len(rows), ROWS_PER_STATEMENT):
+        chunk = rows[i:i + ROWS_PER_STATEMENT]
+        cursor.execute('INSERT INTO %s (%s) VALUES %s' % (qn(meta.db_table), ', '.join(cols),
+                                                          ', '.join([row] * len(chunk))),
+                       [value for r in chunk for value in r])
+    transaction.set_dirty()
+
+class EditRecordManager(models.Manager):
+    FIELDS = ['world', 'tileY', 'tileX', 'charY', 'charX', 'char', 'user', 'ip', 'time']
+
+    def insert_many(self, rows):
+        """Inserts `rows`, tuples of values for FIELDS. Call this inside a transaction."""
+        to_db = connection.ops.value_to_db_datetime
+        insert_rows(self.model, self.FIELDS, [row[:-1] + (to_db(row[-1]),) for row in rows])
+
+class EditRecord(models.Model):
+    """One character accepted by send_edits. See ywot.journal and ywot.history."""
+    # ADD INDEXES, for ywot.history:
+    #CREATE INDEX CONCURRENTLY ywot_editrecord_world_time ON ywot_editrecord(world_id, time, id);
+    #CREATE INDEX CONCURRENTLY ywot_editrecord_tile_time ON ywot_editrecord(world_id, "tileY", "tileX", time, id);
+    #CREATE INDEX CONCURRENTLY ywot_editrecord_user_time ON ywot_editrecord(user_id, time, id);
+    #CREATE INDEX CONCURRENTLY ywot_editrecord_ip_time ON ywot_editrecord(ip, time, id);
+    #CREATE INDEX CONCURRENTLY ywot_editrecord_time ON ywot_editrecord(time);
+    world = models.ForeignKey(World)
+    tileY = models.IntegerField()
+    tileX = models.IntegerField()
+    charY = models.SmallIntegerField()
+    charX = models.SmallIntegerField()
+    char = models.CharField(max_length=1)
+    user = models.ForeignKey(User, null=True)
+    ip = models.IPAddressField(null=True)
+    time = models.DateTimeField()
+
+    objects = EditRecordManager()
+
+    class Meta:
+        ordering = ['time']
+    
+class EditSummary(models.Model):
+    """
+    How many characters one user or ip wrote to one tile on one day. EditRecords
+    are rolled up into these once they're older than EDIT_HISTORY_RETENTION_DAYS.
+    """
+    world = models.ForeignKey(World)
+    tileY = models.IntegerField()
+    tileX = models.IntegerField()
+    day = models.DateField(db_index=True)
+    user = models.ForeignKey(User, null=True)
+    ip = models.IPAddressField(null=True)
+    edits = models.IntegerField(default=0)
+    # ADD INDEX:
+    #CREATE INDEX CONCURRENTLY ywot_editsummary_tile_day ON ywot_editsummary(world_id, "tileY", "tileX", day);
+
+    class Meta:
+        ordering = ['day']
+
+class EditActivity(models.Model):
+    """
+    Edits to a world, or the whole site, in one hour or one day, with how
+    many distinct signed-in users and ips made them. Kept by ywot.activity.
+    """
+    PERIODS = ('hour', 'day')
+
+    # The world's id, or 0 for the whole site. (Not a ForeignKey, so the
+    # site's rows can share the unique index.)
+    scope = models.IntegerField()
+    period = models.CharField(max_length=4)
+    start = models.DateTimeField()
+    edits = models.IntegerField(default=0)
+    editors = models.IntegerField(default=0)
+    ips = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [['scope', 'period', 'start']]
+        ordering = ['start']
+
+class EditActivityMember(models.Model):
+    """
+    Someone already counted in an EditActivity: `who` is "u" and a user id,
+    or "i" and an ip. Only kept while their period may still get edits.
+    """
+    scope = models.IntegerField()
+    period = models.CharField(max_length=4)
+    start = models.DateTimeField(db_index=True)
+    who = models.CharField(max_length=20)
+
+    class Meta:
+        unique_together = [['scope', 'period', 'start', 'who']]
+
+class WorldEditors(models.Model):
+    """
+    Who has edited a world, so claim() needn't read its history; see
+    ywot.editors. `editors` holds the ids of up to MAX_EDITORS distinct
+    signed-in editors, and `more_editors` is set once there have been more.
+    """
+    MAX_EDITORS = 10
+
+    world = models.OneToOneField(World, primary_key=True)
+    editors = models.CommaSeparatedIntegerField(max_length=255, blank=True, default='')
+    more_editors = models.BooleanField(default=False)
+    anonymous = models.BooleanField(default=False) # Anyone edited without signing in
+    first_edit = models.DateTimeField(null=True)
+    last_edit = models.DateTimeField(null=True)
+    # Whether edits from before this row was created have been counted
+    backfilled = models.BooleanField(default=False)
+
+    def editor_ids(self):
+        return set([int(id) for id in self.editors.split(',') if id])
+
+    def add(self, user_ids, anonymous, first_edit, last_edit):
+        """Counts edits by `user_ids` (and anonymous ones, if `anonymous`) made between the two times."""
+        ids = self.editor_ids()
+        for id in sorted(user_ids):
+            if id in ids:
+                continue
+            if len(ids) >= self.MAX_EDITORS:
+                self.more_editors = True
+                break
+            ids.add(id)
+        self.editors = ','.join(map(str, sorted(ids)))
+        self.anonymous = self.anonymous or anonymous
+        if first_edit is not None and (self.first_edit is None or first_edit < self.first_edit):
+            self.first_edit = first_edit
+        if last_edit is not None and (self.last_edit is None or last_edit > self.last_edit):
+            self.last_edit = last_edit
+
 class Whitelist(models.Model):
     user = models.ForeignKey(User)
     world = models.ForeignKey(World)
@@ -93,4 +434,13 @@ class Whitelist(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     class Meta:
         unique_together=[['user', 'world']]
-    
+
+def _forget_world(sender, instance, **kwargs):
+    _world_cache.delete(instance.name.lower())
+signals.post_save.connect(_forget_world, sender=World)
+signals.post_delete.connect(_forget_world, sender=World)
+
+def _forget_membership(sender, instance, **kwargs):
+    permissions.forget_membership(instance.world_id, instance.user_id)
+signals.post_save.connect(_forget_membership, sender=Whitelist)
+signals.post_delete.connect(_forget_membership, sender=Whitelist)
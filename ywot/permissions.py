@@ -1,5 +1,36 @@
-def can_read(user, world):
+from django.conf import settings
+
+from yourworld.lib.cache import get_cache
+
+# Whitelist membership by (world id, user id). This is the only part of a
+# permission decision that needs the database; the rest comes from the world
+# itself, so changes to public_perm or the owner apply right away.
+_members = get_cache('member', getattr(settings, 'PERMISSION_CACHE_SIZE', 10000),
+                     getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 10))
+
+def is_member(user, world):
+    """
+    Whether `user` is on `world`'s whitelist. Remembered on the user object
+    for the rest of the request, and in a cache across requests.
+    """
     from yourworld.ywot.models import Whitelist
+    if not user.is_authenticated():
+        return False
+    memo = user.__dict__.setdefault('_ywot_membership', {})
+    if world.id not in memo:
+        key = (world.id, user.id)
+        member = _members.get(key)
+        if member is None:
+            member = Whitelist.objects.filter(user=user, world=world).exists()
+            _members.set(key, member)
+        memo[world.id] = member
+    return memo[world.id]
+
+def forget_membership(world_id, user_id):
+    """Called when a whitelist entry is added or removed."""
+    _members.delete((world_id, user_id))
+
+def can_read(user, world):
     if world.public_readable:
         return True
     if not user.is_authenticated():
@@ -8,14 +39,9 @@ def can_read(user, world):
         return True
     if user.is_superuser:
         return True
-    try:
-        Whitelist.objects.get(user=user, world=world)
-        return True
-    except Whitelist.DoesNotExist:
-        return False
+    return is_member(user, world)
        
 def can_write(user, world):
-    from yourworld.ywot.models import Whitelist
     if world.public_writable:
         return True
     if not user.is_authenticated():
@@ -23,11 +49,7 @@ def can_write(user, world):
     if world.owner_id == user.id:
         return True
     # Not allowing superuser to write. Be clean.
-    try:
-        Whitelist.objects.get(user=user, world=world)
-        return True
-    except Whitelist.DoesNotExist:
-        return False
+    return is_member(user, world)
 
 def can_admin(user, world):
     return bool(world.owner_id and (world.owner_id == user.id))
@@ -53,19 +75,31 @@ def can_urllink(user, world):
         return True
     return False
 
+def can_paste(user, world):
+    if not can_write(user, world):
+        return False
+    if can_admin(user, world):
+        return True
+    if world.properties.get('features', {}).get('paste', False):
+        return True
+    return False
+
 def get_available_features(user, world):
     features = world.properties.get('features', {})
     if can_admin(user, world):
         coordLink = True
         go_to_coord = True
         urlLink = True
+        paste = True
     else:
         coordLink = features.get('coordLink', False) and can_write(user, world)
         urlLink = features.get('urlLink', False) and can_write(user, world)
         go_to_coord = features.get('go_to_coord', False) or is_superuser(user)
+        paste = features.get('paste', False) and can_write(user, world)
     return {
             'coordLink': coordLink,
             'urlLink': urlLink,
-            'go_to_coord': go_to_coord
+            'go_to_coord': go_to_coord,
+            'paste': paste
             }
 
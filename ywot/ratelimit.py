@@ -0,0 +1,87 @@
+"""
+Admission control for the world endpoints. Each client gets a token bucket
+per world for fetches, and another for edit POSTs. A client is a signed-in
+user, or else an ip; since a school or office behind one address shares an
+ip's buckets, those get RATE_LIMIT_IP_FACTOR times the rate and burst. (The
+session cookie isn't used for anonymous clients: a script could send a new
+one with every request.) views.yourworld checks
+them before it looks the world up or reads the request body, so a flooding
+script costs little more than the 429s we send it.
+
+RATE_LIMITS maps each kind to (requests per second, burst). Buckets are kept
+in a ywot cache (see lib/cache.py). With the shared backend every worker
+counts against the same buckets, kept there as a counter per burst-sized
+window: cruder than a bucket, but one incr instead of a read and a write.
+"""
+
+import threading, time
+
+from django.conf import settings
+
+from yourworld.lib.cache import get_cache
+
+RATE_LIMITS = getattr(settings, 'RATE_LIMITS', {
+    'fetch': (5, 30),
+    'edit': (2, 10),
+})
+
+IP_FACTOR = getattr(settings, 'RATE_LIMIT_IP_FACTOR', 5)
+
+stats = dict((kind, {'allowed': 0, 'limited': 0}) for kind in RATE_LIMITS)
+
+# An idle bucket fills up in burst/rate seconds, after which it may as well
+# be forgotten.
+_refill = max([float(burst) / rate for rate, burst in RATE_LIMITS.values()] or [1])
+_buckets = get_cache('ratelimit', getattr(settings, 'RATE_LIMIT_CLIENTS', 100000), int(_refill) + 1)
+_lock = threading.Lock() # for local buckets, and stats
+
+def _take_local(key, rate, burst, now):
+    _lock.acquire()
+    try:
+        bucket = _buckets.get(key)
+        tokens = burst
+        if bucket is not None:
+            tokens = min(burst, bucket[0] + (now - bucket[1])*rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        _buckets.set(key, (tokens, now))
+        return allowed
+    finally:
+        _lock.release()
+
+def _take_shared(key, rate, burst, now):
+    window = int(now * rate / burst)
+    return _buckets.incr(key + (window,)) <= burst
+
+def client(user, ip):
+    """Whose buckets a request takes from: the user's if signed in, else the ip's."""
+    if user.is_authenticated():
+        return 'u%d' % user.id
+    return 'i' + ip
+
+def allow(kind, who, world_name):
+    """
+    Takes a token from the `kind` bucket of `who`, a `client`, for the named
+    world. Returns False if there wasn't one, i.e. the request should get a 429.
+    """
+    if kind not in RATE_LIMITS:
+        return True
+    rate, burst = RATE_LIMITS[kind]
+    if who.startswith('i'):
+        rate, burst = rate * IP_FACTOR, burst * IP_FACTOR
+    key = (kind, who, world_name.lower())
+    if _buckets.shared:
+        allowed = _take_shared(key, rate, burst, time.time())
+    else:
+        allowed = _take_local(key, rate, burst, time.time())
+    _lock.acquire()
+    try:
+        stats[kind][allowed and 'allowed' or 'limited'] += 1
+    finally:
+        _lock.release()
+    return allowed
+
+def retry_after(kind):
+    """Seconds a limited client should wait for its next token."""
+    return max(1, int(round(1.0 / RATE_LIMITS[kind][0])))
@@ -0,0 +1,370 @@
+import datetime, sys, time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import DatabaseError
+from django.test import TestCase
+from django.test.client import Client
+from django.utils import simplejson
+
+from yourworld.lib import cache
+from yourworld.ywot import (activity, benchmark, editors, history, journal, models, permissions,
+                            ratelimit, tilebuffer, tilecache, tilestore, usernames)
+from yourworld.ywot.models import EditActivity, EditRecord, EditSummary, Tile, World, WorldEditors
+
+# The app is also importable as plain `ywot`, and its models may be the ones
+# defined there; World's caches are in whichever module defined it
+world_models = sys.modules[World.__module__]
+
+def _clear_caches():
+    # Ids are reused once a test's transaction is rolled back
+    for cache in (world_models._world_cache, models._world_cache, tilecache._tiles, tilecache._revisions, permissions._members):
+        cache.clear()
+
+class BenchmarkTest(TestCase):
+    def setUp(self):
+        _clear_caches()
+
+    def test_run(self):
+        results = benchmark.run(viewers=2, typists=2, rounds=3)
+        self.assertEqual(set(results['statuses']) - set(['200', '304']), set())
+        self.assertEqual(results['results']['fetch_updates']['requests'], 12)
+        self.assertEqual(results['results']['send_edits']['requests'], 4)
+
+class TileBufferTest(TestCase):
+    def setUp(self):
+        _clear_caches()
+        self.saved = (settings.TILE_BUFFER, tilebuffer.FLUSH_INTERVAL, tilebuffer.MAX_DIRTY,
+                      ratelimit.RATE_LIMITS, journal.record_rows)
+        settings.TILE_BUFFER = True
+        # Only flush when the test says so
+        tilebuffer.FLUSH_INTERVAL = tilebuffer.MAX_DIRTY = 10**9
+        ratelimit.RATE_LIMITS = {}
+        self.journaled = []
+        journal.record_rows = self.journaled.extend
+        self.world, _ = World.get_or_create('buffered')
+        self.client = Client(REMOTE_ADDR='10.0.0.1')
+
+    def tearDown(self):
+        tilebuffer._take()
+        tilebuffer._done()
+        (settings.TILE_BUFFER, tilebuffer.FLUSH_INTERVAL, tilebuffer.MAX_DIRTY,
+         ratelimit.RATE_LIMITS, journal.record_rows) = self.saved
+
+    def fetch(self, since):
+        response = self.client.get('/buffered', {'fetch': 1, 'v': 4, 'since': since,
+                                                 'min_tileY': 0, 'min_tileX': 0,
+                                                 'max_tileY': 1, 'max_tileX': 1})
+        return simplejson.loads(response.content)
+
+    def type(self, char, tileY=0, tileX=0):
+        edit = '%d,%d,0,0,%d,%s' % (tileY, tileX, time.time() * 1000, char)
+        response = self.client.post('/buffered', {'edits': [edit], 'v': '2'})
+        return simplejson.loads(response.content)['accepted']
+
+    def test_delta_fetch_sees_buffered_edits(self):
+        cursor = self.fetch(-1)['c']
+        self.assertEqual(len(self.type('a')), 1)
+        self.assertFalse(Tile.objects.filter(world=self.world).exists())
+        tiles = self.fetch(cursor)['t']
+        self.assertEqual([(t[0], t[1], t[2][0]) for t in tiles], [(0, 0, 'a')])
+        self.assertEqual(self.journaled, [])
+
+        tilebuffer.flush()
+        self.assertEqual(Tile.objects.get(world=self.world, tileY=0, tileX=0).content[0], 'a')
+        self.assertEqual([row[5] for row in self.journaled], ['a'])
+        response = self.fetch(cursor)
+        self.assertEqual([t[2][0] for t in response['t']], ['a'])
+        self.assertEqual(self.fetch(response['c'])['t'], [])
+
+    def test_flush_skips_tiles_protected_since(self):
+        self.type('a')
+        owner = User.objects.create(username='owner')
+        tilebuffer.add(self.world, owner, '10.0.0.2', [[0, 1, 0, 0, 0, 'b']], True)
+
+        def protect(tiles):
+            for tile in tiles.values():
+                tile.properties['protected'] = True
+            return tiles.values()
+        tilestore.update_tiles(self.world, [(0, 0), (0, 1)], protect)
+
+        tilebuffer.flush()
+        tiles = dict(((t.tileY, t.tileX), t) for t in Tile.objects.filter(world=self.world))
+        self.assertEqual(tiles[(0, 0)].content[0], ' ')
+        self.assertEqual(tiles[(0, 1)].content[0], 'b')
+        self.assertEqual([(row[5], row[6]) for row in self.journaled], [('b', owner.id)])
+
+class WorldCacheTest(TestCase):
+    def setUp(self):
+        _clear_caches()
+        world = World.objects.create(name='cached')
+        world.properties['features'] = {'paste': False}
+        world.save()
+
+    def test_copies_do_not_share_properties(self):
+        World.get_or_create('cached')
+        # Read the cached world's properties, as if it had been handed out itself
+        self.assertEqual(world_models._world_cache.get('cached').properties['features'], {'paste': False})
+        for i in range(2):
+            world, new = World.get_or_create('Cached')
+            self.assertFalse(new)
+            self.assertEqual(world.properties['features'], {'paste': False})
+            world.properties['features']['paste'] = True
+            world.properties['other'] = 1
+
+class UsernamesTest(TestCase):
+    def setUp(self):
+        self.saved = usernames._start_rebuild
+        self.rebuilds = []
+        usernames._start_rebuild = lambda: self.rebuilds.append(1)
+        usernames._index, usernames._by_id, usernames._built_at = None, {}, 0
+
+    def tearDown(self):
+        usernames._start_rebuild = self.saved
+        usernames._index, usernames._by_id, usernames._built_at = None, {}, 0
+
+    def test_stale_index_is_served_while_rebuilding(self):
+        User.objects.create(username='Alice')
+        self.assertEqual(usernames.complete('al'), ['Alice'])
+        self.assertEqual(self.rebuilds, [])
+
+        usernames._built_at = 0
+        alfred = User.objects.create(username='alfred')
+        self.assertEqual(usernames.complete('AL'), ['alfred', 'Alice'])
+        self.assertEqual(len(self.rebuilds), 1)
+        alfred.delete()
+        self.assertEqual(usernames.complete('al'), ['Alice'])
+
+class _Connection(object):
+    # Closing the test database's connection would lose the database
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def close(self):
+        pass
+
+class JournalTest(TestCase):
+    def setUp(self):
+        _clear_caches()
+        self.saved = (journal.connection, editors.record)
+        journal.connection = _Connection(journal.connection)
+        self.world, _ = World.get_or_create('journaled')
+        self.user = User.objects.create(username='typist')
+
+    def tearDown(self):
+        journal.connection, editors.record = self.saved
+
+    def test_editors_failure_keeps_records(self):
+        self.assertEqual(editors.get(self.world).editor_ids(), set())
+        def fail(rows):
+            raise DatabaseError('deadlock')
+        editors.record = fail
+        failed = journal.stats['editors_failed']
+        journal._write(journal.make_rows(self.world, self.user, '10.0.0.1', [[0, 0, 0, 0, 0, 'a']]))
+        self.assertEqual(EditRecord.objects.filter(world=self.world).count(), 1)
+        self.assertEqual(journal.stats['editors_failed'], failed + 1)
+        self.assertFalse(WorldEditors.objects.get(world=self.world).backfilled)
+        # So the next use counts it from history
+        self.assertEqual(editors.get(self.world).editor_ids(), set([self.user.id]))
+
+    def test_failed_batch_is_retried(self):
+        rows = journal.make_rows(self.world, self.user, '10.0.0.1',
+                                 [[0, 0, 0, i, 0, 'a'] for i in range(2)])
+        saved_insert = journal._insert
+        def fail(batch):
+            raise DatabaseError('connection reset')
+        # Keep the writer thread out of it; the condition's lock is reentrant
+        journal._cond.acquire()
+        try:
+            saved_pending = journal._pending[:]
+            journal._pending[:] = rows
+            journal._insert = fail
+            self.assertFalse(journal._write_batch())
+            self.assertEqual(journal._pending, rows)
+            journal._insert = saved_insert
+            self.assertTrue(journal._write_batch())
+            self.assertEqual(journal._pending, [])
+        finally:
+            journal._insert = saved_insert
+            journal._pending[:] = saved_pending
+            journal._cond.release()
+        self.assertEqual(EditRecord.objects.filter(world=self.world).count(), 2)
+
+class ActivityTest(TestCase):
+    def setUp(self):
+        self.saved = (activity.connection, activity._add)
+        activity.connection = _Connection(activity.connection)
+        activity.flush() # whatever other tests left
+        self.world, _ = World.get_or_create('active')
+        self.user = User.objects.create(username='typist')
+
+    def tearDown(self):
+        activity.connection, activity._add = self.saved
+
+    def rows(self, user, ip):
+        return journal.make_rows(self.world, user, ip, [[0, 0, 0, 0, 0, 'a']])
+
+    def site_day(self):
+        return EditActivity.objects.get(scope=activity.SITE, period='day',
+                                        start=activity.period_start('day', datetime.datetime.now()))
+
+    def test_counts_are_written_by_flush(self):
+        activity.record(self.rows(self.user, '10.0.0.1'))
+        activity.record(self.rows(self.user, '10.0.0.2'))
+        self.assertFalse(EditActivity.objects.exists())
+        activity.flush()
+        row = self.site_day()
+        self.assertEqual((row.edits, row.editors, row.ips), (2, 1, 2))
+
+    def test_failed_flush_is_retried(self):
+        activity.record(self.rows(self.user, '10.0.0.1'))
+        def fail(counts):
+            raise DatabaseError('deadlock')
+        activity._add = fail
+        failed = activity.stats['failed']
+        activity.flush()
+        self.assertEqual(activity.stats['failed'], failed + 1)
+        activity._add = self.saved[1]
+        activity.record(self.rows(AnonymousUser(), '10.0.0.1'))
+        activity.flush()
+        row = self.site_day()
+        self.assertEqual((row.edits, row.editors, row.ips), (2, 1, 1))
+
+    def test_rebuilding_a_compacted_day_keeps_its_hours(self):
+        day = datetime.date.today() - datetime.timedelta(days=40)
+        hour = datetime.datetime.combine(day, datetime.time(13))
+        # As the journal counted it before the day was compacted
+        EditActivity.objects.create(scope=activity.SITE, period='hour', start=hour, edits=3)
+        EditSummary.objects.create(world=self.world, tileY=0, tileX=0, day=day, user=self.user,
+                                   ip='10.0.0.1', edits=3)
+        self.assertEqual(activity.rebuild_day(day), 3)
+        self.assertEqual(EditActivity.objects.get(scope=activity.SITE, period='hour').edits, 3)
+        self.assertEqual(EditActivity.objects.get(scope=activity.SITE, period='day').edits, 3)
+
+class TileStoreTest(TestCase):
+    def setUp(self):
+        _clear_caches()
+        self.world, _ = World.get_or_create('stored')
+
+    def test_revision_is_only_taken_for_changes(self):
+        def write(tiles):
+            tiles[(0, 0)].apply_edits([(0, 0, 'a')])
+            return tiles.values()
+        self.assertEqual(len(tilestore.update_tiles(self.world, [(0, 0)], write)), 1)
+        revision = self.world.current_revision()
+        self.assertEqual(tilestore.update_tiles(self.world, [(0, 0)], lambda tiles: []), [])
+        self.assertEqual(self.world.current_revision(), revision)
+        tilestore.update_tiles(self.world, [(0, 0)], write)
+        self.assertEqual(self.world.current_revision(), revision + 1)
+        self.assertEqual(Tile.objects.get(world=self.world).revision, revision + 1)
+
+    def test_current_revision_is_cached_and_moved_by_writes(self):
+        def write(tiles):
+            tiles[(0, 0)].apply_edits([(0, 0, 'a')])
+            return tiles.values()
+        self.assertEqual(tilecache.current_revision(self.world), 0)
+        tilestore.update_tiles(self.world, [(0, 0)], write)
+        revision = self.world.current_revision()
+        self.assertEqual(tilecache.current_revision(self.world), revision)
+        # As if another process wrote
+        self.world.next_revision()
+        self.assertEqual(tilecache.current_revision(self.world), revision)
+        tilecache._revisions.clear()
+        self.assertEqual(tilecache.current_revision(self.world), revision + 1)
+
+class SendEditsTest(TestCase):
+    def setUp(self):
+        _clear_caches()
+        self.saved = ratelimit.RATE_LIMITS
+        ratelimit.RATE_LIMITS = {}
+        self.world, _ = World.get_or_create('bounded')
+        self.client = Client(REMOTE_ADDR='10.0.0.1')
+
+    def tearDown(self):
+        ratelimit.RATE_LIMITS = self.saved
+
+    def test_edits_outside_their_tile_are_dropped(self):
+        edits = ['0,0,0,%d,0,x' % Tile.COLS, '0,0,0,-1,0,y', '0,0,%d,0,0,z' % Tile.ROWS,
+                 '0,0,1,1,0,a']
+        response = self.client.post('/bounded', {'edits': edits, 'v': '2'})
+        result = simplejson.loads(response.content)
+        self.assertEqual(result['done'], 4)
+        self.assertEqual(result['accepted'], [[0, 0, 1, 1, 0, 'a']])
+        content = Tile.objects.get(world=self.world).content
+        self.assertEqual(content.strip(), 'a')
+        self.assertEqual(content[Tile.COLS + 1], 'a')
+
+class RateLimitTest(TestCase):
+    def setUp(self):
+        self.saved = ratelimit.RATE_LIMITS
+        ratelimit.RATE_LIMITS = {'edit': (1, 2)}
+        ratelimit._buckets.clear()
+
+    def tearDown(self):
+        ratelimit.RATE_LIMITS = self.saved
+        ratelimit._buckets.clear()
+
+    def allowed(self, who, n=20):
+        return len([i for i in range(n) if ratelimit.allow('edit', who, 'limited')])
+
+    def test_users_behind_one_ip_have_their_own_buckets(self):
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        self.assertEqual(self.allowed(ratelimit.client(alice, '10.0.0.1')), 2)
+        self.assertEqual(self.allowed(ratelimit.client(bob, '10.0.0.1')), 2)
+        self.assertEqual(self.allowed(ratelimit.client(AnonymousUser(), '10.0.0.1')),
+                         2 * ratelimit.IP_FACTOR)
+
+class SharedCacheTest(TestCase):
+    def test_incr_counts_past_one(self):
+        c = cache.SharedCache('test-incr', 60)
+        c.delete('n')
+        self.assertEqual([c.incr('n') for i in range(3)], [1, 2, 3])
+        self.assertEqual(c.get('n'), 3)
+
+class BulkWriteTest(TestCase):
+    def setUp(self):
+        _clear_caches()
+        self.world, _ = World.get_or_create('bulk')
+
+    def test_bulk_save_in_several_statements(self):
+        n = models.ROWS_PER_STATEMENT + 5
+        coords = [(0, x) for x in range(n)]
+        tiles = Tile.objects.lock_many(self.world, coords)
+        for (tileY, tileX), tile in tiles.items():
+            tile.apply_edits([(0, 0, 'a')])
+        Tile.objects.bulk_save(tiles.values())
+        self.assertEqual(Tile.objects.filter(world=self.world, content__startswith='a').count(), n)
+
+        tiles = Tile.objects.lock_many(self.world, coords)
+        for (tileY, tileX), tile in tiles.items():
+            tile.apply_edits([(0, 0, 'b')])
+            tile.properties['protected'] = tileX % 2 == 0
+            tile.revision = tileX
+        Tile.objects.bulk_save(tiles.values())
+        saved = dict((t.tileX, t) for t in Tile.objects.filter(world=self.world))
+        self.assertEqual(len(saved), n)
+        self.assertEqual(set([t.content[0] for t in saved.values()]), set(['b']))
+        self.assertEqual([t.revision for x, t in sorted(saved.items())], range(n))
+        self.assertTrue(saved[2].properties['protected'])
+        self.assertFalse(saved[3].properties['protected'])
+
+class HistoryTest(TestCase):
+    def setUp(self):
+        _clear_caches()
+        self.world, _ = World.get_or_create('history')
+        for day in range(1, 4):
+            EditSummary.objects.create(world=self.world, tileY=0, tileX=0, ip='10.0.0.1', edits=1,
+                                       day=datetime.date(2010, 6, day))
+
+    def days(self, start, end):
+        return sorted([s.day.day for s in history.summaries(world=self.world, start=start, end=end)])
+
+    def test_summaries_end_is_exclusive(self):
+        self.assertEqual(self.days(datetime.datetime(2010, 6, 1), datetime.datetime(2010, 6, 3)),
+                         [1, 2])
+        self.assertEqual(self.days(datetime.datetime(2010, 6, 1, 12),
+                                   datetime.datetime(2010, 6, 2, 0, 0, 1)), [1, 2])
@@ -0,0 +1,228 @@
+"""
+A write-behind buffer for typing, used when TILE_BUFFER is on.
+
+send_edits hands accepted edits to `add` instead of writing them itself. A
+background thread writes each world's dirty tiles through tilestore every
+TILE_BUFFER_FLUSH_INTERVAL seconds, or as soon as TILE_BUFFER_MAX_DIRTY
+tiles are waiting, so a tile that many people are typing into is read and
+written once per flush rather than once per POST. Edits are merged by cell:
+the flush applies the last edit to each buffered cell to the tile as it
+stands in the database, skipping the edits of non-admins to tiles that were
+protected in the meantime, and journals the edits it kept. Whatever is
+buffered is written when the process exits.
+
+fetch_updates lays buffered cells over the tiles it sends with `overlay`,
+and sends buffered tiles even to clients whose cursor is past their last
+write. The buffer is per process, so other processes see edits only once
+they're flushed; long-pollers are woken by the flush like by any other write.
+"""
+
+import atexit, copy, threading
+
+from django.conf import settings
+from django.db import connection
+
+from yourworld.lib import log
+from yourworld.ywot.models import Tile
+from yourworld.ywot import journal, tilestore
+
+FLUSH_INTERVAL = getattr(settings, 'TILE_BUFFER_FLUSH_INTERVAL', 0.25)
+MAX_DIRTY = getattr(settings, 'TILE_BUFFER_MAX_DIRTY', 500)
+
+stats = {
+    'buffered': 0, # edits added
+    'coalesced': 0, # edits replaced by a later one to the same cell before a flush
+    'flushes': 0,
+    'tiles_written': 0,
+    'failed': 0, # edits lost to a database error while writing
+}
+
+def enabled():
+    return getattr(settings, 'TILE_BUFFER', False)
+
+_cond = threading.Condition() # also guards stats
+_flush_lock = threading.Lock() # so flushes are written in the order they were taken
+# world id -> (world, {(tileY, tileX): {(charY, charX): [(can_admin, journal row), ...]}}),
+# a cell's edits oldest first
+_pending = {}
+# The same, for what a flush has taken but not yet written, so overlay keeps
+# showing it in the meantime
+_flushing = {}
+_versions = {} # world id -> edits ever added to it, for ETags
+_dirty = 0
+_writer = None
+_stopping = False
+
+def add(world, user, ip, edits, can_admin):
+    """
+    Buffers `edits`, which are [tileY, tileX, charY, charX, timestamp, char]
+    lists as in send_edits, already checked against tile protection.
+    `can_admin` says whether they may be written to tiles that get protected
+    before the flush.
+    """
+    global _dirty
+    if not edits:
+        return
+    rows = journal.make_rows(world, user, ip, edits)
+    _cond.acquire()
+    try:
+        tiles = _pending.setdefault(world.id, (world, {}))[1]
+        for row in rows:
+            tileY, tileX, charY, charX = row[1:5]
+            cells = tiles.get((tileY, tileX))
+            if cells is None:
+                cells = tiles[(tileY, tileX)] = {}
+                _dirty += 1
+            cell = cells.setdefault((charY, charX), [])
+            if cell:
+                stats['coalesced'] += 1
+            cell.append((can_admin, row))
+        stats['buffered'] += len(rows)
+        _versions[world.id] = _versions.get(world.id, 0) + len(rows)
+        _start_writer()
+        if _dirty >= MAX_DIRTY:
+            _cond.notify()
+    finally:
+        _cond.release()
+
+def version(world):
+    """Changes whenever edits are buffered for `world`."""
+    return _versions.get(world.id, 0)
+
+def overlay(world, tiles, min_tileY, min_tileX, max_tileY, max_tileX):
+    """
+    Takes {(tileY, tileX): (revision, content, properties)} as from
+    tilecache.get_rect and returns it with the buffered cells in the
+    (inclusive) rectangle written over it, along with the set of the
+    buffered tiles' coordinates. Tiles that only exist in the buffer get
+    revision 0.
+    """
+    _cond.acquire()
+    try:
+        buffered = {}
+        for source in (_flushing, _pending):
+            entry = source.get(world.id)
+            if entry is None:
+                continue
+            for (tileY, tileX), cells in entry[1].iteritems():
+                if min_tileY <= tileY <= max_tileY and min_tileX <= tileX <= max_tileX:
+                    chars = buffered.setdefault((tileY, tileX), {})
+                    for coords, cell in cells.iteritems():
+                        chars[coords] = cell[-1][1][5]
+    finally:
+        _cond.release()
+    if not buffered:
+        return tiles, set()
+    tiles = dict(tiles)
+    for coords, chars in buffered.iteritems():
+        revision, content, properties = tiles.get(coords, (0, Tile.LEN * ' ', {}))
+        tile = Tile(content=content, properties=copy.deepcopy(properties))
+        tile.apply_edits([(charY, charX, char) for (charY, charX), char in chars.iteritems()])
+        tile.flush_content()
+        tiles[coords] = (revision, tile.content, tile.properties)
+    return tiles, set(buffered)
+
+def _take():
+    global _pending, _flushing, _dirty
+    _cond.acquire()
+    try:
+        _flushing, _pending = _pending, {}
+        _dirty = 0
+        return _flushing
+    finally:
+        _cond.release()
+
+def _done():
+    global _flushing
+    _cond.acquire()
+    try:
+        _flushing = {}
+    finally:
+        _cond.release()
+
+def _count(event, n):
+    _cond.acquire()
+    try:
+        stats[event] += n
+    finally:
+        _cond.release()
+
+def _write(world, tiles):
+    """Writes a world's buffered tiles. Returns (tiles written, journal rows of the edits kept)."""
+    kept = []
+
+    def update(locked):
+        del kept[:] # in case of a retry
+        changed = []
+        for coords, cells in tiles.iteritems():
+            tile = locked[coords]
+            protected = tile.properties.get('protected')
+            edits = []
+            for (charY, charX), cell in cells.iteritems():
+                rows = [row for can_admin, row in cell if can_admin or not protected]
+                if rows:
+                    edits.append((charY, charX, rows[-1][5]))
+                    kept.extend(rows)
+            if edits:
+                tile.apply_edits(edits)
+                changed.append(tile)
+        return changed
+
+    changed = tilestore.update_tiles(world, tiles.keys(), update)
+    return changed, kept
+
+def flush():
+    """Writes everything buffered so far, in this thread."""
+    _flush_lock.acquire()
+    try:
+        taken = _take()
+        try:
+            for world, tiles in taken.itervalues():
+                try:
+                    changed, kept = _write(world, tiles)
+                except Exception:
+                    lost = sum([len(cell) for cells in tiles.itervalues() for cell in cells.itervalues()])
+                    _count('failed', lost)
+                    log.exception('Lost %d buffered edits to world %s' % (lost, world.id))
+                    connection.close() # reconnect next time
+                    continue
+                _count('tiles_written', len(changed))
+                journal.record_rows(kept)
+            if taken:
+                _count('flushes', 1)
+        finally:
+            _done()
+    finally:
+        _flush_lock.release()
+
+def _run():
+    while not _stopping:
+        _cond.acquire()
+        try:
+            if _dirty < MAX_DIRTY and not _stopping:
+                _cond.wait(FLUSH_INTERVAL)
+        finally:
+            _cond.release()
+        flush()
+
+def _shutdown():
+    """At exit: stops the writer, then writes what's left, journal included, in this thread."""
+    global _stopping
+    _cond.acquire()
+    try:
+        _stopping = True
+        _cond.notify()
+    finally:
+        _cond.release()
+    _writer.join()
+    flush()
+    journal.flush()
+
+def _start_writer():
+    # Called with _cond held
+    global _writer
+    if _writer is None:
+        _writer = threading.Thread(target=_run, name='ywot-tilebuffer')
+        _writer.setDaemon(True)
+        _writer.start()
+        atexit.register(_shutdown)
@@ -0,0 +1,92 @@
+"""
+A cache of tile data keyed by (world_id, tileY, tileX), in front of the
+rectangle queries made by fetch_updates.
+
+Each entry is (as_of, revision, content, properties): the tile's data as it
+stood at world revision `as_of`, or (as_of, None, None, None) if there was no
+tile there. An entry is fresh while `as_of` is at least the world's current
+revision. Stale entries aren't thrown away; they're brought up to date by
+asking the database only for the tiles written since the oldest `as_of`,
+which is also what keeps workers with a local cache correct when another
+worker did the write.
+
+Writers call `put` after they commit (see tilestore), so most polls
+are answered without touching the tile table. Polls also need the world's
+current revision; that is cached for TILE_CACHE_REVISION_TIMEOUT seconds
+and moved forward by `put`, so most polls don't read WorldRevision either.
+Writes made by other processes (with a local cache) or by management
+commands can take that long to be noticed.
+"""
+
+from django.conf import settings
+
+from yourworld.lib.cache import get_cache
+
+_tiles = get_cache('tile', getattr(settings, 'TILE_CACHE_SIZE', 100000))
+
+# The current revision of each world. It's only trusted for a couple of
+# seconds, since writers that commit close together can set it out of order,
+# and writes from elsewhere don't go through `put` here.
+_revisions = get_cache('rev', 10000, getattr(settings, 'TILE_CACHE_REVISION_TIMEOUT', 2))
+
+def current_revision(world):
+    revision = _revisions.get(world.id)
+    if revision is None:
+        revision = world.current_revision()
+        _revisions.set(world.id, revision)
+    return revision
+
+def get_rect(world, min_tileY, min_tileX, max_tileY, max_tileX, current):
+    """
+    Returns {(tileY, tileX): (revision, content, properties)} for every tile
+    that exists in the (inclusive) rectangle, as of world revision `current`.
+    """
+    from yourworld.ywot.models import Tile
+    from yourworld.ywot import chunks
+    keys = [(world.id, tileY, tileX)
+            for tileY in xrange(min_tileY, max_tileY + 1)
+            for tileX in xrange(min_tileX, max_tileX + 1)]
+    entries = _tiles.get_many(keys)
+    since = None
+    for key in keys:
+        entry = entries.get(key)
+        if entry is None:
+            since = -1
+            break
+        if entry[0] < current and (since is None or entry[0] < since):
+            since = entry[0]
+    if since is not None:
+        if chunks.is_chunked(world):
+            tiles = chunks.tiles_in(world, min_tileY, min_tileX, max_tileY, max_tileX, since)
+        else:
+            tiles = Tile.objects.filter(world=world,
+                                        tileY__gte=min_tileY, tileY__lte=max_tileY,
+                                        tileX__gte=min_tileX, tileX__lte=max_tileX)
+            if since >= 0:
+                tiles = tiles.filter(revision__gt=since)
+        updated = {}
+        for t in tiles:
+            updated[(world.id, t.tileY, t.tileX)] = (current, t.revision, t.content, t.properties)
+        for key in keys:
+            if key not in updated:
+                entry = entries.get(key) or (None, None, None, None)
+                updated[key] = (current,) + entry[1:]
+        _tiles.set_many(updated)
+        entries = updated
+    result = {}
+    for key, entry in entries.iteritems():
+        if entry[1] is not None:
+            result[key[1:]] = entry[1:]
+    return result
+
+def put(world, tiles, revision):
+    """Write-through for tiles that were just saved at `revision`."""
+    _tiles.set_many(dict(((world.id, int(t.tileY), int(t.tileX)),
+                          (revision, revision, t.content, t.properties))
+                         for t in tiles))
+    if _revisions.shared or revision > _revisions.get(world.id, 0):
+        _revisions.set(world.id, revision)
+
+def invalidate(world, coords):
+    """Forget the given (tileY, tileX) pairs, e.g. after a write that bypassed `put`."""
+    _tiles.delete_many([(world.id, int(tileY), int(tileX)) for tileY, tileX in coords])
@@ -0,0 +1,97 @@
+"""
+Tile writes. Everything that changes tiles goes through here, so that each
+write gets a world revision and reaches the tile cache and long-pollers.
+
+Every write locks the world's WorldRevision row first: writers to one world
+go one at a time, and can safely ask the database which layout (plain tiles
+or chunks) the world is in. The world's next revision is only taken once
+something has changed, so writes that change nothing leave it alone.
+"""
+
+from django.db import transaction, IntegrityError
+
+from yourworld.ywot.models import Tile
+from yourworld.ywot import chunks, tilecache, updates
+
+def _publish(world, tiles, revision):
+    tilecache.put(world, tiles, revision)
+    updates.notify(world, revision)
+
+def _lock(world, coords, chunked):
+    if chunked:
+        return chunks.lock_many(world, coords)
+    return Tile.objects.lock_many(world, coords)
+
+def _bulk_save(tiles, chunked):
+    if chunked:
+        chunks.bulk_save(tiles)
+    else:
+        Tile.objects.bulk_save(tiles)
+
+def _lock_world(world):
+    """
+    Locks the world's revision row. Returns (chunked, revision), where
+    revision is None unless one had to be taken to have a row to lock.
+    """
+    chunked = chunks.lock_layout(world)
+    if chunked is not None:
+        return chunked, None
+    # The world's first write: taking a revision creates the row
+    revision = world.next_revision()
+    return chunks.is_chunked(world), revision
+
+@transaction.commit_on_success
+def _update_tiles(world, coords, update):
+    chunked, revision = _lock_world(world)
+    changed = update(_lock(world, coords, chunked))
+    if changed and revision is None:
+        revision = world.next_revision()
+    for tile in changed:
+        tile.revision = revision
+    _bulk_save(changed, chunked)
+    return changed, revision
+
+def update_tiles(world, coords, update):
+    """
+    Loads and locks the tiles at `coords` (a list of (tileY, tileX) pairs),
+    calls `update` with them as {(tileY, tileX): Tile}, and writes back the
+    tiles it returns, all in one transaction. Returns the written tiles.
+
+    `update` may be called twice, so it shouldn't have side effects beyond
+    the tiles it's given.
+    """
+    try:
+        changed, revision = _update_tiles(world, coords, update)
+    except IntegrityError:
+        # Somebody else created one of our new tiles first. It exists now.
+        changed, revision = _update_tiles(world, coords, update)
+    if changed:
+        _publish(world, changed, revision)
+    return changed
+
+@transaction.commit_on_success
+def _write_batches(world, batches):
+    chunked, revision = _lock_world(world)
+    written = 0
+    for coords, update in batches:
+        changed = update(_lock(world, coords, chunked))
+        if changed and revision is None:
+            revision = world.next_revision()
+        for tile in changed:
+            tile.revision = revision
+        _bulk_save(changed, chunked)
+        written += len(changed)
+    return written, revision
+
+def write_batches(world, batches):
+    """
+    Like update_tiles, but for many (coords, update) pairs in turn, all in one
+    transaction and under one revision; for imports, so other writes to the
+    world wait until it's done. Returns how many tiles were written. Cached
+    tiles are refreshed by revision rather than written through, so this
+    doesn't hold on to every tile it writes.
+    """
+    written, revision = _write_batches(world, batches)
+    if written:
+        _publish(world, [], revision)
+    return written
@@ -0,0 +1,48 @@
+"""
+Wake-ups for long-polling fetches.
+
+Writers call `notify` after they commit. A fetch that has nothing new to send
+calls `wait`, which returns as soon as the world's revision moves past the
+client's cursor: immediately for writes made by this process, and within
+LONGPOLL_CHECK_INTERVAL seconds for writes made by other processes.
+"""
+
+import threading, time
+
+from django.conf import settings
+from django.db import transaction
+
+from yourworld.ywot import tilecache
+
+_cond = threading.Condition()
+_latest = {} # world id -> highest revision written by this process
+
+def notify(world, revision):
+    _cond.acquire()
+    try:
+        if revision > _latest.get(world.id, 0):
+            _latest[world.id] = revision
+        _cond.notifyAll()
+    finally:
+        _cond.release()
+
+def wait(world, since, timeout):
+    """
+    Blocks until the world's revision is past `since`, or for at most
+    `timeout` seconds. Returns the current revision.
+    """
+    interval = getattr(settings, 'LONGPOLL_CHECK_INTERVAL', 0.5)
+    deadline = time.time() + timeout
+    while True:
+        current = tilecache.current_revision(world)
+        remaining = deadline - time.time()
+        if current > since or remaining <= 0:
+            return current
+        # Don't sit idle in a transaction while we wait.
+        transaction.rollback_unless_managed()
+        _cond.acquire()
+        try:
+            if _latest.get(world.id, 0) <= since:
+                _cond.wait(min(interval, remaining))
+        finally:
+            _cond.release()
@@ -0,0 +1,178 @@
+"""
+A prefix index of usernames for member_autocomplete, so that a keystroke is a
+bisect into a sorted list rather than a case-insensitive LIKE over auth_user.
+
+The index is per process. It's built on the first lookup, and users saved or
+deleted in this process are put in or taken out by signal handlers. Users
+created by other processes show up when the index is rebuilt, which happens
+after USERNAME_INDEX_MAX_AGE seconds, or after `invalidate` (see the
+rebuild_username_index command; with a shared YWOT_CACHE_BACKEND, that
+reaches every process). The first lookup after that starts the rebuild in a
+background thread and is answered from the old index, as are the lookups
+until the new one is ready; the changes the signal handlers make in the
+meantime are made to both.
+"""
+
+import bisect, threading, time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import signals
+
+from yourworld.lib import log
+from yourworld.lib.cache import get_cache
+
+MAX_AGE = getattr(settings, 'USERNAME_INDEX_MAX_AGE', 600)
+
+# Shared caches would otherwise drop the generation after their default timeout
+_generations = get_cache('usernames', 10, 30 * 24 * 3600)
+
+_build_lock = threading.Lock() # one build at a time
+_lock = threading.Lock() # for the rest, never held while reading the database
+_index = None # sorted [(username.lower(), username)]
+_by_id = {} # user id -> username, to find a user's entry again
+_built_at = 0
+_generation = None
+_rebuilding = False # a background rebuild has been started
+_changes = None # while building, [(user id, username or None if deleted)] to make to the new index
+
+def _current_generation():
+    return _generations.get('generation', 0)
+
+def _build():
+    # Called with _build_lock held
+    global _index, _by_id, _built_at, _generation, _changes
+    _lock.acquire()
+    try:
+        _changes = []
+    finally:
+        _lock.release()
+    try:
+        generation = _current_generation()
+        by_id = dict(User.objects.values_list('id', 'username').iterator())
+        index = [(username.lower(), username) for username in by_id.itervalues()]
+        index.sort()
+    except:
+        _lock.acquire()
+        try:
+            _changes = None
+        finally:
+            _lock.release()
+        raise
+    _lock.acquire()
+    try:
+        changes, _changes = _changes, None
+        _index, _by_id, _built_at, _generation = index, by_id, time.time(), generation
+        # The query may or may not have seen these
+        for user_id, username in changes:
+            _apply(user_id, username)
+        return len(_index)
+    finally:
+        _lock.release()
+
+def _rebuild_in_background():
+    global _rebuilding
+    try:
+        try:
+            _build_lock.acquire()
+            try:
+                _build()
+            finally:
+                _build_lock.release()
+        except Exception:
+            # Keep serving the old index; the next lookup tries again
+            log.exception('Rebuilding the username index failed')
+    finally:
+        _lock.acquire()
+        try:
+            _rebuilding = False
+        finally:
+            _lock.release()
+        connection.close() # this thread's own
+
+def _start_rebuild():
+    # Called with _lock held
+    global _rebuilding
+    _rebuilding = True
+    thread = threading.Thread(target=_rebuild_in_background, name='ywot-usernames')
+    thread.setDaemon(True)
+    thread.start()
+
+def _first_build():
+    _build_lock.acquire()
+    try:
+        if _index is None:
+            _build()
+    finally:
+        _build_lock.release()
+
+def complete(prefix, limit=10):
+    """The first `limit` usernames, in case-insensitive order, that start with `prefix` in any case."""
+    prefix = prefix.lower()
+    if _index is None:
+        # Nothing to serve in the meantime
+        _first_build()
+    generation = _current_generation()
+    _lock.acquire()
+    try:
+        if not _rebuilding and (time.time() - _built_at > MAX_AGE or generation != _generation):
+            _start_rebuild()
+        result = []
+        i = bisect.bisect_left(_index, (prefix,))
+        while i < len(_index) and len(result) < limit and _index[i][0].startswith(prefix):
+            result.append(_index[i][1])
+            i += 1
+        return result
+    finally:
+        _lock.release()
+
+def invalidate():
+    """Has every process rebuild its index on its next lookup."""
+    _generations.incr('generation')
+
+def rebuild():
+    """Rebuilds this process's index now, in this thread. Returns how many usernames are in it."""
+    _build_lock.acquire()
+    try:
+        return _build()
+    finally:
+        _build_lock.release()
+
+def _remove(user_id):
+    # Called with _lock held
+    username = _by_id.pop(user_id, None)
+    if username is None:
+        return
+    entry = (username.lower(), username)
+    i = bisect.bisect_left(_index, entry)
+    if i < len(_index) and _index[i] == entry:
+        del _index[i]
+
+def _apply(user_id, username):
+    # Called with _lock held
+    if _by_id.get(user_id) == username:
+        return
+    _remove(user_id)
+    if username is not None:
+        _by_id[user_id] = username
+        bisect.insort(_index, (username.lower(), username))
+
+def _changed(user_id, username):
+    _lock.acquire()
+    try:
+        if _changes is not None:
+            _changes.append((user_id, username))
+        if _index is not None:
+            _apply(user_id, username)
+    finally:
+        _lock.release()
+
+def _user_saved(sender, instance, **kwargs):
+    _changed(instance.id, instance.username)
+
+def _user_deleted(sender, instance, **kwargs):
+    _changed(instance.id, None)
+
+signals.post_save.connect(_user_saved, sender=User)
+signals.post_delete.connect(_user_deleted, sender=User)
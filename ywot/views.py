@@ -1,17 +1,22 @@
-import collections, datetime, itertools, re, urlparse
+import collections, datetime, itertools, re, time, urlparse
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.db import connection
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseRedirect, Http404
 from django.shortcuts import render_to_response, redirect
 from django.utils import simplejson
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
 
 from yourworld.helpers import req_render_to_response
 from yourworld.lib import log
-from yourworld.ywot.models import Tile, World, Edit, Whitelist
-from yourworld.ywot import permissions
+from yourworld.ywot.models import Tile, World, Whitelist
+from yourworld.ywot import (activity, editors, export, history, importer, journal, metrics,
+                            permissions, ratelimit, tilebuffer, tilecache, tilestore, updates,
+                            usernames)
 
 #
 # Helpers
@@ -34,23 +39,12 @@ def claim(user, worldname):
         return do_claim(user, world)
     if world.owner:
         raise ClaimException, "That world already has an owner."
-    editors = set(world.edit_set.all().values_list('user', flat=True))
-    if not editors:
-        return do_claim(user, world)
-    if len(editors) > 2:
-        raise ClaimException, "Too many people have edited that world."
-    if len(editors) == 2:
-        if editors == set([user, None]):
-            return do_claim(user, world)
-        else:
-            raise ClaimException, "Too many people have edited that world."
-    assert len(editors) == 1
-    obj = editors.pop()
-    if obj == user:
-        return do_claim(user, world)
-    if obj is not None:
+    summary = editors.get(world)
+    editor_ids = summary.editor_ids()
+    if summary.more_editors or editor_ids - set([user.id]):
         raise ClaimException, "Too many people have edited that world."
-    if world.created_at > datetime.datetime.now() - datetime.timedelta(minutes=5):
+    if (summary.anonymous and not editor_ids and
+        world.created_at > datetime.datetime.now() - datetime.timedelta(minutes=5)):
         raise ClaimException, "That world has been around too long to claim."
     return do_claim(user, world)
 
@@ -83,18 +77,42 @@ def get_counts(obj_iter, key_getter):
         result[key] = len(list(group))
     return result
         
+def gzip_response(request, response):
+    """Compresses `response` if the client accepts it and it's worth it."""
+    if len(response.content) < 200 or 'gzip' not in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        return response
+    response.content = compress_string(response.content)
+    response['Content-Encoding'] = 'gzip'
+    response['Content-Length'] = str(len(response.content))
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
 def response_403():
     # TODO: returns JS content type here and elsewhere
     response = HttpResponse(simplejson.dumps('No permission'))
     response.status_code = 403
     return response
 
+def response_429(kind):
+    response = HttpResponse(simplejson.dumps('Slow down'))
+    response.status_code = 429
+    response['Retry-After'] = str(ratelimit.retry_after(kind))
+    return response
+
 #
 # World Views
 #
 
 def yourworld(request, namespace):
     """Check permissions and route request."""
+    kind = None
+    if 'fetch' in request.GET:
+        kind = 'fetch'
+    elif request.method == 'POST':
+        kind = 'edit'
+    if kind and not ratelimit.allow(kind, ratelimit.client(request.user, request.META['REMOTE_ADDR']),
+                                    namespace):
+        return response_429(kind)
     world, _ = World.get_or_create(namespace)
     if not permissions.can_read(request.user, world):
         return HttpResponseRedirect('/accounts/private/')
@@ -110,6 +128,8 @@ def yourworld(request, namespace):
         'canAdmin': permissions.can_admin(request.user, world),
         'worldName': world.name,
         'features': permissions.get_available_features(request.user, world),
+        'longPoll': settings.LONGPOLL_TIMEOUT,
+        'editBatch': permissions.can_paste(request.user, world) and PASTE_BATCH or EDIT_BATCH,
     }
     if 'MSIE' in request.META.get('HTTP_USER_AGENT', ''):
         state['announce'] = "Sorry, your World of Text doesn't work well with Internet Explorer."
@@ -119,81 +139,187 @@ def yourworld(request, namespace):
     })
     
 def fetch_updates(request, world):
-    response = {}
+    """
+    Returns tile data for the requested rectangle. If the client passes a
+    `since` cursor (a world revision, or -1 for everything), only the tiles
+    written after it are sent, along with the cursor to pass next time.
+
+    With a cursor and `wait` (in seconds), this is a long poll: if nothing in
+    the rectangle has changed, the response is held until something does, or
+    until the wait (capped by LONGPOLL_TIMEOUT) runs out.
+
+    Version 4 responses look like
+        {"b": [min_tileY, min_tileX, max_tileY, max_tileX], "c": cursor,
+         "t": [[tileY, tileX, content(, properties)], ...]}
+    listing only tiles that exist. They carry an ETag for the state of the
+    whole rectangle, so a client that already has it gets a 304, and they're
+    gzipped for clients that accept it.
+    """
+    version = int(request.GET.get('v', 0))
+    if version not in (2, 3, 4):
+        raise ValueError, 'Unknown JS version'
     min_tileY = int(request.GET['min_tileY'])
     min_tileX = int(request.GET['min_tileX'])
     max_tileY = int(request.GET['max_tileY'])
     max_tileX = int(request.GET['max_tileX'])
-    response = {}
+    since = request.GET.get('since')
+    if since is None and version == 4:
+        since = -1
 
     assert min_tileY < max_tileY
     assert min_tileX < max_tileX
     assert ((max_tileY - min_tileY)*(max_tileX - min_tileX)) < 400
     
-    # Set default info to null
-    for tileY in xrange(min_tileY, max_tileY + 1): #+1 b/c of range bounds
-        for tileX in xrange(min_tileX, max_tileX + 1):
-            response["%d,%d" % (tileY, tileX)] = None
-            
-    tiles = Tile.objects.filter(world=world,
-                                tileY__gte=min_tileY, tileY__lte=max_tileY,
-                                tileX__gte=min_tileX, tileX__lte=max_tileX)
-    for t in tiles:
-        tile_key = "%s,%s" % (t.tileY, t.tileX)
-        if (int(request.GET.get('v', 0)) == 2):
-            d = {'content': t.content.replace('\n', ' ')}
-            if 'protected' in t.properties: # We want to send *any* set value (case: reset to false)
-                d['protected'] = t.properties['protected']
-            response[tile_key] = d
-        elif (int(request.GET.get('v', 0)) == 3):
-            d = {'content': t.content.replace('\n', ' ')}
-            if t.properties:
-                d['properties'] = t.properties
+    wait = 0
+    if since is not None:
+        since = int(since)
+        if since >= 0:
+            wait = min(float(request.GET.get('wait', 0)), settings.LONGPOLL_TIMEOUT)
+    deadline = time.time() + wait
+    # Read the cursor before the tiles, so a write committing in between
+    # is sent twice rather than never.
+    cursor = tilecache.current_revision(world)
+    buffered = set()
+    while True:
+        all_tiles = tilecache.get_rect(world, min_tileY, min_tileX, max_tileY, max_tileX, cursor)
+        if tilebuffer.enabled():
+            all_tiles, buffered = tilebuffer.overlay(world, all_tiles, min_tileY, min_tileX, max_tileY, max_tileX)
+        tiles = all_tiles
+        if since is not None:
+            # Buffered edits have no revision yet, so they go to everyone until they're written
+            tiles = dict((k, v) for k, v in all_tiles.iteritems() if v[0] > since or k in buffered)
+        remaining = deadline - time.time()
+        if tiles or remaining <= 0:
+            break
+        # Nothing here yet; sleep until the world changes somewhere
+        cursor = updates.wait(world, cursor, remaining)
+    metrics.fetch_tiles.observe(len(tiles))
+
+    if version == 4:
+        bounds = [min_tileY, min_tileX, max_tileY, max_tileX]
+        # Tiles are never deleted and revisions only go up, so this changes
+        # whenever anything in the rectangle does.
+        etag = '"v4-%s-%d-%d"' % ('.'.join(map(str, bounds)), len(all_tiles),
+                                  max([v[0] for v in all_tiles.itervalues()] or [0]))
+        if buffered:
+            etag = '%s-b%d"' % (etag[:-1], tilebuffer.version(world))
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+        compact = []
+        for (tileY, tileX), (revision, content, properties) in tiles.iteritems():
+            t = [tileY, tileX, content.replace('\n', ' ')]
+            if properties:
+                t.append(properties)
+            compact.append(t)
+        response = HttpResponse(simplejson.dumps({'b': bounds, 'c': cursor, 't': compact},
+                                                 separators=(',', ':')))
+        response['ETag'] = etag
+        return gzip_response(request, response)
+
+    response = {}
+    if since is None:
+        # Set default info to null
+        for tileY in xrange(min_tileY, max_tileY + 1): #+1 b/c of range bounds
+            for tileX in xrange(min_tileX, max_tileX + 1):
+                response["%d,%d" % (tileY, tileX)] = None
+    for (tileY, tileX), (revision, content, properties) in tiles.iteritems():
+        tile_key = "%s,%s" % (tileY, tileX)
+        if version == 2:
+            d = {'content': content.replace('\n', ' ')}
+            if 'protected' in properties: # We want to send *any* set value (case: reset to false)
+                d['protected'] = properties['protected']
             response[tile_key] = d
         else:
-            raise ValueError, 'Unknown JS version'
+            d = {'content': content.replace('\n', ' ')}
+            if properties:
+                d['properties'] = properties
+            response[tile_key] = d
+    if since is not None:
+        response = {'cursor': cursor, 'tiles': response}
     return HttpResponse(simplejson.dumps(response))
     
+# Most edits taken from one POST: far more than anyone types between sends
+EDIT_BATCH = 200
+# ...or, on worlds that allow pasting, written PASTE_CHUNK to a transaction
+PASTE_BATCH = getattr(settings, 'PASTE_BATCH_SIZE', 2000)
+PASTE_CHUNK = 500
+
+def _apply_edits(world, edits, can_admin):
+    """Writes `edits`, skipping protected tiles. Returns the edits written."""
+    accepted = []
+
+    def update(tiles):
+        del accepted[:] # in case of a retry
+        by_tile = {}
+        for edit in edits:
+            tileY, tileX, charY, charX, timestamp, char = edit
+            tile = tiles[(tileY, tileX)]
+            if tile.properties.get('protected') and not can_admin:
+                continue    
+            by_tile.setdefault((tileY, tileX), []).append((charY, charX, char))
+            accepted.append(edit)
+        for coords, tile_edits in by_tile.iteritems():
+            tiles[coords].apply_edits(tile_edits)
+        return [tiles[coords] for coords in by_tile]
+
+    tilestore.update_tiles(world, [edit[:2] for edit in edits], update)
+    return accepted
+
+def _buffer_edits(world, user, ip, edits, can_admin):
+    """
+    Like _apply_edits, but into tilebuffer, which journals them once they're
+    written. Returns None, having buffered nothing, if the edits are too
+    spread out to look up their tiles in one go.
+    """
+    if not edits:
+        return []
+    ys = [edit[0] for edit in edits]
+    xs = [edit[1] for edit in edits]
+    if (max(ys) - min(ys) + 1)*(max(xs) - min(xs) + 1) > RANGE_MAX_TILES:
+        return None
+    if can_admin:
+        accepted = edits
+    else:
+        tiles = tilecache.get_rect(world, min(ys), min(xs), max(ys), max(xs),
+                                   tilecache.current_revision(world))
+        accepted = [edit for edit in edits
+                    if not tiles.get((edit[0], edit[1]), (None, None, {}))[2].get('protected')]
+    tilebuffer.add(world, user, ip, accepted, can_admin)
+    return accepted
+
 def send_edits(request, world):
+    """
+    Writes the first EDIT_BATCH edits POSTed (PASTE_BATCH where the user may
+    paste), and responds with the ones accepted, i.e. not on protected tiles
+    (nor outside their tile, which are dropped as they're read). Clients that send v=2 get {"accepted": [...], "done": n} instead, and
+    should send everything after the first n edits again.
+    """
     assert permissions.can_write(request.user, world) # Checked by router
-    response = []
-    tiles = {} # a simple cache
-    edits = [e.split(',', 5) for e in request.POST.getlist('edits')]
+    limit = permissions.can_paste(request.user, world) and PASTE_BATCH or EDIT_BATCH
+    edits = request.POST.getlist('edits')[:limit]
+    parsed = []
     for edit in edits:
+        edit = edit.split(',', 5)
         char = edit[5]
         tileY, tileX, charY, charX, timestamp = map(int, edit[:5])
         assert len(char) == 1 # TODO: investigate these tracebacks
-        keyname = "%d,%d" % (tileY, tileX)
-        if keyname in tiles:
-            tile = tiles[keyname]
-        else:
-            # TODO: select for update
-            tile, _ = Tile.objects.get_or_create(world=world, tileY=tileY, tileX=tileX)
-            tiles[keyname] = tile
-        if tile.properties.get('protected'):
-            if not permissions.can_admin(request.user, world):
-                continue    
-        tile.set_char(charY, charX, char)
-        # TODO: anything, please.
-        if tile.properties:
-            if 'cell_props' in tile.properties:
-                if str(charY) in tile.properties['cell_props']: #must be str because that's how JSON interprets int keys
-                    if str(charX) in tile.properties['cell_props'][str(charY)]:
-                        del tile.properties['cell_props'][str(charY)][str(charX)]
-                        if not tile.properties['cell_props'][str(charY)]:
-                            del tile.properties['cell_props'][str(charY)]
-                            if not tile.properties['cell_props']:
-                                del tile.properties['cell_props']
-        response.append([tileY, tileX, charY, charX, timestamp, char])
-    if len(edits) < 200:
-        for tile in tiles.values():
-            tile.save()
-        Edit.objects.create(world=world, 
-                            user=request.user if request.user.is_authenticated() else None,
-                            content=repr(edits),
-                            ip=request.META['REMOTE_ADDR'],
-                            )
-    return HttpResponse(simplejson.dumps(response))
+        if not (0 <= charY < Tile.ROWS and 0 <= charX < Tile.COLS):
+            continue
+        parsed.append([tileY, tileX, charY, charX, timestamp, char])
+    metrics.edit_batch.observe(len(parsed))
+    can_admin = permissions.can_admin(request.user, world)
+    ip = request.META['REMOTE_ADDR']
+    accepted = None
+    if tilebuffer.enabled():
+        accepted = _buffer_edits(world, request.user, ip, parsed, can_admin)
+    if accepted is None:
+        accepted = []
+        for i in xrange(0, len(parsed), PASTE_CHUNK):
+            accepted.extend(_apply_edits(world, parsed[i:i + PASTE_CHUNK], can_admin))
+        journal.record(world, request.user, ip, accepted)
+    if request.POST.get('v') == '2':
+        return HttpResponse(simplejson.dumps({'accepted': accepted, 'done': len(edits)}))
+    return HttpResponse(simplejson.dumps(accepted))
 
 #
 # Account Views
@@ -227,6 +353,7 @@ def configure(request, worldname):
         # TODO: log security?
         return redirect('profile')
     add_member_message = None
+    import_message = None
     if request.method == 'POST':
         if request.POST['form'] == 'public_perm':
             pp = request.POST['public_perm']
@@ -255,8 +382,20 @@ def configure(request, worldname):
             features['go_to_coord'] = bool(int(request.POST['go_to_coord']))
             features['coordLink'] = bool(int(request.POST['coordLink']))
             features['urlLink'] = bool(int(request.POST['urlLink']))
+            features['paste'] = bool(int(request.POST['paste']))
             world.properties['features'] = features
             world.save()
+        elif request.POST['form'] == 'import':
+            if 'file' in request.FILES:
+                lines = request.FILES['file']
+            else:
+                lines = request.POST['text'].splitlines()
+            do_import = importer.FORMATS[request.POST['format']]
+            try:
+                n = do_import(world, lines, int(request.POST['tileY']), int(request.POST['tileX']))
+                import_message = 'Wrote %d tile%s.' % (n, n != 1 and 's' or '')
+            except importer.ImportException, msg:
+                import_message = msg
         else:
             raise ValueError, "Unknown form type"
             
@@ -266,13 +405,193 @@ def configure(request, worldname):
         public_perm = 'read'
     else:
         public_perm = 'none'
+    today = datetime.datetime.now()
+    week = activity.period_start('day', today - datetime.timedelta(days=6))
+    counts = activity.get(world.id, 'day', week, today)
+    recent_activity = [[day] + list(counts.get(day, (0, 0, 0)))
+                       for day in date_range(week, activity.period_start('day', today))]
     return req_render_to_response(request, 'configure.html', {
         'world': world,
+        'recent_activity': recent_activity,
         'public_perm': public_perm,
         'members': User.objects.filter(whitelist__world=world).order_by('username'),
-        'add_member_message': add_member_message
+        'add_member_message': add_member_message,
+        'import_message': import_message,
         })
     
+@login_required
+def edit_history(request, worldname):
+    """
+    Recent edits to a world as JSON, newest first, for its owner or a superuser.
+    Filters (all optional): min_tileY, min_tileX, max_tileY, max_tileX; user
+    (a username); ip; start and end (unix times, end exclusive). Page with
+    `cursor` and `limit`. Pass `summary` for the daily totals of compacted
+    history instead.
+    """
+    try:
+        world = World.objects.get(name__iexact=worldname)
+    except World.DoesNotExist:
+        raise Http404
+    if not (permissions.can_admin(request.user, world) or permissions.is_superuser(request.user)):
+        return response_403()
+    GET = request.GET
+    filters = {'world': world}
+    if 'min_tileY' in GET:
+        filters['region'] = tuple(int(GET[k]) for k in ('min_tileY', 'min_tileX', 'max_tileY', 'max_tileX'))
+    if GET.get('user'):
+        try:
+            filters['user'] = User.objects.get(username__iexact=GET['user'])
+        except User.DoesNotExist:
+            raise Http404
+    if GET.get('ip'):
+        filters['ip'] = GET['ip']
+    for k in ('start', 'end'):
+        if GET.get(k):
+            filters[k] = datetime.datetime.fromtimestamp(float(GET[k]))
+    username = lambda obj: obj.user.username if obj.user_id else None
+    if 'summary' in GET:
+        response = {'summaries': [[s.day.isoformat(), s.tileY, s.tileX, username(s), s.ip, s.edits]
+                                  for s in history.summaries(**filters)[:history.MAX_LIMIT]]}
+    else:
+        records, cursor = history.query(cursor=GET.get('cursor'), limit=int(GET.get('limit', 100)),
+                                        **filters)
+        response = {
+            'records': [[r.time.isoformat(), r.tileY, r.tileX, r.charY, r.charX, r.char, username(r), r.ip]
+                        for r in records],
+            'cursor': cursor,
+        }
+    return HttpResponse(simplejson.dumps(response))
+
+# Longest span edit_activity covers, in periods
+ACTIVITY_MAX = {'hour': 24*31, 'day': 366*10}
+ACTIVITY_DEFAULT = {'hour': 24*7, 'day': 365}
+
+def edit_activity(request, worldname=None):
+    """
+    Edits, distinct signed-in editors and distinct ips per `period` ('day', the
+    default, or 'hour') as JSON, oldest first, for the last `n` periods or from
+    `start` to `end` (unix times): {"period": ..., "rows": [[start, edits,
+    editors, ips], ...]}. For a world's owner or a superuser, or without a
+    world, the whole site's for superusers.
+    """
+    if worldname is None:
+        if not permissions.is_superuser(request.user):
+            return response_403()
+        scope = activity.SITE
+    else:
+        try:
+            world = World.objects.get(name__iexact=worldname)
+        except World.DoesNotExist:
+            raise Http404
+        if not (permissions.can_admin(request.user, world) or permissions.is_superuser(request.user)):
+            return response_403()
+        scope = world.id
+    period = request.GET.get('period', 'day')
+    if period not in ACTIVITY_MAX:
+        raise Http404
+    step = datetime.timedelta(**{period + 's': 1})
+    if request.GET.get('end'):
+        end = datetime.datetime.fromtimestamp(float(request.GET['end']))
+    else:
+        end = datetime.datetime.now()
+    if request.GET.get('start'):
+        start = datetime.datetime.fromtimestamp(float(request.GET['start']))
+    else:
+        start = end - step*(int(request.GET.get('n', ACTIVITY_DEFAULT[period])) - 1)
+    start = max(start, end - step*(ACTIVITY_MAX[period] - 1))
+    start, end = activity.period_start(period, start), activity.period_start(period, end)
+    counts = activity.get(scope, period, start, end)
+    rows = [[t.isoformat()] + list(counts.get(t, (0, 0, 0))) for t in date_range(start, end, step)]
+    return HttpResponse(simplejson.dumps({'period': period, 'rows': rows}))
+
+@login_required
+def server_stats(request):
+    """Counters for operators, as JSON. Superusers only."""
+    if not permissions.is_superuser(request.user):
+        return response_403()
+    return HttpResponse(simplejson.dumps({
+        'ratelimit': ratelimit.stats,
+        'journal': journal.stats,
+        'activity': activity.stats,
+        'log': log.stats,
+        'tilebuffer': tilebuffer.stats,
+        'db_pool': _pool_stats(),
+    }))
+
+def _pool_stats():
+    pool = getattr(connection, 'pool', None)
+    return pool and pool.stats()
+
+def metrics_text(request):
+    """
+    ywot.metrics and the counters behind server_stats, in Prometheus' text
+    format, for METRICS_ALLOWED_IPS and superusers.
+    """
+    if not (request.META['REMOTE_ADDR'] in getattr(settings, 'METRICS_ALLOWED_IPS', ())
+            or permissions.is_superuser(request.user)):
+        return response_403()
+    lines = metrics.render()
+    lines.extend(metrics.render_values(
+        'ywot_ratelimit_requests_total', 'Requests let through or limited, by kind.', 'counter',
+        [({'kind': kind, 'result': result}, n)
+         for kind, counts in sorted(ratelimit.stats.items()) for result, n in sorted(counts.items())]))
+    lines.extend(metrics.render_values(
+        'ywot_journal_records_total', 'Edit journal records, by what became of them.', 'counter',
+        [({'state': state}, n) for state, n in sorted(journal.stats.items())]))
+    lines.extend(metrics.render_values(
+        'ywot_log_records_total', 'Log records, by what became of them.', 'counter',
+        [({'state': state}, n) for state, n in sorted(log.stats.items())]))
+    lines.extend(metrics.render_values(
+        'ywot_tilebuffer_total', 'Write-behind tile buffer activity, by event.', 'counter',
+        [({'event': event}, n) for event, n in sorted(tilebuffer.stats.items())]))
+    pool = _pool_stats()
+    if pool:
+        lines.extend(metrics.render_values(
+            'ywot_db_pool_connections', 'Pooled database connections in this process, by state.', 'gauge',
+            [({'state': 'in_use'}, pool['in_use']), ({'state': 'idle'}, pool['idle']),
+             ({'state': 'max'}, pool['size'])]))
+        lines.extend(metrics.render_values(
+            'ywot_db_pool_events_total', 'Pool acquires, waits, timeouts and connections opened or closed.', 'counter',
+            [({'event': event}, pool[event])
+             for event in ('acquired', 'waits', 'timeouts', 'opened', 'recycled', 'broken')]))
+        lines.extend(metrics.render_values(
+            'ywot_db_pool_wait_seconds_total', 'Time requests spent waiting for a pooled connection.', 'counter',
+            [({}, pool['wait_seconds'])]))
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
+
+def export_world(request, worldname):
+    """
+    Streams the whole world (or the tiles within min_tileY, min_tileX, max_tileY
+    and max_tileX) as a download, to its owner or a superuser. `format` is
+    'text' (the default) or 'jsonl'.
+    """
+    try:
+        world = World.objects.get(name__iexact=worldname)
+    except World.DoesNotExist:
+        raise Http404
+    if not (permissions.can_admin(request.user, world) or permissions.is_superuser(request.user)):
+        return response_403()
+    format = request.GET.get('format', 'text')
+    if format not in export.FORMATS:
+        raise Http404
+    bbox = None
+    if 'min_tileY' in request.GET:
+        bbox = [int(request.GET[k]) for k in ('min_tileY', 'min_tileX', 'max_tileY', 'max_tileX')]
+
+    def stream():
+        try:
+            for chunk in export.FORMATS[format](world, bbox):
+                yield chunk
+        finally:
+            # This runs after the request has finished, so nobody else will
+            connection.close()
+
+    mimetype = (format == 'jsonl') and 'application/x-json-lines' or 'text/plain'
+    response = HttpResponse(stream(), mimetype='%s; charset=utf-8' % mimetype)
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+            world.name.replace('/', '_'), format == 'jsonl' and 'jsonl' or 'txt')
+    return response
+
 def logout(request):
     from django.contrib.auth import logout
     logout(request)
@@ -287,101 +606,140 @@ def member_autocomplete(request):
     q = request.GET['q']
     assert q
     # TODO: filter by is_active? only if we aren't going to accept those as input...
-    users = (User.objects
-             .filter(username__istartswith=q)
-             .order_by('username')
-             .values_list('username', flat=True))[:10]
-    return HttpResponse('\n'.join(users))
+    return HttpResponse('\n'.join(usernames.complete(q)))
+
+# Largest area, in tiles, that protect, unprotect and the links take at once
+RANGE_MAX_TILES = 2500
+
+def _tile_range(POST):
+    """
+    The (inclusive) rectangle of tiles POSTed as tileY and tileX, and
+    max_tileY and max_tileX for more than one tile.
+    """
+    tileY, tileX = int(POST['tileY']), int(POST['tileX'])
+    max_tileY = int(POST.get('max_tileY', tileY))
+    max_tileX = int(POST.get('max_tileX', tileX))
+    assert tileY <= max_tileY and tileX <= max_tileX
+    assert (max_tileY - tileY + 1)*(max_tileX - tileX + 1) <= RANGE_MAX_TILES
+    return tileY, tileX, max_tileY, max_tileX
+
+def _range_fields(rect, names):
+    # The start of the range, as before ranges; then the end, if it's not the start
+    start, end = rect[:len(rect)//2], rect[len(rect)//2:]
+    fields = zip(names, start)
+    if start != end:
+        fields.extend(zip(['max_' + name for name in names], end))
+    return fields
+
+def _set_protected(world, rect, protected):
+    min_tileY, min_tileX, max_tileY, max_tileX = rect
+    coords = [(tileY, tileX) for tileY in xrange(min_tileY, max_tileY + 1)
+                             for tileX in xrange(min_tileX, max_tileX + 1)]
+    def update(tiles):
+        # Tiles that don't exist yet aren't protected, so unprotect leaves them be
+        changed = [tile for tile in tiles.itervalues()
+                   if bool(tile.properties.get('protected')) != protected]
+        for tile in changed:
+            tile.properties['protected'] = protected
+        return changed
+    tilestore.update_tiles(world, coords, update)
 
 def protect(request):
     world = World.objects.get(name=request.POST['namespace'])
     if not permissions.can_admin(request.user, world):
         return response_403()
-    tileY, tileX = request.POST['tileY'], request.POST['tileX']
-    # TODO: select for update
-    tile, _ = Tile.objects.get_or_create(world=world, tileY=tileY, tileX=tileX)
-    tile.properties['protected'] = True
-    tile.save()
-    log.info('ACTION:PROTECT %s %s %s' % (world.id, tileY, tileX))
+    rect = _tile_range(request.POST)
+    _set_protected(world, rect, True)
+    log.action('PROTECT', [('world', world.id)] + _range_fields(rect, ['tileY', 'tileX']))
     return HttpResponse('')
     
 def unprotect(request):
-    # TODO: factor out w/above
     # TODO: make return javascript
     world = World.objects.get(name=request.POST['namespace'])
     if not permissions.can_admin(request.user, world):
         return response_403()
-    tileY, tileX = request.POST['tileY'], request.POST['tileX']
-    # TODO: select for update
-    tile, _ = Tile.objects.get_or_create(world=world, tileY=tileY, tileX=tileX)
-    tile.properties['protected'] = False
-    tile.save()
-    log.info('ACTION:UNPROTECT %s %s %s' % (world.id, tileY, tileX))
+    rect = _tile_range(request.POST)
+    _set_protected(world, rect, False)
+    log.action('UNPROTECT', [('world', world.id)] + _range_fields(rect, ['tileY', 'tileX']))
     return HttpResponse('')
 
+CELL_FIELDS = ['tileY', 'tileX', 'charY', 'charX']
+
+def _cell_range(POST):
+    """
+    The (inclusive) rectangle of cells POSTed as tileY, tileX, charY and
+    charX, plus max_tileY, max_tileX, max_charY and max_charX for more than
+    one cell, as (tileY, tileX, charY, charX, max_tileY, ..., max_charX).
+    """
+    start = [int(POST[name]) for name in CELL_FIELDS]
+    end = [int(POST.get('max_' + name, value)) for name, value in zip(CELL_FIELDS, start)]
+    for tileY, tileX, charY, charX in (start, end):
+        assert 0 <= charY < Tile.ROWS
+        assert 0 <= charX < Tile.COLS
+    assert (start[0], start[2]) <= (end[0], end[2]) and (start[1], start[3]) <= (end[1], end[3])
+    assert (end[0] - start[0] + 1)*(end[1] - start[1] + 1) <= RANGE_MAX_TILES
+    return tuple(start + end)
+
+def _link_cells(request, world, link):
+    """
+    Puts `link` on each cell in the POSTed range, except on protected tiles
+    when the user can't admin the world. Returns the range if anything was
+    linked, or None.
+    """
+    cells = _cell_range(request.POST)
+    # Cells counted from the world's origin
+    top, left = cells[0]*Tile.ROWS + cells[2], cells[1]*Tile.COLS + cells[3]
+    bottom, right = cells[4]*Tile.ROWS + cells[6], cells[5]*Tile.COLS + cells[7]
+    coords = [(tileY, tileX) for tileY in xrange(cells[0], cells[4] + 1)
+                             for tileX in xrange(cells[1], cells[5] + 1)]
+    can_admin = permissions.can_admin(request.user, world)
+    def update(tiles):
+        changed = []
+        for (tileY, tileX), tile in tiles.iteritems():
+            if tile.properties.get('protected') and not can_admin:
+                # TODO: log?
+                continue
+            # Must convert to str because that's how JsonField reads the existing keys
+            cell_props = tile.properties.setdefault('cell_props', {})
+            for charY in xrange(max(top - tileY*Tile.ROWS, 0),
+                                min(bottom - tileY*Tile.ROWS, Tile.ROWS - 1) + 1):
+                row = cell_props.setdefault(str(charY), {})
+                for charX in xrange(max(left - tileX*Tile.COLS, 0),
+                                    min(right - tileX*Tile.COLS, Tile.COLS - 1) + 1):
+                    row.setdefault(str(charX), {})['link'] = dict(link)
+            changed.append(tile)
+        return changed
+    if not tilestore.update_tiles(world, coords, update):
+        return None
+    return cells
+
 def coordlink(request):
     world = World.objects.get(name=request.POST['namespace'])
     if not permissions.can_coordlink(request.user, world):
         return response_403()
-    tileY, tileX = int(request.POST['tileY']), int(request.POST['tileX'])
-    tile, _ = Tile.objects.get_or_create(world=world, tileY=tileY, tileX=tileX)
-    if tile.properties.get('protected'):
-        if not permissions.can_admin(request.user, world):
-            # TODO: log?
-            return HttpResponse('')
-    # Must convert to str because that's how JsonField reads the existing keys
-    charY = int(request.POST['charY'])
-    charX = int(request.POST['charX'])
-    assert charY < Tile.ROWS
-    assert charX < Tile.COLS
-    charY, charX = str(charY), str(charX)
     link_tileY = str(int(request.POST['link_tileY']))
     link_tileX = str(int(request.POST['link_tileX']))
-    if 'cell_props' not in tile.properties:
-        tile.properties['cell_props'] = {}
-    if charY not in tile.properties['cell_props']:
-        tile.properties['cell_props'][charY] = {}
-    if charX not in tile.properties['cell_props'][charY]:
-        tile.properties['cell_props'][charY][charX] = {}
-    tile.properties['cell_props'][charY][charX]['link'] = {
+    cells = _link_cells(request, world, {
             'type': 'coord',
             'link_tileY': link_tileY,
             'link_tileX': link_tileX,
-            }
-    tile.save()
-    log.info('ACTION:COORDLINK %s %s %s %s %s %s %s' % (world.id, tileY, tileX, charY, charX, link_tileY, link_tileX))
+            })
+    if cells:
+        log.action('COORDLINK', [('world', world.id)] + _range_fields(cells, CELL_FIELDS) +
+                   [('link_tileY', link_tileY), ('link_tileX', link_tileX)])
     return HttpResponse('')
 
 def urllink(request):
-    # TODO: factor out w/above
     world = World.objects.get(name=request.POST['namespace'])
     if not permissions.can_urllink(request.user, world):
         return response_403()
-    tileY, tileX = int(request.POST['tileY']), int(request.POST['tileX'])
-    tile, _ = Tile.objects.get_or_create(world=world, tileY=tileY, tileX=tileX)
-    if tile.properties.get('protected'):
-        if not permissions.can_admin(request.user, world):
-            # TODO: log?
-            return HttpResponse('')
-    # Must convert to str because that's how JsonField reads the existing keys
-    charY = int(request.POST['charY'])
-    charX = int(request.POST['charX'])
-    assert charY < Tile.ROWS
-    assert charX < Tile.COLS
-    charY, charX = str(charY), str(charX)
     url = request.POST['url'].strip()
     if not urlparse.urlparse(url)[0]: # no scheme
         url = 'http://' + url
-    if 'cell_props' not in tile.properties:
-        tile.properties['cell_props'] = {}
-    if charY not in tile.properties['cell_props']:
-        tile.properties['cell_props'][charY] = {}
-    if charX not in tile.properties['cell_props'][charY]:
-        tile.properties['cell_props'][charY][charX] = {}
-    tile.properties['cell_props'][charY][charX]['link'] = {
+    cells = _link_cells(request, world, {
             'type': 'url',
             'url': url,
-            }
-    tile.save()
-    log.info('ACTION:URLLINK %s %s %s %s %s %s' % (world.id, tileY, tileX, charY, charX, url))
+            })
+    if cells:
+        log.action('URLLINK', [('world', world.id)] + _range_fields(cells, CELL_FIELDS) + [('url', url)])
     return HttpResponse('')